@@ -0,0 +1,529 @@
+"""
+Database-side stock status aggregation.
+
+The stock status counts (stockouts, emergency, low, good supply, etc.)
+are normally computed by loading every ProductStock and calling the
+is_* methods on each one. For large deployments that means a full
+python scan per location/product/filter combination, so this module
+computes the same counts with a single grouped query instead, or reads
+them from the materialized StockStatus table.
+"""
+from datetime import datetime, timedelta
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection, transaction, IntegrityError
+from django.db.models import Count, Sum
+from rapidsms.conf import settings
+from logistics.util import config
+from logistics.balances import apply_historical_balances
+from logistics.spot_cache import get_generations, get_fresh_many, \
+    set_fresh_many, get_or_compute
+
+# the counts cached by StockCacheMixin, in the order they are selected below
+STOCK_COUNT_KEYS = ("stocked_count",
+                    "other_count",
+                    "stockout_count",
+                    "emergency_stock_count",
+                    "low_stock_count",
+                    "emergency_plus_low",
+                    "good_supply_count",
+                    "adequate_supply_count",
+                    "overstocked_count")
+
+# the spot cache key all of the counts above (plus consumption) are packed under
+STOCK_COUNTS_CACHE_KEY = "stock_counts"
+
+# one bit per count, as stored in StockStatus.flags
+STOCK_STATUS_FLAGS = dict((key, 1 << i) for i, key in enumerate(STOCK_COUNT_KEYS))
+
+# These mirror the ProductStock.is_* methods. Note that levels are compared
+# against the untruncated (consumption * months) value: for an integer quantity
+# q, q <= int(x) is equivalent to q <= x, and q > int(x) to q > x, so we don't
+# need to reproduce python's int() truncation in sql. A NULL quantity sorts
+# below everything in python 2, which is why it counts as an emergency.
+_CONDITIONS = {
+    "stocked_count": "quantity > 0",
+    "other_count": "monthly_consumption IS NULL AND quantity > 0",
+    "stockout_count": "quantity = 0",
+    "emergency_stock_count": "%(el)s IS NOT NULL AND (quantity IS NULL OR quantity <= %(el)s)",
+    "low_stock_count": "%(rl)s IS NOT NULL AND %(el)s IS NOT NULL "
+                       "AND quantity <= %(rl)s AND quantity > %(el)s",
+    "emergency_plus_low": "%(rl)s IS NOT NULL AND quantity <= %(rl)s AND quantity > 0",
+    "good_supply_count": "%(ml)s IS NOT NULL AND %(rl)s IS NOT NULL "
+                         "AND quantity > %(rl)s AND quantity <= %(ml)s",
+    "adequate_supply_count": "%(ml)s IS NOT NULL AND %(el)s IS NOT NULL "
+                             "AND quantity > %(el)s AND quantity <= %(ml)s",
+    "overstocked_count": "%(ml)s IS NOT NULL AND quantity > %(ml)s",
+}
+
+def _column(model, field):
+    return "%s.%s" % (connection.ops.quote_name(model._meta.db_table),
+                      connection.ops.quote_name(model._meta.get_field(field).column))
+
+def _level_factor_sql(policy_key, global_value, supply_point_type_column):
+    """
+    Returns sql (and params) for the number of months of consumption
+    that make up a given stock level, either from the global settings
+    or per supply point type.
+    """
+    if settings.LOGISTICS_USE_GLOBAL_STOCK_LEVEL_POLICY:
+        return "%s", [global_value]
+    try:
+        policies = config.SupplyPointPolicies.STOCK_POLICIES
+    except AttributeError:
+        raise ImproperlyConfigured("Stock level policies are not configured correctly for this deployment.")
+    sql = ["CASE %s" % supply_point_type_column]
+    params = []
+    for code, policy in policies.items():
+        sql.append("WHEN %s THEN %s")
+        params.extend([code, policy[policy_key]])
+    sql.append("ELSE NULL END")
+    return " ".join(sql), params
+
+def _resolved_levels_sql(stocks):
+    """
+    Returns sql (and params) selecting, for every stock in the queryset,
+    the quantity, the resolved monthly consumption (same precedence as
+    ProductStock.monthly_consumption) and the factors used to compute
+    the emergency, reorder and maximum levels.
+    """
+    from logistics.models import ProductStock, SupplyPoint, Product, \
+        DefaultMonthlyConsumption
+    qn = connection.ops.quote_name
+    ps_table = qn(ProductStock._meta.db_table)
+    sp_table = qn(SupplyPoint._meta.db_table)
+    p_table = qn(Product._meta.db_table)
+    dmc_table = qn(DefaultMonthlyConsumption._meta.db_table)
+    sp_type = _column(SupplyPoint, "type")
+
+    params = []
+    selects = []
+    selects.append("%s AS supply_point_id" % _column(ProductStock, "supply_point"))
+    selects.append("%s AS quantity" % _column(ProductStock, "quantity"))
+    selects.append("%s AS manual_monthly_consumption" % _column(ProductStock, "manual_monthly_consumption"))
+    selects.append(("CASE WHEN %(use_auto)s = %%s AND %(auto)s > 0 THEN %(auto)s "
+                    "ELSE COALESCE(%(manual)s, %(default)s, %(average)s) END AS monthly_consumption") % \
+                   {"use_auto": _column(ProductStock, "use_auto_consumption"),
+                    "auto": _column(ProductStock, "auto_monthly_consumption"),
+                    "manual": _column(ProductStock, "manual_monthly_consumption"),
+                    "default": _column(DefaultMonthlyConsumption, "default_monthly_consumption"),
+                    "average": _column(Product, "average_monthly_consumption")})
+    params.append(True)
+    for alias, policy_key, global_value in \
+      (("emergency_factor", "EMERGENCY_LEVEL", settings.LOGISTICS_EMERGENCY_LEVEL_IN_MONTHS),
+       ("reorder_factor", "REORDER_LEVEL", settings.LOGISTICS_REORDER_LEVEL_IN_MONTHS),
+       ("maximum_factor", "MAXIMUM_LEVEL", settings.LOGISTICS_MAXIMUM_LEVEL_IN_MONTHS)):
+        sql, factor_params = _level_factor_sql(policy_key, global_value, sp_type)
+        selects.append("%s AS %s" % (sql, alias))
+        params.extend(factor_params)
+    selects.append("%s AS static_emergency_level" % _column(Product, "emergency_order_level"))
+
+    stock_ids = stocks.values("pk").query
+    ids_sql, ids_params = stock_ids.get_compiler(connection=connection).as_sql()
+    sql = ("SELECT %(selects)s FROM %(ps)s "
+           "INNER JOIN %(sp)s ON %(ps_sp)s = %(sp_id)s "
+           "INNER JOIN %(p)s ON %(ps_p)s = %(p_id)s "
+           "LEFT OUTER JOIN %(dmc)s ON %(dmc_type)s = %(sp_type)s AND %(dmc_p)s = %(ps_p)s "
+           "WHERE %(ps_id)s IN (%(ids)s)") % \
+            {"selects": ", ".join(selects),
+             "ps": ps_table, "sp": sp_table, "p": p_table, "dmc": dmc_table,
+             "ps_sp": _column(ProductStock, "supply_point"),
+             "sp_id": _column(SupplyPoint, "id"),
+             "ps_p": _column(ProductStock, "product"),
+             "p_id": _column(Product, "id"),
+             "dmc_type": _column(DefaultMonthlyConsumption, "supply_point_type"),
+             "sp_type": sp_type,
+             "dmc_p": _column(DefaultMonthlyConsumption, "product"),
+             "ps_id": _column(ProductStock, "id"),
+             "ids": ids_sql}
+    return sql, params + list(ids_params)
+
+def _stock_counts_sql(stocks, by_supply_point=False):
+    if settings.LOGISTICS_USE_STATIC_EMERGENCY_LEVELS:
+        emergency_level = "static_emergency_level"
+    else:
+        emergency_level = "monthly_consumption * emergency_factor"
+    levels = {"el": "(%s)" % emergency_level,
+              "rl": "(monthly_consumption * reorder_factor)",
+              "ml": "(monthly_consumption * maximum_factor)"}
+    sums = ["SUM(CASE WHEN %s THEN 1 ELSE 0 END)" % (_CONDITIONS[key] % levels) \
+            for key in STOCK_COUNT_KEYS]
+    sums.append("SUM(manual_monthly_consumption)")
+    levels_sql, params = _resolved_levels_sql(stocks)
+    if by_supply_point:
+        return ("SELECT %s, supply_point_id FROM (%s) resolved_levels "
+                "GROUP BY supply_point_id" % (", ".join(sums), levels_sql)), params
+    return "SELECT %s FROM (%s) resolved_levels" % (", ".join(sums), levels_sql), params
+
+def _counts_from_row(row):
+    counts = dict((key, int(row[i] or 0)) for i, key in enumerate(STOCK_COUNT_KEYS))
+    counts["consumption"] = row[len(STOCK_COUNT_KEYS)]
+    return counts
+
+def stock_counts_from_db(stocks):
+    """
+    Computes all the stock status counts (plus the summed manual
+    consumption) for a queryset of ProductStocks in one query.
+    Returns a dictionary keyed by STOCK_COUNT_KEYS and 'consumption'.
+
+    Historical quantities are not supported here; callers should use
+    the python implementation when looking at a non-default datespan.
+    """
+    sql, params = _stock_counts_sql(stocks)
+    cursor = connection.cursor()
+    cursor.execute(sql, params)
+    return _counts_from_row(cursor.fetchone())
+
+def stock_counts_by_supply_point_from_db(stocks):
+    """
+    Like stock_counts_from_db, but grouped by supply point.
+    Returns a dictionary of counts keyed by supply point id. Supply
+    points without any stocks are left out.
+    """
+    sql, params = _stock_counts_sql(stocks, by_supply_point=True)
+    cursor = connection.cursor()
+    cursor.execute(sql, params)
+    return dict((row[-1], _counts_from_row(row)) for row in cursor.fetchall())
+
+def stock_status_flags(stock):
+    """
+    Returns the StockStatus.flags bitmask for a ProductStock, with a bit
+    set for every count the stock is included in.
+    """
+    statuses = {"stocked_count": stock.quantity > 0,
+                "other_count": stock.is_other(),
+                "stockout_count": stock.quantity == 0,
+                "emergency_stock_count": stock.is_below_emergency_level(),
+                "low_stock_count": stock.is_below_low_supply_but_above_emergency_level(),
+                "emergency_plus_low": stock.is_below_low_supply(),
+                "good_supply_count": stock.is_in_good_supply(),
+                "adequate_supply_count": stock.is_in_adequate_supply(),
+                "overstocked_count": stock.is_overstocked()}
+    flags = 0
+    for key in STOCK_COUNT_KEYS:
+        if statuses[key]:
+            flags |= STOCK_STATUS_FLAGS[key]
+    return flags
+
+# the StockStatus columns copied from each ProductStock
+STOCK_STATUS_FIELDS = ("is_active", "quantity", "manual_monthly_consumption", 
+                       "monthly_consumption", "flags", "last_updated")
+
+def _stock_status_values(stock):
+    return {"is_active": stock.is_active,
+            "quantity": stock.quantity,
+            "manual_monthly_consumption": stock.manual_monthly_consumption,
+            "monthly_consumption": stock.monthly_consumption,
+            "flags": stock_status_flags(stock),
+            "last_updated": datetime.utcnow()}
+
+def _stock_status_sql():
+    from logistics.models import StockStatus
+    qn = connection.ops.quote_name
+    column = lambda field: qn(StockStatus._meta.get_field(field).column)
+    table = qn(StockStatus._meta.db_table)
+    update = "UPDATE %s SET %s WHERE %s = %%s AND %s = %%s" % \
+        (table, ", ".join("%s = %%s" % column(field) for field in STOCK_STATUS_FIELDS),
+         column("supply_point"), column("product"))
+    insert = "INSERT INTO %s (%s) VALUES (%s)" % \
+        (table, ", ".join(column(field) for field in ("supply_point", "product") + STOCK_STATUS_FIELDS),
+         ", ".join(["%s"] * (len(STOCK_STATUS_FIELDS) + 2)))
+    return update, insert
+
+def _stock_status_params(values):
+    from logistics.models import StockStatus
+    return [StockStatus._meta.get_field(field).get_db_prep_save(values[field], connection=connection) \
+            for field in STOCK_STATUS_FIELDS]
+
+def refresh_stock_statuses(stocks):
+    """
+    Brings the StockStatus rows for an iterable of ProductStocks up to date,
+    finding the rows that exist in one query and updating them in one batch.
+    """
+    from logistics.models import StockStatus
+    stocks = list(stocks)
+    if not stocks:
+        return
+    existing = set(StockStatus.objects.filter(supply_point__in=set(stock.supply_point_id for stock in stocks),
+                                              product__in=set(stock.product_id for stock in stocks))\
+                       .values_list("supply_point", "product"))
+    update, insert = _stock_status_sql()
+    updates = []
+    inserts = []
+    for stock in stocks:
+        key = [stock.supply_point_id, stock.product_id]
+        params = _stock_status_params(_stock_status_values(stock))
+        if tuple(key) in existing:
+            updates.append(params + key)
+        else:
+            inserts.append((key, params))
+    cursor = connection.cursor()
+    if updates:
+        cursor.executemany(update, updates)
+    for key, params in inserts:
+        sid = transaction.savepoint()
+        try:
+            cursor.execute(insert, key + params)
+        except IntegrityError:
+            # someone else created it since we looked, so update theirs
+            transaction.savepoint_rollback(sid)
+            cursor.execute(update, params + key)
+        else:
+            transaction.savepoint_commit(sid)
+    transaction.commit_unless_managed()
+
+def rebuild_stock_statuses():
+    """
+    Throws away and recreates the whole StockStatus table from ProductStock.
+    Should be run inside a transaction. Returns the number of rows created.
+    """
+    from logistics.models import StockStatus, ProductStock
+    StockStatus.objects.all().delete()
+    count = 0
+    for stock in ProductStock.objects.select_related("supply_point", "supply_point__type", 
+                                                     "product").iterator():
+        StockStatus.objects.create(supply_point_id=stock.supply_point_id, 
+                                   product_id=stock.product_id, 
+                                   **_stock_status_values(stock))
+        count += 1
+    return count
+
+def _empty_counts():
+    counts = dict((key, 0) for key in STOCK_COUNT_KEYS)
+    counts["consumption"] = None
+    return counts
+
+def _add_flags(counts, flags, count):
+    for key in STOCK_COUNT_KEYS:
+        if flags & STOCK_STATUS_FLAGS[key]:
+            counts[key] += count
+
+def _add_consumption(counts, consumption):
+    # consumption stays None unless something actually has one
+    if consumption is not None:
+        counts["consumption"] = (counts["consumption"] or 0) + consumption
+
+def _add_counts(counts, other):
+    for key in STOCK_COUNT_KEYS:
+        counts[key] += other[key]
+    _add_consumption(counts, other["consumption"])
+
+def stock_counts_from_status_table(statuses):
+    """
+    Computes all the stock status counts (plus the summed manual
+    consumption) for a queryset of StockStatuses, by counting the
+    rows for each distinct set of flags.
+    Returns a dictionary keyed by STOCK_COUNT_KEYS and 'consumption'.
+    """
+    counts = _empty_counts()
+    for row in statuses.values("flags").annotate(count=Count("pk")).order_by():
+        _add_flags(counts, row["flags"], row["count"])
+    counts["consumption"] = statuses.exclude(manual_monthly_consumption=None)\
+        .aggregate(consumption=Sum('manual_monthly_consumption'))['consumption']
+    return counts
+
+def stock_counts_by_supply_point_from_status_table(statuses):
+    """
+    Like stock_counts_from_status_table, but grouped by supply point.
+    Returns a dictionary of counts keyed by supply point id.
+    """
+    by_supply_point = {}
+    for row in statuses.values("supply_point", "flags").annotate(count=Count("pk")).order_by():
+        counts = by_supply_point.setdefault(row["supply_point"], _empty_counts())
+        _add_flags(counts, row["flags"], row["count"])
+    for row in statuses.values("supply_point")\
+      .annotate(consumption=Sum("manual_monthly_consumption")).order_by():
+        if row["supply_point"] in by_supply_point:
+            by_supply_point[row["supply_point"]]["consumption"] = row["consumption"]
+    return by_supply_point
+
+def stock_counts_by_supply_point_from_python(stocks, datespan=None):
+    """
+    Computes the stock counts for each supply point by walking through 
+    every stock once. Returns a dictionary of counts keyed by supply point id.
+    """
+    by_supply_point = {}
+    if datespan and not datespan.is_default:
+        stocks = apply_historical_balances(stocks, datespan.end_of_end_day - timedelta(days=1))
+    for stock in stocks:
+        counts = by_supply_point.setdefault(stock.supply_point_id, _empty_counts())
+        _add_flags(counts, stock_status_flags(stock), 1)
+        # NB: consumption is never historical, same as StockCacheMixin
+        _add_consumption(counts, stock.manual_monthly_consumption)
+    return by_supply_point
+
+def _parent_id(location):
+    if 'mptt' in settings.INSTALLED_APPS:
+        return location.tree_parent_id
+    return location.parent_id
+
+class StockCountRollup(object):
+    """
+    The stock counts for a location and every location and facility 
+    below it. 
+    
+    Rather than scanning all the stocks under each location separately,
+    this computes the counts for every facility once and then sums them 
+    up the location tree, so that all the counts for a whole region or
+    country come out of a single pass.
+    """
+    
+    def __init__(self, location, product=None, producttype=None, datespan=None):
+        from logistics.models import SupplyPoint
+        self.location = location
+        self.product = product
+        self.producttype = producttype
+        self.datespan = datespan
+        # these match what Location.all_facilities() uses
+        self.locations = list(location.get_descendants(include_self=True))
+        self.facilities = list(SupplyPoint.objects.filter(location__in=self.locations, 
+                                                          active=True))
+        if location.pk not in [loc.pk for loc in self.locations]:
+            # get_descendants leaves out inactive locations, but the root
+            # still needs its (active descendants') counts
+            self.locations.append(location)
+        self._generations = None
+        if settings.LOGISTICS_USE_SPOT_CACHING:
+            # read before counting, so anything that changes while
+            # we're counting leaves the cached counts looking stale
+            self._generations = self._read_generations()
+        self._facility_counts = self._count_facilities()
+        self._location_counts = self._sum_locations()
+    
+    def _cache_key(self, node):
+        return stock_counts_cache_key(node, self.product, self.producttype, self.datespan)
+    
+    def _read_generations(self):
+        nodes = self.locations + self.facilities
+        keys = list(set(key for node in nodes for key in node._cache_generation_keys()))
+        current = dict(zip(keys, get_generations(keys)))
+        return dict((self._cache_key(node), 
+                     tuple(current[key] for key in node._cache_generation_keys())) \
+                    for node in nodes)
+    
+    def _count_facilities(self):
+        is_current = not (self.datespan and not self.datespan.is_default)
+        if settings.LOGISTICS_STOCK_COUNTS_BY == settings.STOCK_COUNTS_BY_STATUS_TABLE and is_current:
+            statuses = self.location._filtered_stock_status(self.product, self.producttype)\
+                        .filter(supply_point__in=self.facilities)
+            counts = stock_counts_by_supply_point_from_status_table(statuses)
+        else:
+            stocks = self.location._filtered_stock(self.product, self.producttype)\
+                      .filter(supply_point__in=self.facilities)
+            if settings.LOGISTICS_STOCK_COUNTS_BY == settings.STOCK_COUNTS_BY_SQL and is_current:
+                counts = stock_counts_by_supply_point_from_db(stocks)
+            else:
+                stocks = stocks.select_related("supply_point", "supply_point__type", "product")
+                counts = stock_counts_by_supply_point_from_python(stocks, self.datespan)
+        for facility in self.facilities:
+            if facility.pk not in counts:
+                counts[facility.pk] = _empty_counts()
+        return counts
+    
+    def _sum_locations(self):
+        parents = dict((loc.pk, _parent_id(loc)) for loc in self.locations)
+        totals = dict((pk, _empty_counts()) for pk in parents)
+        for facility in self.facilities:
+            _add_counts(totals[facility.location_id], self._facility_counts[facility.pk])
+        
+        def _depth(pk):
+            # how far below the root, guarding against loops in the tree
+            depth = 0
+            seen = set([pk])
+            while parents[pk] in parents and parents[pk] not in seen:
+                pk = parents[pk]
+                seen.add(pk)
+                depth += 1
+            return depth
+        
+        # deepest first, so every location's total is complete
+        # before it's added to its parent's
+        for pk in sorted(parents, key=_depth, reverse=True):
+            if pk != self.location.pk and parents[pk] in totals:
+                _add_counts(totals[parents[pk]], totals[pk])
+        return totals
+    
+    def counts(self, node):
+        """
+        Returns the counts dictionary for a location or facility 
+        covered by this rollup.
+        """
+        from logistics.models import SupplyPoint
+        if isinstance(node, SupplyPoint):
+            return self._facility_counts[node.pk]
+        return self._location_counts[node.pk]
+    
+    def get(self, node, key):
+        return self.counts(node)[key]
+    
+    def cache(self):
+        """
+        Puts the counts for every location and facility in the rollup 
+        in the spot cache, under the key StockCacheMixin uses, in a single
+        round-trip. Does nothing unless spot caching is on.
+        """
+        if self._generations is None:
+            return
+        set_fresh_many(dict((self._cache_key(node), self.counts(node)) \
+                            for node in self.locations + self.facilities),
+                       self._generations)
+
+class CachedStockCounts(object):
+    """
+    Stock counts for a set of locations and facilities, read from the 
+    spot cache. Has the same interface as StockCountRollup.
+    """
+    
+    def __init__(self, counts, product=None, producttype=None, datespan=None):
+        # counts are keyed by cache key
+        self._counts = counts
+        self.product = product
+        self.producttype = producttype
+        self.datespan = datespan
+    
+    def counts(self, node):
+        return self._counts[stock_counts_cache_key(node, self.product, self.producttype, 
+                                                   self.datespan)]
+    
+    def get(self, node, key):
+        return self.counts(node)[key]
+
+def stock_counts_cache_key(node, product, producttype, datespan=None):
+    """
+    The spot cache key for the packed counts of a location or facility
+    """
+    return node._cache_key(STOCK_COUNTS_CACHE_KEY, product, producttype, datespan)
+
+def stock_count_rollup(location, children, product=None, producttype=None, datespan=None):
+    """
+    Returns the counts for a location and its children (facilities and 
+    locations). 
+    
+    If spot caching is on and all of them are cached (and fresh), these 
+    are read in one round-trip. Otherwise the rollup for the location is 
+    computed (and cached).
+    """
+    if settings.LOGISTICS_USE_SPOT_CACHING:
+        keys = dict((stock_counts_cache_key(node, product, producttype, datespan), 
+                     node._cache_generation_keys()) for node in [location] + list(children))
+        fresh = get_fresh_many(keys)
+        if len(fresh) == len(keys):
+            return CachedStockCounts(fresh, product, producttype, datespan)
+    rollup = StockCountRollup(location, product, producttype, datespan)
+    rollup.cache()
+    return rollup
+
+def rolled_up_stock_count(location, key, product=None, producttype=None, datespan=None):
+    """
+    Returns one stock count for a location, from the cache if possible,
+    otherwise by rolling up (and caching) the counts for everything 
+    below it.
+    """
+    if settings.LOGISTICS_USE_SPOT_CACHING:
+        def _compute():
+            rollup = StockCountRollup(location, product, producttype, datespan)
+            rollup.cache()
+            return rollup.counts(location)
+        counts = get_or_compute(stock_counts_cache_key(location, product, producttype, datespan), 
+                                location._cache_generation_keys(), _compute)
+        return counts[key]
+    return StockCountRollup(location, product, producttype, datespan).get(location, key)
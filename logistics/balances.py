@@ -0,0 +1,320 @@
+"""
+In-memory historical stock balances.
+
+SupplyPointBase.historical_stock() and historical_stock_by_date() run
+one ordered StockTransaction query per (supply point, product, date),
+which adds up to thousands of queries for a facility x product x month
+grid. A BalanceIndex loads the transactions for a whole set of supply
+points once, after which each of those lookups is a binary search.
+
+When only one date is needed (e.g. for a historical dashboard),
+balances_as_of gets the latest balance of every stock at a set of
+supply points in a single query instead.
+
+For past months, historical_stock_counts reads the HistoricalStockCache
+table (filling in any months that are missing from it, or that were
+cached before they had ended, first), so that reports only have to 
+compute each month once.
+"""
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timedelta
+from django.db import connection, transaction, IntegrityError
+from django.db.models import Count
+
+def _pk(obj):
+    return getattr(obj, "pk", obj)
+
+def _ids(objects):
+    if hasattr(objects, "values_list"):
+        return list(objects.values_list("pk", flat=True))
+    return [_pk(obj) for obj in objects]
+
+def end_of_day(date):
+    """
+    The cutoff SupplyPointBase.historical_stock_by_date uses for a date: 
+    midnight at the end of it.
+    """
+    return datetime(date.year, date.month, date.day) + timedelta(days=1)
+
+def first_of_next_month(year, month):
+    if month == 12:
+        return datetime(year + 1, 1, 1)
+    return datetime(year, month + 1, 1)
+
+class BalanceIndex(object):
+    """
+    The ending balance after every stock transaction, as a pair of
+    date-sorted arrays per (supply point, product). Transactions with
+    the same date are ordered by pk, like the queries in
+    transactions_before_or_during.
+    """
+
+    def __init__(self, supply_points=None, products=None, before=None):
+        """
+        supply_points and products can be querysets or lists of objects,
+        and limit what's loaded (None means everything). If before is
+        specified, only transactions before that date are loaded.
+        """
+        from logistics.models import StockTransaction
+        transactions = StockTransaction.objects.all()
+        if supply_points is not None:
+            transactions = transactions.filter(supply_point__in=supply_points)
+        if products is not None:
+            transactions = transactions.filter(product__in=products)
+        if before is not None:
+            transactions = transactions.filter(date__lt=before)
+        self._dates = {}
+        self._balances = {}
+        key = None
+        for supply_point_id, product_id, date, balance in transactions\
+          .order_by("supply_point", "product", "date", "pk")\
+          .values_list("supply_point", "product", "date", "ending_balance").iterator():
+            if key != (supply_point_id, product_id):
+                key = (supply_point_id, product_id)
+                dates = self._dates[key] = []
+                balances = self._balances[key] = array("l")
+            dates.append(date)
+            balances.append(balance)
+
+    def _balance_at(self, supply_point, product, cutoff, bisect, default_value):
+        key = (_pk(supply_point), _pk(product))
+        dates = self._dates.get(key)
+        if dates is None:
+            return default_value
+        i = bisect(dates, cutoff)
+        if i == 0:
+            return default_value
+        return self._balances[key][i - 1]
+
+    def balance_before(self, supply_point, product, cutoff, default_value=None):
+        """
+        The balance after the last transaction strictly before cutoff.
+        """
+        return self._balance_at(supply_point, product, cutoff, bisect_left, default_value)
+
+    def balance_as_of(self, supply_point, product, cutoff, default_value=None):
+        """
+        The balance after the last transaction on or before cutoff.
+        """
+        return self._balance_at(supply_point, product, cutoff, bisect_right, default_value)
+
+    def historical_stock(self, supply_point, product, year, month, default_value=0):
+        """
+        Same as SupplyPointBase.historical_stock: the balance at the end
+        of the month.
+        """
+        return self.balance_before(supply_point, product,
+                                   first_of_next_month(year, month), default_value)
+
+    def historical_stock_by_date(self, supply_point, product, date, default_value=0):
+        """
+        Same as SupplyPointBase.historical_stock_by_date: the balance at
+        the end of the day (any time of day on date is ignored).
+        """
+        return self.balance_as_of(supply_point, product, end_of_day(date), default_value)
+
+    def first_dates(self):
+        """
+        The date of the first transaction for every stock in the index,
+        keyed by (supply point id, product id).
+        """
+        return dict((key, dates[0]) for key, dates in self._dates.items())
+
+    def has_transactions(self, supply_point, product):
+        return (_pk(supply_point), _pk(product)) in self._dates
+
+
+def _ids_sql(objects):
+    """
+    SQL (and params) for a list of ids, from a queryset of objects, 
+    a values queryset selecting a single column of ids, or a list of 
+    objects/ids.
+    """
+    if hasattr(objects, "query"):
+        if not hasattr(objects, "_fields"):
+            objects = objects.values("pk")
+        return objects.query.get_compiler(connection=connection).as_sql()
+    ids = [_pk(obj) for obj in objects]
+    if not ids:
+        return "NULL", []
+    return ", ".join(["%s"] * len(ids)), ids
+
+def _supports_window_functions():
+    return "postgis" in connection.settings_dict["ENGINE"] or \
+           "postgresql" in connection.settings_dict["ENGINE"]
+
+def balances_as_of(supply_points, cutoff, products=None):
+    """
+    Returns the ending balance of the last transaction on or before 
+    cutoff for every (supply point, product) at the supply points, 
+    as a dictionary keyed by (supply point id, product id). Stocks 
+    without any transactions by then are left out.
+    
+    supply_points (and products, to limit the results) can be querysets
+    or lists. This runs one query, using a window function where the 
+    database supports it and a correlated subquery otherwise.
+    """
+    from logistics.models import StockTransaction
+    qn = connection.ops.quote_name
+    table = qn(StockTransaction._meta.db_table)
+    columns = dict((field, qn(StockTransaction._meta.get_field(field).column)) \
+                   for field in ("id", "supply_point", "product", "date", "ending_balance"))
+    sp_sql, sp_params = _ids_sql(supply_points)
+    where = ["%(supply_point)s IN (%(sp_ids)s)", "%(date)s <= %%s"]
+    params = list(sp_params) + [connection.ops.value_to_db_datetime(cutoff)]
+    if products is not None:
+        product_sql, product_params = _ids_sql(products)
+        where.append("%(product)s IN (%(product_ids)s)")
+        params.extend(product_params)
+    else:
+        product_sql = None
+    values = dict(columns, table=table, sp_ids=sp_sql, product_ids=product_sql)
+    where = " AND ".join(where) % values
+    
+    if _supports_window_functions():
+        sql = ("SELECT supply_point_id, product_id, ending_balance FROM ("
+               "SELECT %(supply_point)s AS supply_point_id, %(product)s AS product_id, "
+               "%(ending_balance)s AS ending_balance, ROW_NUMBER() OVER ("
+               "PARTITION BY %(supply_point)s, %(product)s "
+               "ORDER BY %(date)s DESC, %(id)s DESC) AS position "
+               "FROM %(table)s WHERE %%s) latest WHERE position = 1") % values
+        sql = sql % where
+    else:
+        # greatest-per-group: keep the rows that are the latest for their stock
+        sql = ("SELECT %(supply_point)s, %(product)s, %(ending_balance)s "
+               "FROM %(table)s WHERE %%s AND %(id)s = ("
+               "SELECT latest.%(id)s FROM %(table)s latest "
+               "WHERE latest.%(supply_point)s = %(table)s.%(supply_point)s "
+               "AND latest.%(product)s = %(table)s.%(product)s "
+               "AND latest.%(date)s <= %%%%s "
+               "ORDER BY latest.%(date)s DESC, latest.%(id)s DESC LIMIT 1)") % values
+        sql = sql % where
+        params.append(connection.ops.value_to_db_datetime(cutoff))
+    cursor = connection.cursor()
+    cursor.execute(sql, params)
+    return dict(((supply_point_id, product_id), balance) \
+                for supply_point_id, product_id, balance in cursor.fetchall())
+
+def apply_historical_balances(stocks, date):
+    """
+    Sets the quantity of each ProductStock to what it was at the end of
+    date, where there are any transactions by then, like 
+    historical_stock_by_date(product, date, default_value=None) would.
+    Returns the stocks as a list.
+    """
+    stocks = list(stocks)
+    balances = balances_as_of(set(stock.supply_point_id for stock in stocks), end_of_day(date))
+    for stock in stocks:
+        balance = balances.get((stock.supply_point_id, stock.product_id))
+        if balance is not None:
+            stock.quantity = balance
+    return stocks
+
+def write_historical_stock_cache(inserts=(), updates=()):
+    """
+    Writes HistoricalStockCache rows in bulk, marking them computed now.
+    inserts are (supply point id, product id, year, month, stock) tuples 
+    and updates are (stock, row id) tuples. Leaves committing to the caller.
+    """
+    from logistics.models import HistoricalStockCache
+    qn = connection.ops.quote_name
+    column = lambda field: qn(HistoricalStockCache._meta.get_field(field).column)
+    table = qn(HistoricalStockCache._meta.db_table)
+    computed = connection.ops.value_to_db_datetime(datetime.utcnow())
+    cursor = connection.cursor()
+    if updates:
+        cursor.executemany("UPDATE %s SET %s = %%s, %s = %%s WHERE %s = %%s" % \
+                           (table, column("stock"), column("computed"), column("id")), 
+                           [(stock, computed, pk) for stock, pk in updates])
+    if inserts:
+        cursor.executemany("INSERT INTO %s (%s) VALUES (%%s, %%s, %%s, %%s, %%s, %%s)" % \
+                           (table, ", ".join(column(field) for field in \
+                                             ("supply_point", "product", "year", "month", 
+                                              "stock", "computed"))), 
+                           [tuple(row) + (computed,) for row in inserts])
+
+def is_complete(computed, year, month):
+    """
+    Whether a HistoricalStockCache row for the month, computed at 
+    computed, was worked out after the month had ended.
+    """
+    return computed is not None and computed >= first_of_next_month(year, month)
+
+def fill_historical_stock_cache(supply_points, products, year, month):
+    """
+    Adds whatever HistoricalStockCache rows are missing for the month for
+    every (supply point, product), and recomputes any that were written 
+    before the month had ended. Stocks without any transactions by the 
+    end of the month are cached with a stock of None. Returns the number 
+    of rows written.
+    """
+    from logistics.models import HistoricalStockCache
+    supply_point_ids = _ids(supply_points)
+    product_ids = _ids(products)
+    existing = {}
+    stale = {}
+    for pk, sp, p, computed in HistoricalStockCache.objects.filter(supply_point__in=supply_point_ids, 
+                                                                   product__in=product_ids,
+                                                                   year=year, month=month)\
+                               .values_list("pk", "supply_point", "product", "computed"):
+        existing[(sp, p)] = pk
+        if not is_complete(computed, year, month):
+            stale[(sp, p)] = pk
+    missing = [(sp, p) for sp in supply_point_ids for p in product_ids \
+               if (sp, p) not in existing]
+    if not missing and not stale:
+        return 0
+    
+    balances = BalanceIndex(set(sp for sp, _ in missing + stale.keys()), product_ids, 
+                            before=first_of_next_month(year, month))
+    inserts = [(sp, p, year, month, balances.historical_stock(sp, p, year, month, default_value=None)) \
+               for sp, p in missing]
+    updates = [(balances.historical_stock(sp, p, year, month, default_value=None), pk) \
+               for (sp, p), pk in stale.items()]
+    sid = transaction.savepoint()
+    try:
+        write_historical_stock_cache(inserts, updates)
+    except IntegrityError:
+        # someone else filled in the same month at the same time, 
+        # and their rows are as good as ours
+        transaction.savepoint_rollback(sid)
+        return 0
+    transaction.savepoint_commit(sid)
+    transaction.commit_unless_managed()
+    return len(inserts) + len(updates)
+
+def historical_stock_counts(supply_points, products, year, month):
+    """
+    Counts the supply points with and without stock of each product at 
+    the end of the month, as a dictionary of (with stock, without stock) 
+    pairs keyed by product id. Supply points with no transactions by 
+    then are in neither count.
+    
+    Past months come from HistoricalStockCache, filling in any missing 
+    (or incomplete) rows first, in a constant number of queries. The current month is 
+    still changing, so it's computed from the transactions instead.
+    """
+    from logistics.models import HistoricalStockCache
+    supply_point_ids = _ids(supply_points)
+    product_ids = _ids(products)
+    counts = dict((p, [0, 0]) for p in product_ids)
+    now = datetime.utcnow()
+    if (year, month) >= (now.year, now.month):
+        balances = balances_as_of(supply_point_ids, first_of_next_month(year, month) - \
+                                  timedelta(microseconds=1), product_ids)
+        for (_, product_id), stock in balances.items():
+            if stock > 0:
+                counts[product_id][0] += 1
+            elif stock == 0:
+                counts[product_id][1] += 1
+        return dict((p, tuple(c)) for p, c in counts.items())
+    
+    fill_historical_stock_cache(supply_point_ids, product_ids, year, month)
+    cached = HistoricalStockCache.objects.filter(supply_point__in=supply_point_ids, 
+                                                 product__in=product_ids,
+                                                 year=year, month=month)
+    for i, rows in enumerate((cached.filter(stock__gt=0), cached.filter(stock=0))):
+        for row in rows.values("product").annotate(count=Count("pk")).order_by():
+            counts[row["product"]][i] = row["count"]
+    return dict((p, tuple(c)) for p, c in counts.items())
@@ -1,9 +1,14 @@
+import hashlib
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
 from datetime import datetime
 from dimagi.utils.dates import DateSpan, get_day_of_month
 from dateutil.relativedelta import relativedelta
-from django.core.cache import cache
+from logistics.spot_cache import cache
 import gviz_api
-from logistics.models import ProductReportType, Product, ProductStock
+from logistics.models import ProductReportType, Product, ProductStock, StockTransaction
+from logistics.consumption import ConsumptionSettings, ConsumptionCalculator, \
+    TRANSACTION_FIELDS
 from logistics.const import Reports
 
 
@@ -17,7 +22,7 @@ def stocklevel_plot(transactions):
     table = gviz_api.DataTable(cols)
 
     data_rows = {}
-    for t in transactions:
+    for t in transactions.select_related("product"):
         if not t.product.average_monthly_consumption: continue
         if not t.date in data_rows: data_rows[t.date] = {}
         data_rows[t.date][t.product.name] = float(t.ending_balance) / float(t.product.average_monthly_consumption)
@@ -34,6 +39,61 @@ def stocklevel_plot(transactions):
                                 order_by="date")
     return chart_data
         
+def _supply_points_hash(sps):
+    if hasattr(sps, "values_list"):
+        ids = sps.values_list("pk", flat=True)
+    else:
+        ids = [getattr(sp, "pk", sp) for sp in sps]
+    return hashlib.md5(",".join(str(pk) for pk in sorted(set(ids)))).hexdigest()
+
+def _as_datetime(d):
+    return d if isinstance(d, datetime) else datetime(d.year, d.month, d.day)
+
+def _average_monthly_consumptions(sps, products, datespans):
+    """
+    The average monthly consumption of each product across the active 
+    stocks at sps, over each datespan, as a dictionary keyed by 
+    (product id, datespan index). Stocks without a consumption for a 
+    span are left out of its average.
+    
+    The transactions for every span are loaded in one query, and each 
+    stock's consumption over a span is calculated from the slice of 
+    them that falls inside it.
+    """
+    spans = [(_as_datetime(dm.startdate), _as_datetime(dm.enddate)) for dm in datespans]
+    stocks = set(ProductStock.objects.filter(supply_point__in=sps, product__in=products, 
+                                             is_active=True)\
+                 .values_list("supply_point", "product"))
+    transactions = defaultdict(list)
+    for row in StockTransaction.objects.filter(supply_point__in=sps, product__in=products, 
+                                               date__gte=min(start for start, _ in spans), 
+                                               date__lte=max(end for _, end in spans))\
+      .order_by("supply_point", "product", "date", "pk")\
+      .values_list("supply_point", "product", *TRANSACTION_FIELDS).iterator():
+        if row[:2] in stocks:
+            transactions[row[:2]].append(row[2:])
+    
+    consumption_settings = ConsumptionSettings.default()
+    cutoff_date = consumption_settings.cutoff_date
+    totals = defaultdict(float)
+    counts = defaultdict(int)
+    for supply_point_id, product_id in stocks:
+        rows = transactions.get((supply_point_id, product_id), [])
+        dates = [row[0] for row in rows]
+        for i, (start, end) in enumerate(spans):
+            calculator = ConsumptionCalculator(consumption_settings, cutoff_date)
+            # newest first, like daily_consumption
+            for row in reversed(rows[bisect_left(dates, start):bisect_right(dates, end)]):
+                calculator.add(*row)
+            try:
+                daily = calculator.daily_consumption
+            except ZeroDivisionError:
+                continue
+            if daily is not None:
+                totals[(product_id, i)] += daily * 30.0
+                counts[(product_id, i)] += 1
+    return dict((key, totals[key] / counts[key]) for key in counts)
+
 def amc_plot(sps, datespan, products=None):
     cols = {"date": ("datetime", "Date")}
     products = products or Product.objects.all().order_by('sms_code')
@@ -42,29 +102,27 @@ def amc_plot(sps, datespan, products=None):
             cols[p.sms_code] = ('number', p.sms_code)#, {'type': 'string', 'label': "title_"+s.sms_code}]
     table = gviz_api.DataTable(cols)
 
+    # each month is the average over the three months up to its end
+    months = list(datespan.months_iterator())
+    datespans = [DateSpan(startdate=datetime(year,month,1)-relativedelta(months=2), 
+                          enddate=get_day_of_month(year, month, -1)) for year, month in months]
+    sps_hash = _supply_points_hash(sps)
+    cache_keys = dict(((pr.pk, i), "log-amc-%s-%s-%s-%s" % (sps_hash, pr.sms_code, year, month)) \
+                      for pr in products for i, (year, month) in enumerate(months))
+    cached = cache.get_many(cache_keys.values())
+    missing = [pr for pr in products \
+               if any(cache_keys[(pr.pk, i)] not in cached for i in range(len(months)))]
+    if missing:
+        amcs = _average_monthly_consumptions(sps, missing, datespans)
+        computed = dict((cache_keys[(pr.pk, i)], amcs.get((pr.pk, i), 0)) \
+                        for pr in missing for i in range(len(months)))
+        cache.set_many(computed, (30 * 24 * 60 * 60) - 1)
+        cached.update(computed)
+    
     data_rows = {}
-    for year, month in datespan.months_iterator():
-        dm = DateSpan(startdate=datetime(year,month,1)-relativedelta(months=2), enddate=get_day_of_month(year, month, -1))
+    for i, (year, month) in enumerate(months):
         dt = datetime(year, month, 1)
-        if not dt in data_rows: data_rows[dt] = {}
-        for pr in products:
-            cache_key = "log-amc-%s-%s-%s" % (pr.sms_code, year, month)
-            cached_amc = cache.get(cache_key)
-            if cached_amc is not None:
-                data_rows[dt][pr.sms_code] = cached_amc
-            else:
-                ps = ProductStock.objects.filter(supply_point__in=sps, product=pr, is_active=True)
-                total = 0.0
-                count = 0.0
-                for p in ps:
-                    try:
-                        total += p.get_daily_consumption(datespan=dm) * 30.0
-                        count += 1
-                    except:
-                        continue
-                amc_avg = total / count if count else 0
-                cache.set(cache_key, amc_avg, (30 * 24 * 60 * 60) - 1)
-                data_rows[dt][pr.sms_code] = amc_avg
+        data_rows[dt] = dict((pr.sms_code, cached[cache_keys[(pr.pk, i)]]) for pr in products)
 
     rows = []
     for d in data_rows.keys():
@@ -0,0 +1,52 @@
+"""
+Holds back things that must only happen once a transaction has been
+committed, like queueing work for another process or bumping spot 
+cache generations, so that nobody acts on (or caches) the rows as they
+were before the commit.
+
+Anything passed to after_commit inside a function decorated with 
+queue_after_commit is held until the outermost such function has 
+returned, and dropped if it raises. Outside of one it happens straight
+away.
+"""
+import threading
+
+_local = threading.local()
+
+def holding():
+    """
+    Whether after_commit is currently holding things back.
+    """
+    return getattr(_local, "held", None) is not None
+
+def after_commit(f, *args):
+    """
+    Calls f with args once the changes made so far have been committed.
+    """
+    if holding():
+        _local.held.append((f, args))
+    else:
+        f(*args)
+
+def queue_after_commit(f):
+    """
+    Holds back everything passed to after_commit while f runs until it 
+    has returned, and drops it if f raises. Goes outside 
+    transaction.commit_on_success, so that it all happens after the commit.
+    """
+    def wrapper(*args, **kwargs):
+        if holding():
+            # the outermost one flushes everything
+            return f(*args, **kwargs)
+        _local.held = []
+        try:
+            result = f(*args, **kwargs)
+            held = _local.held
+        finally:
+            _local.held = None
+        for held_f, held_args in held:
+            held_f(*held_args)
+        return result
+    wrapper.__name__ = f.__name__
+    wrapper.__doc__ = f.__doc__
+    return wrapper
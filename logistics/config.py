@@ -49,19 +49,19 @@ def has_permissions_to(contact, operation):
     # one might want to use the responsibilities framework to manage
     # this but currently it seems strange that we'd have such tight
     # coupling between app logic and database logic, so it's here
-    from logistics.models import ContactRole
+    from logistics.registries import contact_roles
     if not contact.is_active:
         return False
     if operation == Operations.REPORT_STOCK:
-        return contact.role == ContactRole.objects.get(code=Roles.HSA)
+        return contact_roles.has_role(contact, Roles.HSA)
     if operation == Operations.FILL_ORDER:
-        return contact.role == ContactRole.objects.get(code=Roles.IN_CHARGE)
+        return contact_roles.has_role(contact, Roles.IN_CHARGE)
     if operation == Operations.MAKE_TRANSFER:
-        return contact.role == ContactRole.objects.get(code=Roles.HSA)
+        return contact_roles.has_role(contact, Roles.HSA)
     if operation == Operations.CONFIRM_TRANSFER:
-        return contact.role == ContactRole.objects.get(code=Roles.HSA)
+        return contact_roles.has_role(contact, Roles.HSA)
     if operation == Operations.REPORT_FOR_OTHERS:
-        return contact.role == ContactRole.objects.get(code=Roles.IN_CHARGE)
+        return contact_roles.has_role(contact, Roles.IN_CHARGE)
     # TODO, fill this in more
     return True
 
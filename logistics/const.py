@@ -2,6 +2,9 @@
 Constants go here
 '''
 
+# how long (in seconds) a repeated receipt overrides the max stock levels for
+MAX_STOCK_OVERRIDE_WINDOW = 60 * 60 * 4
+
 
 class Reports(object):
     """
@@ -1,4 +1,8 @@
+import math
+import uuid
 from datetime import datetime, timedelta
+from django.db import connection, transaction
+from django.db.models import Q, Count, Max
 from rapidsms.conf import settings
 from logistics.const import Reports
 from dimagi.utils.dates import delta_secs
@@ -24,11 +28,30 @@ class ConsumptionSettings(object):
     def default(cls):
         return ConsumptionSettings(settings.LOGISTICS_CONSUMPTION)
 
-def daily_consumption(supply_point, product, datespan=None, 
-                      consumption_settings=None):
+def _scaling_factor(cutoff_date, start_date, end_date):
+    """
+    How much of a period counts, given the cutoff date: all of it if it
+    starts after the cutoff, otherwise the fraction after the cutoff.
     """
-    Calculate daily consumption through the following algorithm:
+    if cutoff_date < start_date:
+        return 1
+    return max(0, delta_secs(end_date - cutoff_date) / delta_secs(end_date - start_date))
+
+def _daily_consumption(consumption_settings, transactions, total_time, total_consumption):
+    if transactions < consumption_settings.min_transactions:
+        return None
+    days = total_time.days
+    if days < consumption_settings.min_days:
+        return None
+    return round(abs((float(total_consumption) / delta_secs(total_time)) * 60*60*24),2)
 
+class ConsumptionCalculator(object):
+    """
+    The daily consumption algorithm as a state machine, which is fed one 
+    stock's transactions one at a time, newest first. This lets the 
+    same algorithm run over a single stock (daily_consumption) or over 
+    a stream of every stock's transactions (update_auto_consumptions).
+    
     Consider each non-stockout SOH report to be the start of a period.
     We iterate through the stock transactions following it until we reach another SOH.
     If it's a stockout, we drop the period from the calculation.
@@ -41,62 +64,347 @@ def daily_consumption(supply_point, product, datespan=None,
 
     This algorithm effectively deals with cases where a SOH report immediately follows a receipt.
     """
-    from logistics.models import StockTransaction
-    consumption_settings = consumption_settings or ConsumptionSettings.default()
     
-    total_time = timedelta(0)
-    total_consumption = 0
-    
-    txs = StockTransaction.objects.filter\
-        (supply_point=supply_point,product=product).order_by('-date')
+    def __init__(self, consumption_settings=None, cutoff_date=None):
+        self.settings = consumption_settings or ConsumptionSettings.default()
+        self.cutoff_date = cutoff_date or self.settings.cutoff_date
+        self.transactions = 0
+        self.total_time = timedelta(0)
+        self.total_consumption = 0
+        self.period_receipts = 0
+        # the (date, ending balance) of the SOH report ending the current period
+        self.end_transaction = None
+        self.done = False
     
-    if datespan:
-        txs = txs.filter(date__gte=datespan.startdate,
-                         date__lte=datespan.enddate)
-    if txs.count() < consumption_settings.min_transactions:
-        return None
-    period_receipts = 0
-    end_transaction = None
-    for t in txs:
-        # Go through each StockTransaction in turn (backwards!).
-        if t.ending_balance == 0 and not consumption_settings.include_end_stockouts:
+    def add(self, date, ending_balance, quantity, report_type_code):
+        """
+        Adds the next (i.e. next oldest) transaction.
+        """
+        self.transactions += 1
+        if self.done:
+            # still counted towards the minimum number of transactions
+            return
+        if ending_balance == 0 and not self.settings.include_end_stockouts:
             # Previous period ended in stockout -- pass on this period
-            end_transaction = None
-            period_receipts = 0
-            continue
-        if t.product_report.report_type.code == Reports.SOH:
-            if end_transaction:
+            self.end_transaction = None
+            self.period_receipts = 0
+            return
+        if report_type_code == Reports.SOH:
+            if self.end_transaction:
+                end_date, end_balance = self.end_transaction
                 # End of a period.
-                if t.ending_balance + period_receipts >= end_transaction.ending_balance:
+                if ending_balance + self.period_receipts >= end_balance:
                     # if this check fails it's an anomalous data point 
                     # (finished with higher stock than possible)
                     
                     # Add the period stats to the running count.
                     # But first scale them if they fall within the cutoff window
-                    period_time = (end_transaction.date - t.date)
-                    period_consumption = t.ending_balance + period_receipts - end_transaction.ending_balance
+                    period_time = (end_date - date)
+                    period_consumption = ending_balance + self.period_receipts - end_balance
                     
-                    scaling_factor = 1 if consumption_settings.cutoff_date < t.date \
-                        else max(0, delta_secs(end_transaction.date - consumption_settings.cutoff_date) \
-                                    / delta_secs(period_time))
+                    scaling_factor = _scaling_factor(self.cutoff_date, date, end_date)
                     
-                    total_time += timedelta(seconds=scaling_factor * delta_secs(period_time))
-                    total_consumption += scaling_factor * period_consumption
+                    self.total_time += timedelta(seconds=scaling_factor * delta_secs(period_time))
+                    self.total_consumption += scaling_factor * period_consumption
                     
-            if t.date < consumption_settings.cutoff_date:
-                break
+            if date < self.cutoff_date:
+                self.done = True
             else:
                 # Start a new period.
-                end_transaction = t
-                period_receipts = 0
+                self.end_transaction = (date, ending_balance)
+                self.period_receipts = 0
             
-        elif t.product_report.report_type.code == Reports.REC:
+        elif report_type_code == Reports.REC:
             # Receipt.
-            if end_transaction:
+            if self.end_transaction:
                 # Mid-period receipt, so we care about it.
-                period_receipts += t.quantity
-    days = total_time.days
-    if days < consumption_settings.min_days:
-        return None
-    return round(abs((float(total_consumption) / delta_secs(total_time)) * 60*60*24),2)
+                self.period_receipts += quantity
+    
+    @property
+    def daily_consumption(self):
+        return _daily_consumption(self.settings, self.transactions, 
+                                  self.total_time, self.total_consumption)
+
+# what the calculator needs from each transaction, newest first
+TRANSACTION_FIELDS = ("date", "ending_balance", "quantity", "report_type_code")
+TRANSACTION_ORDER = ("-date", "-pk")
+
+def daily_consumption(supply_point, product, datespan=None, 
+                      consumption_settings=None):
+    """
+    Calculate daily consumption for a single stock. See 
+    ConsumptionCalculator for the algorithm.
+    """
+    from logistics.models import StockTransaction
+    txs = StockTransaction.objects.filter\
+        (supply_point=supply_point,product=product).order_by(*TRANSACTION_ORDER)
+    
+    if datespan:
+        txs = txs.filter(date__gte=datespan.startdate,
+                         date__lte=datespan.enddate)
+    calculator = ConsumptionCalculator(consumption_settings)
+    for values in txs.values_list(*TRANSACTION_FIELDS):
+        calculator.add(*values)
+    return calculator.daily_consumption
+
+class ConsumptionAccumulator(object):
+    """
+    The same algorithm as ConsumptionCalculator, run forwards (oldest 
+    transaction first), with its running totals and the currently open 
+    period kept in the consumption_* fields of a ProductStock. Each new
+    transaction can then be added without rereading the stock's history.
+    
+    update() adds whatever transactions have come in since the last 
+    one that was added (by id). Every transaction up to that id has been
+    counted, so if the count of them changes, one with a lower id was 
+    committed late (or one was deleted) and the totals are recomputed.
+    With LOOKBACK_DAYS, the first period that was 
+    counted is kept unscaled as well (consumption_since to 
+    consumption_first_end, along with the cutoff it was scaled with), so
+    that it can be rescaled to the current cutoff as the window moves.
+    The totals have to be recomputed instead when a transaction arrives 
+    out of order, or once the cutoff has passed the end of the first 
+    counted period, which then drops out and leaves the next one to be 
+    rescaled. That recompute only reads the transactions inside the 
+    lookback window.
+    
+    The fields don't record the settings they were computed with, so 
+    after changing INCLUDE_END_STOCKOUTS run update_auto_consumption, 
+    which marks them all for recomputing.
+    """
+    
+    def __init__(self, stock, consumption_settings=None, cutoff_date=None):
+        self.stock = stock
+        self.settings = consumption_settings or ConsumptionSettings.default()
+        self.cutoff_date = cutoff_date or self.settings.cutoff_date
+    
+    def can_add(self, date):
+        """
+        Whether a new transaction on date can be added to the totals, 
+        rather than recomputing them.
+        """
+        stock = self.stock
+        if stock.consumption_last_date is None or date < stock.consumption_last_date:
+            return False
+        if self.settings.lookback_days and stock.consumption_since is not None and \
+          (stock.consumption_first_end is None or stock.consumption_first_end <= self.cutoff_date):
+            # the first counted period has dropped out of the window
+            return False
+        return True
+    
+    def reset(self):
+        stock = self.stock
+        stock.consumption_transactions = 0
+        stock.consumption_period_start = None
+        stock.consumption_period_balance = None
+        stock.consumption_period_receipts = 0
+        stock.consumption_total = 0
+        stock.consumption_seconds = 0
+        stock.consumption_since = None
+        stock.consumption_first_end = None
+        stock.consumption_first_amount = None
+        stock.consumption_window_start = None
+        stock.consumption_last_date = None
+        stock.consumption_last_id = None
+    
+    def add(self, date, ending_balance, quantity, report_type_code):
+        """
+        Adds the next (i.e. newest) transaction.
+        """
+        stock = self.stock
+        stock.consumption_transactions += 1
+        stock.consumption_last_date = date
+        if ending_balance == 0 and not self.settings.include_end_stockouts:
+            # the open period ended in stockout -- pass on it
+            stock.consumption_period_start = None
+            stock.consumption_period_balance = None
+            stock.consumption_period_receipts = 0
+            return
+        if report_type_code == Reports.SOH:
+            start_date = stock.consumption_period_start
+            if start_date is not None and \
+              stock.consumption_period_balance + stock.consumption_period_receipts >= ending_balance:
+                # close the open period, unless it's anomalous
+                scaling_factor = _scaling_factor(self.cutoff_date, start_date, date)
+                amount = stock.consumption_period_balance + stock.consumption_period_receipts - \
+                    ending_balance
+                # added up as timedeltas, like ConsumptionCalculator does
+                total_time = timedelta(seconds=stock.consumption_seconds) + \
+                    timedelta(seconds=scaling_factor * delta_secs(date - start_date))
+                stock.consumption_seconds = delta_secs(total_time)
+                stock.consumption_total += scaling_factor * amount
+                if stock.consumption_since is None:
+                    stock.consumption_since = start_date
+                    stock.consumption_first_end = date
+                    stock.consumption_first_amount = amount
+                    if self.settings.lookback_days:
+                        stock.consumption_window_start = self.cutoff_date
+            # start a new period
+            stock.consumption_period_start = date
+            stock.consumption_period_balance = ending_balance
+            stock.consumption_period_receipts = 0
+        elif report_type_code == Reports.REC:
+            if stock.consumption_period_start is not None:
+                # mid-period receipt, so we care about it
+                stock.consumption_period_receipts += quantity
+    
+    def _transactions(self):
+        from logistics.models import StockTransaction
+        return StockTransaction.objects.filter(supply_point=self.stock.supply_point_id, 
+                                               product=self.stock.product_id)
+    
+    def _add_all(self, txs):
+        stock = self.stock
+        for values in txs.order_by("date", "pk").values_list("pk", *TRANSACTION_FIELDS):
+            self.add(*values[1:])
+            stock.consumption_last_id = max(stock.consumption_last_id, values[0])
+    
+    def update(self):
+        """
+        Brings the totals up to date with the stock's transactions, 
+        only reading the new ones if possible.
+        """
+        stock = self.stock
+        if stock.consumption_last_date is None or stock.consumption_last_id is None:
+            return self.recompute()
+        if self._transactions().filter(pk__lte=stock.consumption_last_id).count() != \
+          stock.consumption_transactions:
+            # ids are handed out before commit, so a transaction with a 
+            # lower id than the last one added can commit after it
+            return self.recompute()
+        txs = self._transactions().filter(pk__gt=stock.consumption_last_id)
+        first = txs.order_by("date", "pk").values_list("date", flat=True)[:1]
+        if first and not self.can_add(first[0]):
+            return self.recompute()
+        self._add_all(txs)
+    
+    def recompute(self):
+        """
+        Recomputes the totals from the stock's transactions.
+        """
+        self.reset()
+        txs = self._transactions()
+        if self.settings.lookback_days:
+            # nothing before the last SOH report that could start a period
+            # before the cutoff counts, apart from towards the number of 
+            # transactions
+            starts = txs.filter(date__lt=self.cutoff_date, report_type_code=Reports.SOH)
+            if not self.settings.include_end_stockouts:
+                starts = starts.exclude(ending_balance=0)
+            start = starts.order_by(*TRANSACTION_ORDER).values_list("date", "pk")[:1]
+            if start:
+                date, pk = start[0]
+                earlier = txs.filter(Q(date__lt=date) | Q(date=date, pk__lt=pk))\
+                    .aggregate(count=Count("pk"), last_id=Max("pk"))
+                self.stock.consumption_transactions = earlier["count"]
+                self.stock.consumption_last_id = earlier["last_id"]
+                txs = txs.filter(Q(date__gt=date) | Q(date=date, pk__gte=pk))
+        self._add_all(txs)
+    
+    @property
+    def daily_consumption(self):
+        stock = self.stock
+        seconds = stock.consumption_seconds
+        total = stock.consumption_total
+        if self.settings.lookback_days and stock.consumption_first_end is not None:
+            # rescale the first counted period from the cutoff it was 
+            # added with to the current one
+            start, end = stock.consumption_since, stock.consumption_first_end
+            change = _scaling_factor(self.cutoff_date, start, end) - \
+                _scaling_factor(stock.consumption_window_start or datetime.min, start, end)
+            if change:
+                seconds = delta_secs(timedelta(seconds=seconds) + \
+                                     timedelta(seconds=change * delta_secs(end - start)))
+                total += change * stock.consumption_first_amount
+        return _daily_consumption(self.settings, stock.consumption_transactions, 
+                                  timedelta(seconds=seconds), total)
 
+def auto_monthly_consumption(daily):
+    """
+    The auto_monthly_consumption for a daily consumption, or None 
+    if there isn't one.
+    """
+    if daily:
+        # if AMC is a fraction, we should always round up
+        # (always better to underestimate months remaining than over)
+        return int(math.ceil(daily * 30))
+    return None
+
+def _stream(queryset, chunk_size=2000):
+    """
+    Yields the rows of a values_list queryset. On postgres they are read
+    through a server-side cursor, so they aren't all held in memory.
+    """
+    engine = connection.settings_dict["ENGINE"]
+    if "postgresql" not in engine and "postgis" not in engine:
+        for row in queryset.iterator():
+            yield row
+        return
+    sql, params = queryset.query.get_compiler(connection=connection).as_sql()
+    connection.cursor() # makes sure we're connected
+    cursor = connection.connection.cursor(name="logistics_stream_%s" % uuid.uuid4().hex)
+    try:
+        cursor.execute(sql, params)
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            for row in rows:
+                yield row
+    finally:
+        cursor.close()
+
+def update_auto_consumptions(consumption_settings=None):
+    """
+    Recalculates auto_monthly_consumption for every ProductStock in a
+    single pass over all the transactions, giving the same results as 
+    calling update_auto_consumption() on each. Returns the number of 
+    stocks that changed. Should be run inside a transaction.
+    """
+    from logistics.models import StockTransaction, ProductStock
+    consumption_settings = consumption_settings or ConsumptionSettings.default()
+    cutoff_date = consumption_settings.cutoff_date
+    stocks = dict(((supply_point_id, product_id), (pk, amc)) for pk, supply_point_id, product_id, amc in \
+                  ProductStock.objects.values_list("pk", "supply_point", "product", 
+                                                   "auto_monthly_consumption").iterator())
+    
+    updates = []
+    def _finish(key, calculator):
+        if key in stocks:
+            pk, current = stocks[key]
+            amc = auto_monthly_consumption(calculator.daily_consumption)
+            if amc is not None and amc != current:
+                updates.append((amc, pk))
+    
+    key = None
+    calculator = None
+    for row in _stream(StockTransaction.objects.order_by("supply_point", "product", *TRANSACTION_ORDER)\
+                           .values_list("supply_point", "product", *TRANSACTION_FIELDS)):
+        if key != row[:2]:
+            if calculator is not None:
+                _finish(key, calculator)
+            key = row[:2]
+            calculator = ConsumptionCalculator(consumption_settings, cutoff_date)
+        calculator.add(*row[2:])
+    if calculator is not None:
+        _finish(key, calculator)
+    
+    # the accumulators may have been computed with other settings
+    ProductStock.objects.exclude(consumption_last_date=None).update(consumption_last_date=None)
+    if updates:
+        qn = connection.ops.quote_name
+        cursor = connection.cursor()
+        cursor.executemany("UPDATE %s SET %s = %%s WHERE %s = %%s" % \
+                           (qn(ProductStock._meta.db_table), 
+                            qn(ProductStock._meta.get_field("auto_monthly_consumption").column),
+                            qn(ProductStock._meta.pk.column)), updates)
+        transaction.set_dirty()
+        # the bulk update skips ProductStock's post_save signals, 
+        # so catch up on what they would have done
+        if settings.LOGISTICS_STOCK_COUNTS_BY == settings.STOCK_COUNTS_BY_STATUS_TABLE:
+            from logistics.aggregation import refresh_stock_statuses
+            refresh_stock_statuses(ProductStock.objects.filter(pk__in=[pk for _, pk in updates])\
+                .select_related("supply_point", "supply_point__type", "product"))
+        from logistics.spot_cache import GLOBAL_GENERATION_KEY, bump_generations
+        bump_generations([GLOBAL_GENERATION_KEY])
+    return len(updates)
@@ -104,6 +104,18 @@ class Location(models.Model, StockCacheMixin):
         locations = self.get_descendants()
         return SupplyPoint.objects.filter(location__in=locations, active=True).order_by('name')
         
+    def balances_as_of(self, cutoff, products=None):
+        """
+        The latest stock balance on or before cutoff for every stock at 
+        every facility in this location (and below), in one query. 
+        See logistics.balances.balances_as_of
+        """
+        from logistics.balances import balances_as_of
+        return balances_as_of(self.all_facilities(), cutoff, products)
+    
+    def _generation_key(self):
+        return ("gen-LOC-%s" % self.code).replace(" ", "-")
+        
     def _cache_key(self, key, product, producttype, datetime=None):
         return ("LOC-%(location)s-%(key)s-%(product)s-%(producttype)s-%(datetime)s" % \
                 {"key": key, "location": self.code, "product": product, 
@@ -111,10 +123,11 @@ class Location(models.Model, StockCacheMixin):
     
     def _get_stock_count(self, operation, product, producttype, datespan=None):
         """ 
-        pulls requested value from cache. refresh cache if necessary
+        pulls requested value from cache. refresh cache if necessary, 
+        along with the values for every location and facility below this one
         """
-        return self._get_stock_count_for_facilities(self.all_facilities(), operation, 
-                                                    product, producttype, datespan)
+        from logistics.aggregation import rolled_up_stock_count
+        return rolled_up_stock_count(self, operation, product, producttype, datespan)
     
     """ The following methods express AGGREGATE counts, of all subsumed facilities"""
     def stockout_count(self, product=None, producttype=None, datespan=None):
@@ -37,13 +37,14 @@ class Contact(models.Model):
         if self.message_set.count() > 0:
             return self.message_set.order_by("-date")[0]
         
+    @property
+    def role_code(self):
+        from logistics.registries import contact_roles
+        return contact_roles.code(self.role_id)
+        
     def has_responsibility(self, code):
-        if not self.role:
-            return False
-        responsibilities = self.role.responsibilities.values_list('code', flat=True)
-        if code in responsibilities:
-            return True
-        return False
+        from logistics.registries import contact_roles
+        return code in contact_roles.responsibilities(self.role_id)
     
     def commodities_reported(self):
         from logistics.models import Product
@@ -7,13 +7,13 @@ from logistics.exceptions import TooMuchStockError
 from logistics.validators import check_max_levels, get_max_level_function
 from rapidsms.contrib.handlers.handlers.keyword import KeywordHandler
 from rapidsms.contrib.handlers.handlers.tagging import TaggingHandler
-from logistics.models import ProductReportsHelper, StockRequest, StockTransfer, ProductReport
+from logistics.models import ProductReportsHelper, StockRequest, StockTransfer, ProductReport, \
+    MessageFingerprint
 from logistics.decorators import logistics_contact_and_permission_required
-from logistics.const import Reports
+from logistics.const import Reports, MAX_STOCK_OVERRIDE_WINDOW
 from logistics.util import config, ussd_msg_response
 from logistics.handlers import logistics_keyword
 from rapidsms.conf import settings
-from rapidsms.contrib.messagelog.models import Message
 
 
 class ReceiptHandler(KeywordHandler, TaggingHandler):
@@ -28,13 +28,17 @@ class ReceiptHandler(KeywordHandler, TaggingHandler):
 
     @logistics_contact_and_permission_required(config.Operations.REPORT_RECEIPT)
     def handle(self, text):
-        dupes = Message.objects.filter(direction="I",
-                                       connection=self.msg.connection,
-                                       text__iexact=self.msg.raw_text).exclude(pk=self.msg.logger_msg.pk)
+        # repeats of this message are looked up by fingerprint, which
+        # is recorded before anything else so later repeats can find it
+        dupes = MessageFingerprint.recent(self.msg.connection, self.msg.raw_text, 
+                                          MessageFingerprint.ttl())
+        dupe_messages = list(dupes.values_list("message", "date"))
+        MessageFingerprint.record(self.msg.connection, self.msg.raw_text, self.msg.logger_msg)
         if settings.LOGISTICS_IGNORE_DUPE_RECEIPTS_WITHIN:
             dupe_ignore_threshold = datetime.utcnow() - timedelta(seconds=settings.LOGISTICS_IGNORE_DUPE_RECEIPTS_WITHIN)
-            ignore = dupes.filter(date__gte=dupe_ignore_threshold)
-            if ignore.count() and ProductReport.objects.filter(message__in=dupes).count():
+            ignore = [message for message, date in dupe_messages \
+                      if date >= dupe_ignore_threshold and message is not None]
+            if ignore and ProductReport.objects.filter(message__in=ignore).exists():
                 return True
 
         # at the end of your receipt message you can write:
@@ -61,9 +65,9 @@ class ReceiptHandler(KeywordHandler, TaggingHandler):
             except TooMuchStockError, e:
                 # bit of a hack, also check if there was a recent message
                 # that matched this and if so force it through
-                override_threshold = datetime.utcnow() - timedelta(seconds=60*60*4)
-                override = dupes.filter(date__gte=override_threshold)
-                if override.count() == 0:
+                override_threshold = datetime.utcnow() - timedelta(seconds=MAX_STOCK_OVERRIDE_WINDOW)
+                override = [message for message, date in dupe_messages if date >= override_threshold]
+                if not override:
                     self.respond(config.Messages.TOO_MUCH_STOCK % {
                         'keyword': self.msg.text.split()[0],
                         'req': e.amount,
@@ -20,7 +20,7 @@ class Stop(KeywordHandler):
         if self.msg.contact is None:
             self.respond(config.Messages.REGISTER_MESSAGE)
             return
-        if config.Responsibilities.REPORTEE_RESPONSIBILITY in self.msg.contact.role.responsibilities.values_list('code', flat=True):
+        if self.msg.contact.has_responsibility(config.Responsibilities.REPORTEE_RESPONSIBILITY):
             # if a super, show last report from your facility
             reports = ProductReport.objects.filter(facility=self.msg.contact.facility)
             if not reports:
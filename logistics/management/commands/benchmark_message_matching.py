@@ -0,0 +1,37 @@
+import random
+import time
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from logistics.models import Product
+from logistics.template_app import App
+
+class FakeMessage(object):
+    def __init__(self, text):
+        self.text = text
+
+class Command(BaseCommand):
+    help = ("Measures how many messages per second the stock report app "
+            "can decide whether to handle.")
+    option_list = BaseCommand.option_list + (
+        make_option("--messages", type="int", dest="messages", default=100000,
+                    help="The number of messages to test."),
+    )
+    
+    def handle(self, *args, **options):
+        codes = list(Product.objects.values_list("sms_code", flat=True)) or ["zz"]
+        # a mix of stock reports and other messages
+        texts = ["%s 10 %s 20" % (random.choice(codes), random.choice(codes)) for i in range(50)] + \
+                ["soh %s 10" % random.choice(codes) for i in range(10)] + \
+                ["register john doe 123", "help", "hello there", "stop", "yes"] * 8
+        messages = [FakeMessage(random.choice(texts)) for i in range(options["messages"])]
+        app = App(None)
+        app._should_handle(messages[0]) # warm up
+        
+        start = time.time()
+        handled = 0
+        for message in messages:
+            if app._should_handle(message):
+                handled += 1
+        elapsed = max(time.time() - start, 0.001)
+        print "%s messages (%s handled) in %.2fs: %.0f messages/s" % \
+            (len(messages), handled, elapsed, len(messages) / elapsed)
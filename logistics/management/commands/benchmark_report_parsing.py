@@ -0,0 +1,70 @@
+import time
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from logistics.models import ProductReportsHelper
+from logistics.util import parse_report
+
+def _legacy_clean_string(string, separator=ProductReportsHelper.REC_SEPARATOR):
+    # the cleanup ProductReportsHelper.parse used before the single pass lexer
+    mylist = list(string)
+    newstring = string[0]
+    i = 1
+    while i < len(mylist)-1:
+        if mylist[i] == ' ' and mylist[i-1].isdigit() and mylist[i+1].isdigit():
+            newstring = newstring + separator
+        else:
+            newstring = newstring + mylist[i]
+        i = i + 1
+    newstring = newstring + string[-1]
+    string = newstring.replace(' ','')
+    for mark in [',', '/', ';', '*', '+', '-']:
+        string = string.replace(mark, separator)
+    for mark in ['\'', '\"', '`', '(', ')']:
+        string = string.replace(mark, '')
+    return string.lower()
+
+def _legacy_tokens(string):
+    # the tokenizer ProductReportsHelper.parse used before the single pass lexer
+    mylist = list(string)
+    token = ''
+    i = 0
+    while i<len(mylist):
+        token = token + mylist[i]
+        if i+1 == len(mylist):
+            yield token
+        elif mylist[i].isdigit() and not mylist[i+1].isdigit() or \
+          mylist[i].isalpha() and not mylist[i+1].isalpha() or \
+          not mylist[i].isalnum() and mylist[i+1].isalnum():
+            yield token
+            token = ''
+        i = i+1
+
+class Command(BaseCommand):
+    help = ("Measures how many reports per second can be tokenized by the "
+            "lexer used by ProductReportsHelper.parse, the two pass cleanup it "
+            "replaced, and util.parse_report.")
+    option_list = BaseCommand.option_list + (
+        make_option("--repeat", type="int", dest="repeat", default=5000,
+                    help="How many times to go through the sample reports."),
+        make_option("--length", type="int", dest="length", default=10,
+                    help="How many times to repeat each report within a message, "
+                         "to see how each copes with long messages."),
+    )
+    
+    def handle(self, *args, **options):
+        helper = ProductReportsHelper(object(), None)
+        samples = ["ov 10 ml 20", "ov10-2 ml20-3", "OV 10 2, ML 20", "soh ov 10 ml 20",
+                   "ov 1O ml 2O", "(ov) 10; ml: 20 * co 5", "zi 10 0 3 la 12-4"]
+        texts = [" ".join([text] * options["length"]) for text in samples]
+        for text in texts:
+            assert list(helper._lex(text)) == list(_legacy_tokens(_legacy_clean_string(text)))
+        for name, tokenize in (("lexer", lambda text: list(helper._lex(text))),
+                               ("legacy", lambda text: list(_legacy_tokens(_legacy_clean_string(text)))),
+                               ("parse_report", parse_report)):
+            start = time.time()
+            for i in range(options["repeat"]):
+                for text in texts:
+                    tokenize(text)
+            elapsed = max(time.time() - start, 0.001)
+            count = options["repeat"] * len(texts)
+            print "%-12s %s reports in %.2fs: %.0f reports/s" % (name, count, elapsed, count / elapsed)
@@ -0,0 +1,62 @@
+import time
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from logistics.models import ProductStock, SupplyPointType
+
+# what classifying a stock for the stock counts and dashboards calls
+PREDICATES = ("is_stocked_out", "is_below_emergency_level",
+              "is_below_low_supply_but_above_emergency_level", "is_below_low_supply",
+              "is_above_low_supply", "is_in_good_supply", "is_other",
+              "is_in_adequate_supply", "is_overstocked")
+
+def _classify(stock, resolve_each_time):
+    for name in PREDICATES:
+        if resolve_each_time:
+            # what every predicate did before the levels were kept
+            stock._levels = None
+        getattr(stock, name)()
+    if resolve_each_time:
+        stock._levels = None
+    stock.reorder_amount
+    if resolve_each_time:
+        stock._levels = None
+    stock.months_remaining
+
+class Command(BaseCommand):
+    help = ("Measures how many consumption lookups and how long it takes to "
+            "classify each ProductStock, resolving its levels once per stock "
+            "and (for comparison) once per predicate.")
+    option_list = BaseCommand.option_list + (
+        make_option("--stocks", type="int", dest="stocks", default=1000,
+                    help="The most stocks to classify."),
+    )
+
+    def handle(self, *args, **options):
+        stocks = list(ProductStock.objects.exclude(quantity=None)\
+                      .select_related("supply_point", "supply_point__type", "product")\
+                      [:options["stocks"]])
+        if not stocks:
+            print "no stocks with a quantity to classify"
+            return
+
+        lookups = []
+        original = SupplyPointType.__dict__["monthly_consumption_by_product"]
+        def _counting_lookup(sptype, product):
+            lookups.append(1)
+            return original(sptype, product)
+        SupplyPointType.monthly_consumption_by_product = _counting_lookup
+        try:
+            for label, resolve_each_time in (("once per predicate", True),
+                                             ("once per stock", False)):
+                for stock in stocks:
+                    stock._levels = None
+                del lookups[:]
+                start = time.time()
+                for stock in stocks:
+                    _classify(stock, resolve_each_time)
+                elapsed = max(time.time() - start, 0.001)
+                print "resolving levels %s: %s stocks in %.2fs (%.0f stocks/s), %.1f lookups per stock" % \
+                    (label, len(stocks), elapsed, len(stocks) / elapsed,
+                     float(len(lookups)) / len(stocks))
+        finally:
+            SupplyPointType.monthly_consumption_by_product = original
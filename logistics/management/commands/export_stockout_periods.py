@@ -20,8 +20,8 @@ class Command(LabelCommand):
                 print 'negative balance!! %s, %s' % (trans.pk, trans)
             return trans.ending_balance == 0
         def _is_match(start_trans, end_trans):
-            return (start_trans.supply_point == end_trans.supply_point and
-                    start_trans.product == end_trans.product)
+            return (start_trans.supply_point_id == end_trans.supply_point_id and
+                    start_trans.product_id == end_trans.product_id)
 
         def _get_row(start, end):
             def _ignore(supply_point):
@@ -73,7 +73,8 @@ class Command(LabelCommand):
         out = csv.writer(f)
         out.writerow(['Product', 'District', 'Facility', 'HSA', 'HSA Code', 'Start Date', 'End Date',
                       'Ongoing', 'Duration (days)', 'Duration (seconds)'])
-        transactions = StockTransaction.objects.order_by('product', 'supply_point', 'date')
+        transactions = StockTransaction.objects.select_related('supply_point', 'product')\
+            .order_by('product', 'supply_point', 'date').iterator()
         count = StockTransaction.objects.count()
         period_start = None
 
@@ -1,34 +1,147 @@
+import time
+from datetime import datetime
+from itertools import imap
+from multiprocessing import Pool
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Max, Min
 from logistics.models import SupplyPoint, StockTransaction, \
-    Product, HistoricalStockCache
-from datetime import datetime, timedelta
-from django.core.management.base import LabelCommand
+    HistoricalStockCache, HistoricalStockCacheRun
+from logistics.balances import BalanceIndex, write_historical_stock_cache, is_complete
 
-def _date_in_next_month(date):
-    return datetime(date.year, date.month, 1) + timedelta(days=32)
+# how many transactions before the last run's watermark are processed 
+# again. ids are handed out before commit, so a transaction can commit
+# (and be seen) after one with a higher id that the last run went up to.
+WATERMARK_OVERLAP = 1000
 
-class Command(LabelCommand):
-    help = "Populates the historical stock cache."
+def _months(start, end):
+    """
+    (year, month) pairs from start to end, inclusive
+    """
+    year, month = start
+    while (year, month) <= end:
+        yield year, month
+        year, month = _next_month((year, month))
+
+def _next_month(year_month):
+    year, month = year_month
+    return (year + 1, 1) if month == 12 else (year, month + 1)
+
+def _last_complete_month(date):
+    """
+    The (year, month) of the last month that had ended by date.
+    """
+    return (date.year - 1, 12) if date.month == 1 else (date.year, date.month - 1)
+
+@transaction.commit_on_success
+def populate_supply_point(supply_point_id, starts, end):
+    """
+    Recomputes the cached stock at a supply point for every month from
+    start to end. starts is a dictionary of the (year, month) to start 
+    from, by product id, or None for every product from its first 
+    transaction. Returns the number of rows written.
+    """
+    balances = BalanceIndex([supply_point_id], 
+                            products=starts.keys() if starts is not None else None)
+    if starts is None:
+        starts = dict((product_id, (date.year, date.month)) \
+                      for (_, product_id), date in balances.first_dates().items())
+    if not starts:
+        return 0
+    
+    existing = dict(((product_id, year, month), (pk, stock, is_complete(computed, year, month))) \
+                    for pk, product_id, year, month, stock, computed in HistoricalStockCache.objects\
+                        .filter(supply_point=supply_point_id, product__in=starts.keys())\
+                        .values_list("pk", "product", "year", "month", "stock", "computed"))
+    
+    inserts = []
+    updates = []
+    for product_id, start in starts.items():
+        for year, month in _months(start, end):
+            stock = balances.historical_stock(supply_point_id, product_id, year, month)
+            if (product_id, year, month) not in existing:
+                inserts.append((supply_point_id, product_id, year, month, stock))
+            else:
+                pk, cached_stock, complete = existing[(product_id, year, month)]
+                # rows cached before their month ended are rewritten even
+                # if they're right, so they're trusted from then on
+                if cached_stock != stock or not complete:
+                    updates.append((stock, pk))
+    
+    write_historical_stock_cache(inserts, updates)
+    transaction.set_dirty()
+    return len(inserts) + len(updates)
+
+def _populate(args):
+    # the entry point for worker processes
+    supply_point_id, starts, end = args
+    return populate_supply_point(supply_point_id, starts, end)
+
+class Command(BaseCommand):
+    help = ("Populates the historical stock cache, up to the last complete month "
+            "(the current month is still changing). By default, only the months "
+            "touched by transactions since the last run (and a few before it, in case "
+            "they committed late), and the months that have ended since then, are "
+            "computed.")
+    option_list = BaseCommand.option_list + (
+        make_option("--full", action="store_true", dest="full", default=False,
+                    help="Recompute everything, rather than only what's changed since the last run. "
+                         "Use this after editing or deleting existing transactions."),
+        make_option("--processes", type="int", dest="processes", default=1,
+                    help="The number of processes to split the supply points across."),
+    )
     
     def handle(self, *args, **options):
-        products = Product.objects.all()
-        for sp in SupplyPoint.objects.all():
-            print "generating stock for %s" % sp
-            for p in products:
-                transactions = StockTransaction.objects.filter(supply_point=sp,
-                                                             product=p)
-                if transactions.count():
-                    date = transactions.order_by("date")[0].date
-                    print "product %s, starting on %s" % (p, date)
-                    
-                    end = _date_in_next_month(datetime.utcnow())
-                    while date < end:
-                        cached = HistoricalStockCache.objects\
-                            .get_or_create(supply_point=sp, product=p, 
-                                           year=date.year, month=date.month,
-                                           stock=0)[0]
-                        stock = sp.historical_stock(p, date.year, date.month)
-                        if cached.stock != stock:
-                            cached.stock = stock
-                            cached.save()
-                        
-                        date = _date_in_next_month(date)
+        end = _last_complete_month(datetime.utcnow())
+        watermark = StockTransaction.objects.aggregate(Max("pk"))["pk__max"] or 0
+        last_runs = HistoricalStockCacheRun.objects.exclude(completed=None)\
+                        .order_by("-last_transaction_id")[:1]
+        full = options["full"] or not last_runs
+        run = HistoricalStockCacheRun.objects.create(last_transaction_id=watermark, 
+                                                     is_full=full)
+        if full:
+            print "recomputing all historical stock, up to transaction %s" % watermark
+            work = [(pk, None, end) for pk in SupplyPoint.objects.values_list("pk", flat=True)]
+        else:
+            since = max(last_runs[0].last_transaction_id - WATERMARK_OVERLAP, 0)
+            print "recomputing historical stock for transactions %s to %s" % (since, watermark)
+            starts = {}
+            # every stock needs the months that have ended since the last run
+            first_new_month = _next_month(_last_complete_month(last_runs[0].started))
+            if first_new_month <= end:
+                for supply_point_id, product_id in StockTransaction.objects.filter(pk__lte=since)\
+                  .values_list("supply_point", "product").distinct().order_by():
+                    starts.setdefault(supply_point_id, {})[product_id] = first_new_month
+            # and anything touched by new transactions needs recomputing
+            for row in StockTransaction.objects.filter(pk__gt=since, pk__lte=watermark)\
+              .values("supply_point", "product").annotate(first=Min("date")).order_by():
+                products = starts.setdefault(row["supply_point"], {})
+                first = (row["first"].year, row["first"].month)
+                products[row["product"]] = min(first, products.get(row["product"], first))
+            work = [(pk, products, end) for pk, products in starts.items()]
+        
+        pool = None
+        if options["processes"] > 1:
+            # workers can't share the connection, so each opens its own
+            connection.close()
+            pool = Pool(options["processes"])
+            results = pool.imap_unordered(_populate, work)
+        else:
+            results = imap(_populate, work)
+        
+        start = time.time()
+        rows = 0
+        for done, written in enumerate(results, 1):
+            rows += written
+            elapsed = max(time.time() - start, 0.001)
+            print "%s/%s supply points, %s rows written (%.1f supply points/s, %.1f rows/s)" % \
+                (done, len(work), rows, done / elapsed, rows / elapsed)
+        if pool is not None:
+            pool.close()
+            pool.join()
+        
+        run.rows_written = rows
+        run.completed = datetime.utcnow()
+        run.save()
+        print "done: %s rows written in %.1fs" % (rows, time.time() - start)
@@ -0,0 +1,15 @@
+from datetime import datetime
+from django.db import transaction
+from django.core.management.base import LabelCommand
+from logistics.aggregation import rebuild_stock_statuses
+
+class Command(LabelCommand):
+    help = ("Rebuilds the stock status table from the current product stocks. "
+            "Run this after switching LOGISTICS_STOCK_COUNTS_BY to the status table, "
+            "after changing stock level policies, or to repair the table.")
+    
+    @transaction.commit_on_success
+    def handle(self, *args, **options):
+        start = datetime.utcnow()
+        count = rebuild_stock_statuses()
+        print "rebuilt %s stock statuses in %s" % (count, datetime.utcnow() - start)
@@ -0,0 +1,16 @@
+from datetime import datetime
+from django.db import transaction
+from django.core.management.base import LabelCommand
+from logistics.commit_hooks import queue_after_commit
+from logistics.consumption import update_auto_consumptions
+
+class Command(LabelCommand):
+    help = ("Recalculates the automatic monthly consumption of every product stock "
+            "in a single pass over the stock transactions.")
+    
+    @queue_after_commit
+    @transaction.commit_on_success
+    def handle(self, *args, **options):
+        start = datetime.utcnow()
+        count = update_auto_consumptions()
+        print "updated the consumption of %s stocks in %s" % (count, datetime.utcnow() - start)
@@ -5,6 +5,7 @@ from django.core.cache import cache
 from django.template import Template
 from django.template.context import RequestContext
 from rapidsms.conf import settings
+from logistics.spot_cache import round_trips, reset_round_trips
 import urllib
 
 class CachedTemplateMiddleware(object):
@@ -25,3 +26,14 @@ class CachedTemplateMiddleware(object):
             response.content = t.render(RequestContext(request))
 
         return response
+
+class CacheRoundTripMiddleware(object):
+    """ Counts the round-trips each request makes to the cache (through 
+    logistics.spot_cache) and reports them in a response header, so that 
+    the effect of spot caching on a page can be measured."""
+    def process_request(self, request):
+        reset_round_trips()
+
+    def process_response(self, request, response):
+        response['X-Cache-Round-Trips'] = str(round_trips())
+        return response
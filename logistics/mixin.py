@@ -1,7 +1,11 @@
 from datetime import timedelta
 from rapidsms.conf import settings
-from django.core.cache import cache
+from logistics.spot_cache import GLOBAL_GENERATION_KEY, get_generations, \
+    set_fresh_many, get_or_compute
 from django.db.models import Sum
+from logistics.balances import apply_historical_balances
+from logistics.aggregation import STOCK_COUNTS_CACHE_KEY, stock_counts_from_db, \
+    stock_counts_from_status_table
 
 class StockCacheMixin():
     """
@@ -14,14 +18,44 @@ class StockCacheMixin():
     def _populate_stock_cache(self, facilities, product, producttype, datespan=None):
         """ 
         refreshes all the stock count values in the cache in bulk
-        returns None
+        returns a dictionary keyed by STOCK_COUNT_KEYS and 'consumption'
+        """
+        key = self._cache_key(STOCK_COUNTS_CACHE_KEY, product, producttype, datespan)
+        generations = get_generations(self._cache_generation_keys())
+        counts = self._compute_stock_counts(facilities, product, producttype, datespan)
+        set_fresh_many({key: counts}, {key: generations})
+        return counts
+
+    def _compute_stock_counts(self, facilities, product, producttype, datespan=None):
+        """ 
+        computes all the stock count values
+        returns a dictionary keyed by STOCK_COUNT_KEYS and 'consumption'
         """
         stocks = self._filtered_stock(product, producttype)\
                   .filter(supply_point__in=facilities)\
                   .select_related("supply_point", "supply_point__type", "product")
-        # TODO: when datespan is None, stockouts can be queried more efficiently 
-        # at the db level. 
-        #nonzero_stocks = all_stocks.filter(quantity__gt=0)
+        # historical quantities aren't available at the db level, 
+        # so only current-state counts are done in sql
+        is_current = not (datespan and not datespan.is_default)
+        if settings.LOGISTICS_STOCK_COUNTS_BY == settings.STOCK_COUNTS_BY_SQL and is_current:
+            counts = stock_counts_from_db(stocks)
+        elif settings.LOGISTICS_STOCK_COUNTS_BY == settings.STOCK_COUNTS_BY_STATUS_TABLE and is_current:
+            statuses = self._filtered_stock_status(product, producttype)\
+                        .filter(supply_point__in=facilities)
+            counts = stock_counts_from_status_table(statuses)
+        else:
+            counts = self._stock_counts_from_python(stocks, datespan)
+            # NB: we do not yet support historical consumption, 
+            # since that's its own giant bag of worms
+            counts["consumption"] = stocks.exclude(manual_monthly_consumption=None)\
+                .aggregate(consumption=Sum('manual_monthly_consumption'))['consumption']
+        return counts
+
+    def _stock_counts_from_python(self, stocks, datespan=None):
+        """
+        computes the stock count values by walking through every stock
+        returns a dictionary keyed by STOCK_COUNT_KEYS
+        """
         stockout_count = 0
         stocked_count = 0
         emergency_stock_count = 0
@@ -31,13 +65,10 @@ class StockCacheMixin():
         adequate_supply_count = 0
         overstocked_count = 0
         other_count = 0
+        if datespan and not datespan.is_default:
+            # one query for all the balances, rather than one per stock
+            stocks = apply_historical_balances(stocks, datespan.end_of_end_day - timedelta(days=1))
         for stock in stocks:
-            if datespan and not datespan.is_default:
-                historical_stock = stock.supply_point.historical_stock_by_date(stock.product, 
-                                                                               datespan.end_of_end_day - timedelta(days=1), 
-                                                                               default_value=None)
-                if historical_stock is not None:
-                    stock.quantity = historical_stock
             if stock.quantity == 0:
                 stockout_count = stockout_count + 1
             elif stock.quantity > 0:
@@ -56,50 +87,63 @@ class StockCacheMixin():
                 adequate_supply_count = adequate_supply_count + 1
             if stock.is_overstocked():
                 overstocked_count = overstocked_count + 1
-        cache.set(self._cache_key('stocked_count', product, producttype, datespan), 
-                  stocked_count, settings.LOGISTICS_SPOT_CACHE_TIMEOUT)       
-        cache.set(self._cache_key('other_count', product, producttype, datespan), 
-                  other_count, settings.LOGISTICS_SPOT_CACHE_TIMEOUT)       
-        cache.set(self._cache_key('stockout_count', product, producttype, datespan), 
-                  stockout_count, settings.LOGISTICS_SPOT_CACHE_TIMEOUT)
-        cache.set(self._cache_key('emergency_stock_count', product, producttype, datespan), 
-                  emergency_stock_count, settings.LOGISTICS_SPOT_CACHE_TIMEOUT)       
-        cache.set(self._cache_key('low_stock_count', product, producttype, datespan), 
-                  low_stock_count, settings.LOGISTICS_SPOT_CACHE_TIMEOUT)       
-        cache.set(self._cache_key('emergency_plus_low', product, producttype, datespan), 
-                  emergency_plus_low, settings.LOGISTICS_SPOT_CACHE_TIMEOUT)       
-        cache.set(self._cache_key('good_supply_count', product, producttype, datespan), 
-                  good_supply_count, settings.LOGISTICS_SPOT_CACHE_TIMEOUT)       
-        cache.set(self._cache_key('adequate_supply_count', product, producttype, datespan), 
-                  adequate_supply_count, settings.LOGISTICS_SPOT_CACHE_TIMEOUT)       
-        cache.set(self._cache_key('overstocked_count', product, producttype, datespan), 
-                  overstocked_count, settings.LOGISTICS_SPOT_CACHE_TIMEOUT)
-        consumption = stocks.exclude(manual_monthly_consumption=None).aggregate(consumption=Sum('manual_monthly_consumption'))['consumption']
-        # NB: we do not yet support historical consumption, 
-        # since that's its own giant bag of worms
-        cache.set(self._cache_key('consumption', product, producttype, datespan), 
-                  consumption, settings.LOGISTICS_SPOT_CACHE_TIMEOUT)
+        return {"stocked_count": stocked_count,
+                "other_count": other_count,
+                "stockout_count": stockout_count,
+                "emergency_stock_count": emergency_stock_count,
+                "low_stock_count": low_stock_count,
+                "emergency_plus_low": emergency_plus_low,
+                "good_supply_count": good_supply_count,
+                "adequate_supply_count": adequate_supply_count,
+                "overstocked_count": overstocked_count}
     
     def _get_stock_count_for_facilities(self, facilities, operation, product, producttype, datespan=None):
         """ 
         pulls requested stock value for a given set of facilities from the cache
-        refresh cache if necessary
+        refresh cache if necessary (cached values are refreshed whenever
+        the object's cache generation changes)
         returns integer
         """
         if settings.LOGISTICS_USE_SPOT_CACHING:
-            from_cache = cache.get(self._cache_key(operation, product, producttype, datespan))
-            if from_cache is not None:
-                return from_cache
-        # if LOGISTICS_USE_SPOT_CACHING is not enabled, we refresh the cache each time
-        self._populate_stock_cache(facilities, product, producttype, datespan)
-        return cache.get(self._cache_key(operation, product, producttype, datespan))
+            # all the counts are cached as one value, so they can 
+            # be set and read back in a single round-trip
+            counts = get_or_compute(self._cache_key(STOCK_COUNTS_CACHE_KEY, product, 
+                                                    producttype, datespan),
+                                    self._cache_generation_keys(),
+                                    lambda: self._compute_stock_counts(facilities, product, 
+                                                                       producttype, datespan))
+            return counts[operation]
+        return self._compute_stock_counts(facilities, product, producttype, datespan)[operation]
+
+    def _cache_generation_keys(self):
+        """ 
+        the generations the cached stock values depend on. classes using this
+        mixin must define _generation_key(), and bump it whenever their stock changes
+        """
+        return (GLOBAL_GENERATION_KEY, self._generation_key())
 
     def _filtered_stock(self, product, producttype):
         """ 
         returns a QuerySet of ProductStock filetered by product and product type
         """
         from logistics.models import ProductStock
-        results = ProductStock.objects.filter(is_active=True, product__is_active=True)
+        return self._filter_by_product(ProductStock.objects.filter(is_active=True, 
+                                                                   product__is_active=True),
+                                       product, producttype)
+
+    def _filtered_stock_status(self, product, producttype):
+        """ 
+        returns a QuerySet of StockStatus filetered by product and product type
+        """
+        from logistics.models import StockStatus
+        return self._filter_by_product(StockStatus.objects.filter(is_active=True, 
+                                                                  product__is_active=True),
+                                       product, producttype)
+
+    def _filter_by_product(self, results, product, producttype):
+        """ 
+        filters a QuerySet of anything with a product by product and product type
+        """
         if product is not None:
             results = results.filter(product__sms_code=product)
         elif producttype is not None:
@@ -3,32 +3,47 @@
 
 import re
 import uuid
+import hashlib
 import logging
-import math
 from datetime import datetime, date, timedelta
 from dateutil.relativedelta import relativedelta
 
 from django.contrib.auth.models import User
-from django.core.cache import cache
+from logistics.spot_cache import get_or_compute, bump_generations
+from logistics.commit_hooks import queue_after_commit
 from django.core.exceptions import ImproperlyConfigured
 from django.db import models, transaction
 from django.db.models import Q
-from django.db.models.signals import post_save
+from django.db.models.query import QuerySet
+from django.db.models.signals import post_init, post_save, post_delete, m2m_changed
 from django.db.models.fields import PositiveIntegerField
+from django.core.signals import request_started, request_finished
 from django.utils.translation import ugettext as _
 
 from rapidsms.conf import settings
 from rapidsms.models import Contact, ExtensibleModelBase
 from rapidsms.contrib.locations.models import Location
-from rapidsms.contrib.messaging.utils import send_message
 from dimagi.utils.dates import get_day_of_month
 from logistics.signals import post_save_product_report, create_user_profile,\
-    stockout_resolved, stockout_reported, post_save_stock_transaction
+    stockout_resolved, stockout_reported, post_save_stock_transaction, \
+    post_delete_stock_transaction, default_consumption_changed, \
+    default_consumption_stock_statuses, \
+    post_save_product_stock, post_delete_product_stock, post_save_product, \
+    invalidate_supply_point_spot_caches, invalidate_all_spot_caches, \
+    products_changed, product_equivalents_changed, contact_roles_changed, \
+    remember_tree_state, supply_point_moved, location_moved, post_save_supply_point, \
+    _refresh_stock_statuses
 from logistics.errors import *
-from logistics.const import Reports
+from logistics.const import Reports, MAX_STOCK_OVERRIDE_WINDOW
 from logistics.util import config, parse_report
 from logistics.mixin import StockCacheMixin
-from logistics.consumption import daily_consumption
+from logistics.balances import balances_as_of
+from logistics.stock_reports import ReportBatch, ReportContext
+from logistics.outbound import recipients, dispatch
+from logistics.registries import default_consumptions, product_codes, check_registries, \
+    end_registry_checks, location_tree
+from logistics.consumption import daily_consumption, auto_monthly_consumption, \
+    ConsumptionAccumulator
 
 if hasattr(settings, "MESSAGELOG_APP"):
     message_class = "%s.Message" % settings.MESSAGELOG_APP
@@ -81,6 +96,7 @@ class Product(models.Model):
     def by_code(cls, code):
         return cls.objects.get(sms_code=code)
     
+    @queue_after_commit
     @transaction.commit_on_success
     def deactivate(self):
         self.is_active = False
@@ -93,6 +109,7 @@ class Product(models.Model):
         for contact in contacts:
             contact.commodities.remove(self)
 
+    @queue_after_commit
     @transaction.commit_on_success
     def activate(self):
         """ 
@@ -138,10 +155,6 @@ class SupplyPointType(models.Model):
     def __unicode__(self):
         return self.name
     
-    def _cache_key(self, product_code):
-        return '%(sptype)s-%(product)s-default-monthly-consumption' % {'sptype': self.code, 
-                                                                       'product': product_code}
-        
     def policy(self):
         try:
             return config.SupplyPointPolicies.STOCK_POLICIES[self.code]
@@ -149,26 +162,7 @@ class SupplyPointType(models.Model):
             raise ImproperlyConfigured("Stock level policies are not configured correctly for this deployment.")
     
     def monthly_consumption_by_product(self, product):
-        # we need to supply a non-None cache value since the
-        # actual value to store here will often be 'None'
-        _NONE_VALUE = 'x'
-        cache_key = self._cache_key(product.code)
-        if settings.LOGISTICS_USE_SPOT_CACHING: 
-            from_cache = cache.get(cache_key)
-            if from_cache == _NONE_VALUE:
-                return None
-            elif from_cache is not None:
-                return from_cache
-        try:
-            dmc = DefaultMonthlyConsumption.objects.get(product=product, 
-                                                        supply_point_type=self).default_monthly_consumption
-        except DefaultMonthlyConsumption.DoesNotExist:
-            dmc = None
-        if dmc is None:
-            cache.set(cache_key, _NONE_VALUE, settings.LOGISTICS_SPOT_CACHE_TIMEOUT)
-        else:
-            cache.set(cache_key, dmc, settings.LOGISTICS_SPOT_CACHE_TIMEOUT)
-        return dmc 
+        return default_consumptions.get(self.code, product.pk)
     
     def monthly_consumption_by_product_code(self, code):
         product = Product.objects.get(code=code)
@@ -182,7 +176,23 @@ class DefaultMonthlyConsumption(models.Model):
     class Meta:
         unique_together = (("supply_point_type", "product"),)
 
-class ActiveSupplyPointManager(models.Manager):
+class SupplyPointQuerySet(QuerySet):
+    
+    def balances_as_of(self, cutoff, products=None):
+        """
+        The latest stock balance on or before cutoff for every stock at 
+        these supply points, in one query. See logistics.balances.balances_as_of
+        """
+        return balances_as_of(self, cutoff, products)
+
+class SupplyPointManager(models.Manager):
+    def get_query_set(self):
+        return SupplyPointQuerySet(self.model, using=self._db)
+    
+    def balances_as_of(self, cutoff, products=None):
+        return self.get_query_set().balances_as_of(cutoff, products)
+
+class ActiveSupplyPointManager(SupplyPointManager):
     def get_query_set(self):
         return super(ActiveSupplyPointManager, self).get_query_set().filter(active=True)
 
@@ -205,7 +215,7 @@ class SupplyPointBase(models.Model, StockCacheMixin):
     supplied_by = models.ForeignKey('SupplyPoint', blank=True, null=True, db_index=True)
     groups = models.ManyToManyField('SupplyPointGroup', blank=True, null=True)
     
-    objects = models.Manager()
+    objects = SupplyPointManager()
     active_objects = ActiveSupplyPointManager()
 
     class Meta:
@@ -436,16 +446,23 @@ class SupplyPointBase(models.Model, StockCacheMixin):
                                       default_value=default_value)
     
     def _historical_stock(self, product, cache_key, year, month, day=None, default_value=0):
+        def _compute():
+            srs = transactions_before_or_during(year, month, day).\
+                    filter(supply_point=self, product=product).order_by("-date","-pk")
+            return srs[0].ending_balance if srs.exists() else default_value
         if settings.LOGISTICS_USE_SPOT_CACHING: 
-            from_cache = cache.get(cache_key)
-            if from_cache:
-                return from_cache
-        srs = transactions_before_or_during(year, month, day).\
-                filter(supply_point=self, product=product).order_by("-date","-pk")
-        ret = srs[0].ending_balance if srs.exists() else default_value
-        if settings.LOGISTICS_USE_SPOT_CACHING: 
-            cache.set(cache_key, ret, settings.LOGISTICS_SPOT_CACHE_TIMEOUT)
-        return ret
+            return get_or_compute(cache_key, self._cache_generation_keys(), _compute)
+        return _compute()
+
+    def _generation_key(self):
+        return ("gen-SP-%s" % self.code).replace(" ", "-")
+    
+    def invalidate_spot_caches(self):
+        """
+        Bumps the cache generation of this supply point and every location
+        above it, so that nothing that was spot cached for them gets used again.
+        """
+        bump_generations([self._generation_key()] + location_tree.generation_keys(self.location_id))
 
     def _cache_key(self, key, product, producttype, cdatetime=None):
         return ("SP-%(supplypoint)s-%(key)s-%(product)s-%(producttype)s-%(datetime)s" % \
@@ -561,13 +578,12 @@ class SupplyPointBase(models.Model, StockCacheMixin):
             parent = parent.supplied_by
 
     def report_to_supervisor(self, report, kwargs, exclude=None):
-        reportees = self.reportees()
-        if exclude:
-            reportees = reportees.exclude(pk__in=[e.pk for e in exclude])
-        for reportee in reportees:
+        messages = []
+        for reportee, connection in recipients([self], config.Responsibilities.REPORTEE_RESPONSIBILITY, 
+                                               exclude):
             kwargs['admin_name'] = reportee.name
-            if reportee.default_connection:
-                reportee.message(report % kwargs)
+            messages.append((connection, report % kwargs))
+        dispatch(messages)
 
     def supplies_product(self, product):
         try:
@@ -602,17 +618,13 @@ class SupplyPointBase(models.Model, StockCacheMixin):
             
     def notify_suppliees(self, message, products, exclude=None):
         """ stockouts_resolved is a dictionary of code to product """
-        to_notify = SupplyPoint.objects.filter(supplied_by=self, active=True).distinct()
-        for fac in to_notify:
-            reporters = fac.reporters()
-            if exclude:
-                reporters = reporters.exclude(pk__in=[e.pk for e in exclude])
-            for reporter in reporters:
-                if reporter.default_connection is not None:
-                    send_message(reporter.default_connection, message %
-                                 {'name':reporter.name,
-                                 'products':", ".join(products),
-                                 'supply_point':self.name})
+        to_notify = SupplyPoint.objects.filter(supplied_by=self, active=True)
+        dispatch([(connection, message % {'name':reporter.name,
+                                          'products':", ".join(products),
+                                          'supply_point':self.name}) \
+                  for reporter, connection in recipients(to_notify, 
+                                                         config.Responsibilities.STOCK_ON_HAND_RESPONSIBILITY, 
+                                                         exclude)])
 
     def notify_suppliees_of_stockouts_reported(self, stockouts_reported, exclude=None):
         message = "Dear %(name)s, %(supply_point)s is STOCKED OUT of: %(products)s "
@@ -663,6 +675,71 @@ class LogisticsProfileBase(models.Model):
 class LogisticsProfile(LogisticsProfileBase):
     __metaclass__ = ExtensibleModelBase
 
+class StockLevels(object):
+    """
+    A snapshot of the resolved monthly consumption and stock levels
+    for a ProductStock, along with the stock classification rules.
+    
+    Quantities are passed in rather than stored, so that the same 
+    snapshot can be used to classify historical stock values.
+    """
+    __slots__ = ("monthly_consumption", "emergency_reorder_level", 
+                 "reorder_level", "maximum_level")
+    
+    def __init__(self, monthly_consumption, emergency_reorder_level, 
+                 reorder_level, maximum_level):
+        self.monthly_consumption = monthly_consumption
+        self.emergency_reorder_level = emergency_reorder_level
+        self.reorder_level = reorder_level
+        self.maximum_level = maximum_level
+    
+    def is_below_emergency_level(self, quantity):
+        if self.emergency_reorder_level is not None:
+            if quantity <= self.emergency_reorder_level:
+                return True
+        return False
+
+    def is_below_low_supply_but_above_emergency_level(self, quantity):
+        if self.reorder_level is not None and self.emergency_reorder_level is not None:
+            if quantity <= self.reorder_level and quantity > self.emergency_reorder_level:
+                return True
+        return False
+
+    def is_below_low_supply(self, quantity):
+        if self.reorder_level is not None:
+            if quantity <= self.reorder_level and quantity > 0:
+                return True
+        return False
+
+    def is_above_low_supply(self, quantity):
+        if self.reorder_level is not None:
+            if quantity > self.reorder_level:
+                return True
+        return False
+
+    def is_in_good_supply(self, quantity):
+        if self.maximum_level is not None and self.reorder_level is not None:
+            if quantity > self.reorder_level and quantity <= self.maximum_level:
+                return True
+        return False
+
+    def is_other(self, quantity):
+        if self.monthly_consumption is None and quantity > 0:
+            return True
+        return False
+
+    def is_in_adequate_supply(self, quantity):
+        if self.maximum_level is not None and self.emergency_reorder_level is not None:
+            if quantity > self.emergency_reorder_level and quantity <= self.maximum_level:
+                return True
+        return False
+
+    def is_overstocked(self, quantity):
+        if self.maximum_level is not None:
+            if quantity > self.maximum_level:
+                return True
+        return False
+
 class ProductStock(models.Model):
     """
     Indicates supply point-specific information about a product (such as monthly consumption rates)
@@ -680,6 +757,24 @@ class ProductStock(models.Model):
     manual_monthly_consumption = models.PositiveIntegerField(default=None, blank=True, null=True)
     auto_monthly_consumption = models.PositiveIntegerField(default=None, blank=True, null=True)
     use_auto_consumption = models.BooleanField(default=settings.LOGISTICS_USE_AUTO_CONSUMPTION)
+    # running totals for the auto consumption calculation, 
+    # see logistics.consumption.ConsumptionAccumulator
+    consumption_transactions = models.PositiveIntegerField(default=0, editable=False)
+    consumption_period_start = models.DateTimeField(null=True, editable=False)
+    consumption_period_balance = models.IntegerField(null=True, editable=False)
+    consumption_period_receipts = models.IntegerField(default=0, editable=False)
+    consumption_total = models.FloatField(default=0, editable=False)
+    consumption_seconds = models.FloatField(default=0, editable=False)
+    consumption_since = models.DateTimeField(null=True, editable=False)
+    # the end and (unscaled) consumption of the first counted period, and
+    # the lookback cutoff it was scaled with, so it can be rescaled
+    consumption_first_end = models.DateTimeField(null=True, editable=False)
+    consumption_first_amount = models.FloatField(null=True, editable=False)
+    consumption_window_start = models.DateTimeField(null=True, editable=False)
+    # null until the totals have been computed
+    consumption_last_date = models.DateTimeField(null=True, editable=False)
+    # the highest transaction id added to the totals
+    consumption_last_id = models.PositiveIntegerField(null=True, editable=False)
 
     class Meta:
         unique_together = (('supply_point', 'product'),)
@@ -695,23 +790,81 @@ class ProductStock(models.Model):
             return consumption_by_sptype
         return self.product.average_monthly_consumption
     
-    @property
-    def monthly_consumption(self):
+    def _monthly_consumption(self):
         if self.use_auto_consumption and self.auto_monthly_consumption:
             return self.auto_monthly_consumption
         return self._manual_consumption()
     
+    _levels = None
+    _levels_key = None
+    @property
+    def levels(self):
+        """
+        The resolved consumption and stock levels for this stock.
+        
+        Resolving these can hit the cache or database several times,
+        so the result is kept on the object until one of the 
+        consumption fields it was computed from changes, or the supply 
+        point's type does.
+        """
+        key = (self.use_auto_consumption, self.auto_monthly_consumption, 
+               self.manual_monthly_consumption, self.supply_point_id, self.product_id,
+               self.supply_point.type_id)
+        if self._levels is None or self._levels_key != key:
+            self._levels = self._resolve_levels()
+            self._levels_key = key
+        return self._levels
+    
+    def _resolve_levels(self):
+        monthly_consumption = self._monthly_consumption()
+        emergency_reorder_level = reorder_level = maximum_level = None
+        if monthly_consumption is not None:
+            if settings.LOGISTICS_USE_GLOBAL_STOCK_LEVEL_POLICY:
+                policy = {"EMERGENCY_LEVEL": settings.LOGISTICS_EMERGENCY_LEVEL_IN_MONTHS,
+                          "REORDER_LEVEL": settings.LOGISTICS_REORDER_LEVEL_IN_MONTHS,
+                          "MAXIMUM_LEVEL": settings.LOGISTICS_MAXIMUM_LEVEL_IN_MONTHS}
+            else:
+                policy = self.supply_point.type.policy()
+            emergency_reorder_level = int(monthly_consumption*policy["EMERGENCY_LEVEL"])
+            reorder_level = int(monthly_consumption*policy["REORDER_LEVEL"])
+            maximum_level = int(monthly_consumption*policy["MAXIMUM_LEVEL"])
+        # if you use static levels you only get the product's data or nothing
+        if settings.LOGISTICS_USE_STATIC_EMERGENCY_LEVELS:
+            emergency_reorder_level = self.product.emergency_order_level
+        return StockLevels(monthly_consumption, emergency_reorder_level, 
+                           reorder_level, maximum_level)
+
+    @property
+    def monthly_consumption(self):
+        return self.levels.monthly_consumption
+    
     @monthly_consumption.setter
     def monthly_consumption(self, value):
         self.manual_monthly_consumption = value
 
     def update_auto_consumption(self):
-        d = self.daily_consumption
-        if d:
-            # if AMC is a fraction, we should always round up
-            # (always better to underestimate months remaining than over)
-            self.auto_monthly_consumption = math.ceil(d * 30)
-            self.save()
+        """
+        Updates the automatic monthly consumption, adding any new 
+        transactions to the running totals rather than going through 
+        every transaction again.
+        """
+        accumulator = ConsumptionAccumulator(self)
+        accumulator.update()
+        amc = auto_monthly_consumption(accumulator.daily_consumption)
+        changed = amc is not None and amc != self.auto_monthly_consumption
+        if amc is not None:
+            self.auto_monthly_consumption = amc
+        # only write what was computed here, since this can run on a queue
+        # worker while a report updates the quantity of the same stock
+        fields = ["auto_monthly_consumption"] + [f.name for f in ProductStock._meta.fields \
+                                                 if f.name.startswith("consumption_")]
+        ProductStock.objects.filter(pk=self.pk).update(**dict((name, getattr(self, name)) \
+                                                              for name in fields))
+        if changed:
+            # the update skips the post_save signals, so catch up on 
+            # what they would have done
+            _refresh_stock_statuses(pk=self.pk)
+            self.supply_point.invalidate_spot_caches()
 
     @property
     def daily_consumption(self):
@@ -722,39 +875,21 @@ class ProductStock(models.Model):
         
     @property
     def emergency_reorder_level(self):
-        # if you use static levels you only get the product's data or nothing
-        if settings.LOGISTICS_USE_STATIC_EMERGENCY_LEVELS:
-            return self.product.emergency_order_level
-        
-        elif self.monthly_consumption is not None:
-            if settings.LOGISTICS_USE_GLOBAL_STOCK_LEVEL_POLICY:
-                return int(self.monthly_consumption*settings.LOGISTICS_EMERGENCY_LEVEL_IN_MONTHS)
-            else: 
-                return int(self.monthly_consumption*self.supply_point.type.policy()["EMERGENCY_LEVEL"])
-        return None
+        return self.levels.emergency_reorder_level
 
     @property
     def reorder_level(self):
-        if self.monthly_consumption is not None:
-            if settings.LOGISTICS_USE_GLOBAL_STOCK_LEVEL_POLICY:
-                return int(self.monthly_consumption*settings.LOGISTICS_REORDER_LEVEL_IN_MONTHS)
-            else: 
-                return int(self.monthly_consumption*self.supply_point.type.policy()["REORDER_LEVEL"])
-        return None
+        return self.levels.reorder_level
 
     @property
     def maximum_level(self):
-        if self.monthly_consumption is not None:
-            if settings.LOGISTICS_USE_GLOBAL_STOCK_LEVEL_POLICY:
-                return int(self.monthly_consumption*settings.LOGISTICS_MAXIMUM_LEVEL_IN_MONTHS)
-            else: 
-                return int(self.monthly_consumption*self.supply_point.type.policy()["MAXIMUM_LEVEL"])
-        return None
+        return self.levels.maximum_level
 
     @property
     def reorder_amount(self):
-        if self.maximum_level is not None and self.quantity is not None:
-            return max(self.maximum_level - self.quantity, 0)
+        levels = self.levels
+        if levels.maximum_level is not None and self.quantity is not None:
+            return max(levels.maximum_level - self.quantity, 0)
         return None
     
     @property
@@ -762,9 +897,10 @@ class ProductStock(models.Model):
         return self.calculate_months_remaining(self.quantity)
         
     def calculate_months_remaining(self, quantity):
-        if self.monthly_consumption is not None and self.monthly_consumption > 0 \
+        monthly_consumption = self.levels.monthly_consumption
+        if monthly_consumption is not None and monthly_consumption > 0 \
           and quantity is not None:
-            return float(quantity) / float(self.monthly_consumption)
+            return float(quantity) / float(monthly_consumption)
         elif quantity == 0:
             return 0
         return None
@@ -786,51 +922,28 @@ class ProductStock(models.Model):
         Returns False if a) below emergency levels, or
         b) emergency levels not yet defined
         """
-        if self.emergency_reorder_level is not None:
-            if self.quantity <= self.emergency_reorder_level:
-                return True
-        return False
+        return self.levels.is_below_emergency_level(self.quantity)
 
     def is_below_low_supply_but_above_emergency_level(self):
-        if self.reorder_level is not None and self.emergency_reorder_level is not None:
-            if self.quantity <= self.reorder_level and self.quantity > self.emergency_reorder_level:
-                return True
-        return False
+        return self.levels.is_below_low_supply_but_above_emergency_level(self.quantity)
 
     def is_below_low_supply(self):
-        if self.reorder_level is not None:
-            if self.quantity <= self.reorder_level and self.quantity > 0:
-                return True
-        return False
+        return self.levels.is_below_low_supply(self.quantity)
 
     def is_above_low_supply(self):
-        if self.reorder_level is not None:
-            if self.quantity > self.reorder_level:
-                return True
-        return False
+        return self.levels.is_above_low_supply(self.quantity)
 
     def is_in_good_supply(self):
-        if self.maximum_level is not None and self.reorder_level is not None:
-            if self.quantity > self.reorder_level and self.quantity <= self.maximum_level:
-                return True
-        return False
+        return self.levels.is_in_good_supply(self.quantity)
 
     def is_other(self):
-        if self.monthly_consumption is None and self.quantity > 0:
-            return True
-        return False
+        return self.levels.is_other(self.quantity)
 
     def is_in_adequate_supply(self):
-        if self.maximum_level is not None and self.emergency_reorder_level is not None:
-            if self.quantity > self.emergency_reorder_level and self.quantity <= self.maximum_level:
-                return True
-        return False
+        return self.levels.is_in_adequate_supply(self.quantity)
 
     def is_overstocked(self):
-        if self.maximum_level is not None:
-            if self.quantity > self.maximum_level:
-                return True
-        return False
+        return self.levels.is_overstocked(self.quantity)
     
     def set_auto_consumption(self):
         self.use_auto_consumption = True
@@ -1188,6 +1301,10 @@ class ProductReport(models.Model):
             return None
         return parent_location.tree_parent
     
+    # set on reports saved by a logistics.stock_reports.ReportBatch, 
+    # which has already done everything post_save would
+    _stock_recorded = False
+    
     def post_save(self, created=True):
         """
         Every time a product report is created,
@@ -1198,7 +1315,7 @@ class ProductReport(models.Model):
         I guess 1+3 could go on a stocktransaction signal. 
         Something to consider if we start saving stocktransactions anywhere else.
         """
-        if not created:
+        if not created or self._stock_recorded:
             return
 
         # 1. Update the facility report date information
@@ -1238,6 +1355,9 @@ class StockTransaction(models.Model):
     ending_balance = models.IntegerField()
     date = models.DateTimeField(default=datetime.utcnow)
     product_report = models.ForeignKey(ProductReport, null=True)
+    # the code of the product report's type, copied here so that scans 
+    # over transactions don't need to join the reports and their types
+    report_type_code = models.CharField(max_length=10, null=True, blank=True, db_index=True)
     
     class Meta:
         verbose_name = "Stock Transaction"
@@ -1250,7 +1370,8 @@ class StockTransaction(models.Model):
     @classmethod
     def from_product_report(cls, pr, beginning_balance):
         st = cls(product_report=pr, supply_point=pr.supply_point, 
-                 product=pr.product, date=pr.report_date)
+                 product=pr.product, date=pr.report_date, 
+                 report_type_code=pr.report_type.code)
 
         st.beginning_balance = beginning_balance
         if pr.report_type.code in (Reports.SOH, Reports.EMERGENCY_SOH):
@@ -1305,6 +1426,54 @@ class NagRecord(models.Model):
     warning = models.IntegerField(default=1)
     nag_type = models.CharField(max_length=30)
 
+
+class MessageFingerprint(models.Model):
+    """
+    A hash of the text of a recent incoming message (ignoring case), so 
+    that repeats of it from the same connection can be found with an 
+    indexed lookup rather than a case-insensitive search through the 
+    whole message log. Fingerprints are only kept for ttl() seconds.
+    """
+    connection = models.ForeignKey("rapidsms.Connection")
+    message = models.ForeignKey(message_class, null=True, blank=True)
+    fingerprint = models.CharField(max_length=40, db_index=True)
+    date = models.DateTimeField(default=datetime.utcnow, db_index=True)
+
+    @classmethod
+    def fingerprint_text(cls, text):
+        return hashlib.sha1(text.lower().encode("utf-8")).hexdigest()
+
+    @classmethod
+    def ttl(cls):
+        """
+        How long (in seconds) fingerprints are kept: 
+        LOGISTICS_MESSAGE_FINGERPRINT_TTL, or longer if anything looks 
+        further back than that for repeats.
+        """
+        return max(settings.LOGISTICS_MESSAGE_FINGERPRINT_TTL, 
+                   settings.LOGISTICS_IGNORE_DUPE_RECEIPTS_WITHIN or 0,
+                   MAX_STOCK_OVERRIDE_WINDOW)
+
+    @classmethod
+    def recent(cls, connection, text, seconds):
+        """
+        Fingerprints of messages with the same text from the connection
+        in the last seconds.
+        """
+        return cls.objects.filter(connection=connection, fingerprint=cls.fingerprint_text(text),
+                                  date__gte=datetime.utcnow() - timedelta(seconds=seconds))
+
+    @classmethod
+    def record(cls, connection, text, message=None):
+        """
+        Records a message, and forgets the connection's expired ones.
+        """
+        now = datetime.utcnow()
+        cls.objects.filter(connection=connection, 
+                           date__lt=now - timedelta(seconds=cls.ttl())).delete()
+        return cls.objects.create(connection=connection, message=message, 
+                                  fingerprint=cls.fingerprint_text(text), date=now)
+
     
 class Responsibility(models.Model):
     """ e.g. 'reports stock on hand', 'orders new stock' """
@@ -1345,6 +1514,9 @@ class ProductReportsHelper(object):
     lazy UPDATE-ing, error reporting etc.
     """
     REC_SEPARATOR = '-'
+    # characters which are read as REC_SEPARATOR, and ones which are ignored
+    SEPARATORS = ',/;*+-'
+    JUNK = '\'"`()'
 
     def __init__(self, sdp, report_type, message=None, timestamp=None, validator=Validator()):
         self.product_stock = {}
@@ -1358,6 +1530,7 @@ class ProductReportsHelper(object):
         self.timestamp = timestamp if timestamp else datetime.utcnow()
         self.errors = []
         self.validator = validator
+        self._context = None
     
     def validate(self):
         self.validator.validate(supply_point=self.supply_point, 
@@ -1365,55 +1538,50 @@ class ProductReportsHelper(object):
                                 product_received=self.product_received, 
                                 consumption=self.consumption)
 
-    def _clean_string(self, string):
-        if not string:
-            return string
-        mylist = list(string)
-        newstring = string[0]
-        i = 1
-        while i < len(mylist)-1:
-            if mylist[i] == ' ' and mylist[i-1].isdigit() and mylist[i+1].isdigit():
-                newstring = newstring + self.REC_SEPARATOR
-            else:
-                newstring = newstring + mylist[i]
-            i = i + 1
-        newstring = newstring + string[-1]
-        string = newstring
-
-        string = string.replace(' ','')
-        separators = [',', '/', ';', '*', '+', '-']
-        for mark in separators:
-            string = string.replace(mark, self.REC_SEPARATOR)
-        junk = ['\'', '\"', '`', '(', ')']
-        for mark in junk:
-            string = string.replace(mark, '')
-        return string.lower()
-
-    def _getTokens(self, string):
-        mylist = list(string)
-        token = ''
-        i = 0
-        while i<len(mylist):
-            token = token + mylist[i]
-            if i+1 == len(mylist):
-                # you've reached the end
-                yield token
-            elif mylist[i].isdigit() and not mylist[i+1].isdigit() or \
-              mylist[i].isalpha() and not mylist[i+1].isalpha() or \
-              not mylist[i].isalnum() and mylist[i+1].isalnum():
-                yield token
-                token = ''
-            i = i+1
+    def _clean_chars(self, string):
+        """
+        Yields the characters of a report, lower cased, with the separators
+        (including a space between two digits) replaced by REC_SEPARATOR 
+        and any other spaces or junk dropped.
+        """
+        if len(string) == 1:
+            # the first and last characters have always been kept separately
+            string = string * 2
+        last = len(string) - 1
+        for i, c in enumerate(string):
+            if c == ' ' and 0 < i < last and string[i-1].isdigit() and string[i+1].isdigit():
+                c = self.REC_SEPARATOR
+            if c == ' ':
+                continue
+            if c in self.SEPARATORS:
+                c = self.REC_SEPARATOR
+            if c in self.JUNK:
+                continue
+            yield c.lower()
+
+    def _lex(self, string):
+        """
+        Splits a report into tokens in a single pass: runs of digits, runs
+        of letters and runs of anything else.
+        """
+        empty = string[:0]
+        token = []
+        previous = None
+        for c in self._clean_chars(string):
+            if previous is not None and (previous.isdigit() and not c.isdigit() or \
+              previous.isalpha() and not c.isalpha() or \
+              not previous.isalnum() and c.isalnum()):
+                yield empty.join(token)
+                token = []
+            token.append(c)
+            previous = c
+        if token:
+            yield empty.join(token)
 
     
     def clean_product_code(self, code):
-        code = code.lower()
-        if hasattr(settings, "LOGISTICS_PRODUCT_ALIASES"):
-            # support aliases for product codes.
-            if code in settings.LOGISTICS_PRODUCT_ALIASES:
-                assert(not Product.objects.filter(sms_code__iexact=code).exists()) 
-                code = settings.LOGISTICS_PRODUCT_ALIASES[code]
-        return code
+        # support aliases for product codes.
+        return product_codes.clean(code)
     
     def newparse(self, string, delimiters=" "):
         """
@@ -1443,8 +1611,7 @@ class ProductReportsHelper(object):
         match = re.search("[0-9]",string)
         if not match:
             raise ValueError(config.Messages.NO_QUANTITY_ERROR)
-        string = self._clean_string(string)
-        an_iter = self._getTokens(string)
+        an_iter = self._lex(string)
         commodity = None
         valid = False
         while True:
@@ -1488,26 +1655,27 @@ class ProductReportsHelper(object):
     def save(self):
         stockouts_reported = []
         stockouts_resolved = []
+        products = dict((code, self.get_product(code)) for code in \
+                        set(self.product_received) | set(self.product_stock))
+        # all the reports are written together, in a constant number of queries
+        batch = ReportBatch(self.supply_point, products.values(), 
+                            message=self.message, date=self.timestamp)
         # NOTE: receipts should be processed BEFORE stock levels
         # (so that after someone reports jd10.3, we record that
         # we've received 3 jd this past week and the current stock
         # level is 10)
         for stock_code in self.product_received:
-            self._record_product_report(self.get_product(stock_code), 
-                                        self.product_received[stock_code], 
-                                        Reports.REC)
+            batch.add(products[stock_code], Reports.REC, 
+                      self.product_received[stock_code])
         for stock_code in self.product_stock:
-            try:
-                original_quantity = ProductStock.objects.get(supply_point=self.supply_point, 
-                                                             product__sms_code=stock_code).quantity
-            except ProductStock.DoesNotExist:
-                original_quantity = 0
+            stock = batch.stock(products[stock_code])
+            original_quantity = stock.quantity if stock else 0
             new_quantity = self.product_stock[stock_code]
 
             if original_quantity == 0 and new_quantity == 0 and settings.LOGISTICS_IGNORE_EMPTY_STOCKS:
                 continue
 
-            self._record_product_report(self.get_product(stock_code), new_quantity, self.report_type)
+            batch.add(products[stock_code], self.report_type, new_quantity)
 
             # in the case of transfers out this logic is broken
             # for now that's ok, since malawi doesn't do anything with this 
@@ -1515,6 +1683,7 @@ class ProductReportsHelper(object):
                 stockouts_resolved.append(stock_code)
             if original_quantity > 0 and new_quantity == 0:
                 stockouts_reported.append(stock_code)
+        batch.save()
         reporter = self.message.connection.contact if self.message \
             and self.message.connection \
             and self.message.connection.contact else None
@@ -1530,6 +1699,17 @@ class ProductReportsHelper(object):
         for stock_code in self.consumption:
             self.supply_point.record_consumption_by_code(stock_code, 
                                                          self.consumption[stock_code])
+        self._context = None
+
+    @property
+    def context(self):
+        """
+        The ReportContext that the replies to this report are worked out
+        from, loaded the first time one of them is needed.
+        """
+        if self._context is None:
+            self._context = ReportContext(self.supply_point)
+        return self._context
 
     def add_product_consumption(self, product, consumption):
         if isinstance(consumption, basestring) and consumption.isdigit():
@@ -1544,7 +1724,7 @@ class ProductReportsHelper(object):
         if the product can't be found.
         """
         try:
-            return Product.objects.get(sms_code__icontains=product_code)
+            return product_codes.get(product_code)
         except (Product.DoesNotExist, Product.MultipleObjectsReturned):
             raise UnknownCommodityCodeError(product_code)
     
@@ -1607,19 +1787,12 @@ class ProductReportsHelper(object):
         for key, val in self.product_stock.items():
             if val == 0:
                 stockouts[key] = val
-        # remove equivalents
+        # remove products with an equivalent which was reported and isn't low
         dupes = []
-        if getattr(settings, "LOGISTICS_USE_COMMODITY_EQUIVALENTS", False):
-            for key in stockouts:
-                prod = Product.objects.get(sms_code=key)#.select_related('equivalent_to')
-                if prod.equivalents.count() > 0:
-                    for e in prod.equivalents.all():
-                        if e.sms_code in self.product_stock:
-                            ps = ProductStock.objects.get(product=e, supply_point=self.supply_point)
-                            if ps.is_above_low_supply(): 
-                                # if we wanted to support multiple equivalents, 
-                                # we could do a recurisve search here
-                                dupes.append(key)
+        for key in stockouts:
+            for ps in self.context.equivalent_stocks(self.get_product(key)):
+                if ps.product.sms_code in self.product_stock and ps.is_above_low_supply(): 
+                    dupes.append(key)
         return [key for key, val in stockouts.items() if val == 0 and key not in dupes]
 
     def stockouts(self):
@@ -1629,23 +1802,15 @@ class ProductReportsHelper(object):
     def _low_supply(self):
         low_supply = {}
         for i in self.product_stock:
-            productstock = ProductStock.objects.filter(supply_point=self.supply_point)\
-                .get(product__sms_code__icontains=i)#.select_related('product','product__equivalent_to')
-            if productstock.is_below_low_supply():
+            productstock = self.context.stock(self.get_product(i))
+            if productstock is not None and productstock.is_below_low_supply():
                 low_supply[i] = productstock
-        # strip equivalents
+        # strip products with an equivalent that isn't low
         dupes = []
-        if getattr(settings, "LOGISTICS_USE_COMMODITY_EQUIVALENTS", False):
-            for ls in low_supply:
-                stock = low_supply[ls]
-                equivalents = stock.product.equivalents.all()
-                for e in equivalents:
-                    ps, created = ProductStock.objects.get_or_create(product=e, 
-                                                                     supply_point=stock.supply_point)
-                    if ps.is_above_low_supply():
-                        # if we wanted to support multiple equivalents, 
-                        # we could do a recurisve search here
-                        dupes.append(ls)
+        for ls in low_supply:
+            for ps in self.context.equivalent_stocks(low_supply[ls].product):
+                if ps.is_above_low_supply():
+                    dupes.append(ls)
         return [key for key, val in low_supply.items() if key not in dupes]
 
     def low_supply(self):
@@ -1653,16 +1818,16 @@ class ProductReportsHelper(object):
         return " ".join(low_supply)
     
     def amount_to_reorder(self):
-        reorder = self._stockouts() + self._low_supply()
-        pss = ProductStock.objects.filter(supply_point=self.supply_point, 
-                                          product__sms_code__in=reorder)
+        reorder = set(self._stockouts() + self._low_supply())
+        pss = [ps for ps in self.context.stocks if ps.product.sms_code in reorder]
         return ", ".join('%s %s' % (ps.reorder_amount, ps.product.sms_code) for ps in pss if ps.reorder_level is not None)
 
     def over_supply(self):
         over_supply = ""
         for i in self.product_stock:
-            productstock = ProductStock.objects.filter(supply_point=self.supply_point)\
-                .get(product__sms_code__icontains=i)
+            productstock = self.context.stock(self.get_product(i))
+            if productstock is None:
+                continue
             #if productstock.monthly_consumption == 0:
             #    raise ValueError("I'm sorry. I cannot calculate oversupply
             #    for %(code)s until I know your monthly con/sumption.
@@ -1683,7 +1848,9 @@ class ProductReportsHelper(object):
         date_check = datetime.utcnow() + relativedelta(days=-num_days)
         reporter = self.message.contact
         products_to_report = reporter.commodities_reported()
-        stocks_already_reported = self.supply_point.product_stocks().filter(last_modified__gt=date_check)
+        # the same stocks as self.supply_point.product_stocks()
+        stocks_already_reported = [r for r in self.context.stocks if r.is_active and \
+                                   r.product.is_active and r.last_modified > date_check]
         return list(set([p.sms_code for p in products_to_report]) \
             - set([r.product.sms_code for r in stocks_already_reported]) \
             - set([q for q in self.reported_products()]))
@@ -1718,3 +1885,37 @@ from .warehouse_models import *
 
 post_save.connect(post_save_product_report, sender=ProductReport)
 post_save.connect(post_save_stock_transaction, sender=StockTransaction)
+post_delete.connect(post_delete_stock_transaction, sender=StockTransaction)
+post_save.connect(default_consumption_changed, sender=DefaultMonthlyConsumption)
+post_delete.connect(default_consumption_changed, sender=DefaultMonthlyConsumption)
+# these need to come after the registry is invalidated above
+post_save.connect(default_consumption_stock_statuses, sender=DefaultMonthlyConsumption)
+post_delete.connect(default_consumption_stock_statuses, sender=DefaultMonthlyConsumption)
+post_save.connect(post_save_product_stock, sender=ProductStock)
+post_delete.connect(post_delete_product_stock, sender=ProductStock)
+post_save.connect(post_save_product, sender=Product)
+post_save.connect(products_changed, sender=Product)
+post_delete.connect(products_changed, sender=Product)
+m2m_changed.connect(product_equivalents_changed, sender=Product.equivalents.through)
+post_save.connect(contact_roles_changed, sender=ContactRole)
+post_delete.connect(contact_roles_changed, sender=ContactRole)
+post_save.connect(contact_roles_changed, sender=Responsibility)
+post_delete.connect(contact_roles_changed, sender=Responsibility)
+m2m_changed.connect(contact_roles_changed, sender=ContactRole.responsibilities.through)
+post_save.connect(invalidate_supply_point_spot_caches, sender=ProductStock)
+post_delete.connect(invalidate_supply_point_spot_caches, sender=ProductStock)
+post_save.connect(invalidate_supply_point_spot_caches, sender=StockTransaction)
+post_delete.connect(invalidate_supply_point_spot_caches, sender=StockTransaction)
+post_save.connect(invalidate_all_spot_caches, sender=DefaultMonthlyConsumption)
+post_delete.connect(invalidate_all_spot_caches, sender=DefaultMonthlyConsumption)
+post_save.connect(invalidate_all_spot_caches, sender=Product)
+post_init.connect(remember_tree_state, sender=SupplyPoint)
+# this needs to come before supply_point_moved, which updates the state it checks
+post_save.connect(post_save_supply_point, sender=SupplyPoint)
+post_save.connect(supply_point_moved, sender=SupplyPoint)
+post_delete.connect(supply_point_moved, sender=SupplyPoint)
+post_init.connect(remember_tree_state, sender=Location)
+post_save.connect(location_moved, sender=Location)
+post_delete.connect(location_moved, sender=Location)
+request_started.connect(check_registries)
+request_finished.connect(end_registry_checks)
@@ -0,0 +1,127 @@
+"""
+Sending notifications to many contacts at once, like telling every 
+facility supplied by a store about a stockout there.
+
+The recipients (and their connections and backends) are found in two 
+queries, the messages are rendered up front, and then each one is 
+handed to the outbound WorkQueue along with its connection, so sending
+it doesn't query anything. With LOGISTICS_QUEUE_BACKEND set to threads
+or celery they're sent in the background, so notifying a district's 
+worth of facilities doesn't hold up the reply to whoever reported the 
+stockout. Sending through each rapidsms backend in the background is 
+limited to LOGISTICS_OUTBOUND_RATE_LIMITS messages per second, counted
+in the cache, so the limit holds across every process and celery worker
+sharing a cache backend (but is per process with the local memory 
+cache). Sent straight away (the sync backend), messages are never held
+back, since that would hold up handling the incoming message.
+
+With LOGISTICS_OUTBOUND_BACKEND set to OUTBOUND_BACKEND_LOCAL, messages 
+are kept in local_outbox instead of being sent, for tests.
+"""
+import hashlib
+import threading
+import time
+from rapidsms.conf import settings
+from rapidsms.contrib.messaging.utils import send_message
+from logistics.balances import _ids
+from logistics.spot_cache import cache
+
+def recipients(supply_points, responsibility, exclude=None):
+    """
+    The contacts at any of the supply points with the responsibility 
+    (a Responsibility code), as (contact, default connection) pairs. 
+    Contacts without a connection, or in exclude, are left out.
+    """
+    from rapidsms.models import Contact, Connection
+    contacts = Contact.objects.filter(supply_point__in=_ids(supply_points), 
+                                      role__responsibilities__code=responsibility).distinct()
+    if exclude:
+        contacts = contacts.exclude(pk__in=[e.pk for e in exclude])
+    contacts = list(contacts)
+    connections = {}
+    # the first connection of each, like Contact.default_connection
+    for connection in Connection.objects.filter(contact__in=[c.pk for c in contacts])\
+                                        .select_related("backend").order_by("pk"):
+        connections.setdefault(connection.contact_id, connection)
+    return [(contact, connections[contact.pk]) for contact in contacts \
+            if contact.pk in connections]
+
+def dispatch(messages):
+    """
+    Queues (connection, text) pairs to be sent. The connections should
+    have their backends loaded already (as recipients() does).
+    """
+    from logistics.queues import outbound_queue
+    for connection, text in messages:
+        outbound_queue.put(connection, text)
+
+
+class RateLimiter(object):
+    """
+    Holds back calls to wait() with the same key, so that at most 
+    LOGISTICS_OUTBOUND_RATE_LIMITS[key] of them return in any one second,
+    across every process sharing the cache. Keys without a limit never 
+    wait.
+    """
+
+    def _counter(self, key, second):
+        # backend names can have anything in them
+        return "outbound-rate-%s-%s" % (hashlib.md5(key.encode("utf-8")).hexdigest(), second)
+
+    def wait(self, key):
+        rate = settings.LOGISTICS_OUTBOUND_RATE_LIMITS.get(key)
+        if not rate:
+            return
+        while True:
+            now = time.time()
+            counter = self._counter(key, int(now))
+            cache.add(counter, 0, 2)
+            try:
+                if cache.incr(counter) <= rate:
+                    return
+            except ValueError:
+                # expired in between, so the second is over anyway
+                continue
+            # this second is used up, so try again in the next one
+            time.sleep(int(now) + 1 - now)
+
+rate_limiter = RateLimiter()
+
+
+class LocalOutbox(object):
+    """
+    Keeps (connection, text) pairs instead of sending them.
+    """
+
+    def __init__(self):
+        self.messages = []
+        self._lock = threading.Lock()
+
+    def send(self, connection, text):
+        self._lock.acquire()
+        try:
+            self.messages.append((connection, text))
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self.messages = []
+
+local_outbox = LocalOutbox()
+
+
+def send(connection, text):
+    """
+    Sends a single message. Run by the outbound queue, which waits for 
+    the connection's backend's rate limit first unless it's sending 
+    straight away.
+    """
+    if settings.LOGISTICS_QUEUE_BACKEND != settings.QUEUE_BACKEND_SYNC:
+        rate_limiter.wait(connection.backend.name)
+    backend = settings.LOGISTICS_OUTBOUND_BACKEND
+    if backend == settings.OUTBOUND_BACKEND_RAPIDSMS:
+        send_message(connection, text)
+    elif backend == settings.OUTBOUND_BACKEND_LOCAL:
+        local_outbox.send(connection, text)
+    else:
+        raise ValueError("Unknown LOGISTICS_OUTBOUND_BACKEND %s" % backend)
@@ -0,0 +1,145 @@
+"""
+Queues for work that shouldn't hold up handling a message, like 
+recalculating a stock's auto consumption after every report.
+
+Work is queued by key (e.g. a supply point and product id). On a 
+deduplicating queue, queueing a key that's already waiting to be run 
+does nothing, so a burst of reports for the same stock is only 
+processed once; queues of things that must each happen, like 
+outbound messages, are created with deduplicate=False. On the threads and
+celery backends each piece of work runs in its own transaction; run 
+straight away, it's part of whatever transaction is open.
+
+Work queued inside a function decorated with queue_after_commit (e.g.
+a signal handler that saves in its own transaction) is held back until
+the function has returned, so that workers never run before the 
+changes that queued them are committed (see logistics.commit_hooks).
+
+LOGISTICS_QUEUE_BACKEND decides where the work runs: straight away 
+(the default), on a pool of threads in the current process (for 
+deployments without a broker), or on the celery workers.
+"""
+import hashlib
+import logging
+import threading
+import Queue
+from django.db import transaction
+from logistics.commit_hooks import after_commit, holding, queue_after_commit
+from logistics.spot_cache import cache
+from rapidsms.conf import settings
+
+# how long (in seconds) a key queued on celery is considered to be waiting,
+# in case its task is lost
+CELERY_PENDING_TIMEOUT = 60 * 60
+
+class WorkQueue(object):
+    _queues = {}
+
+    def __init__(self, name, handler, deduplicate=True):
+        self.name = name
+        self.handler = handler
+        self.deduplicate = deduplicate
+        self._queue = Queue.Queue()
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._workers = []
+        WorkQueue._queues[name] = self
+
+    @classmethod
+    def get(cls, name):
+        return cls._queues[name]
+
+    def put(self, *key):
+        """
+        Queues the handler to be run with key as its arguments.
+        """
+        if holding():
+            after_commit(self.put, *key)
+            return
+        backend = settings.LOGISTICS_QUEUE_BACKEND
+        if backend == settings.QUEUE_BACKEND_SYNC:
+            self.handler(*key)
+        elif backend == settings.QUEUE_BACKEND_THREADS:
+            self._put_local(key)
+        elif backend == settings.QUEUE_BACKEND_CELERY:
+            if not self.deduplicate or \
+              cache.add(self._pending_key(key), 1, CELERY_PENDING_TIMEOUT):
+                from logistics.tasks import run_queued
+                run_queued.delay(self.name, key)
+        else:
+            raise ValueError("Unknown LOGISTICS_QUEUE_BACKEND %s" % backend)
+
+    @queue_after_commit
+    @transaction.commit_on_success
+    def run(self, *key):
+        """
+        Runs the handler for key in its own transaction, as the workers do,
+        holding back anything it queues or bumps until that has committed.
+        """
+        self.handler(*key)
+
+    def run_queued(self, *key):
+        """
+        Runs a key that was queued on celery.
+        """
+        if self.deduplicate:
+            # anything queued after this point needs another run
+            cache.delete(self._pending_key(key))
+        self.run(*key)
+
+    def join(self):
+        """
+        Waits until everything queued on the local threads has been run.
+        """
+        self._queue.join()
+
+    def _pending_key(self, key):
+        # keys can include message text, which can't go in a cache key as is
+        return "queue-%s-%s" % (self.name, hashlib.md5(repr(key)).hexdigest())
+
+    def _put_local(self, key):
+        self._lock.acquire()
+        try:
+            if self.deduplicate:
+                if key in self._pending:
+                    return
+                self._pending.add(key)
+            while len(self._workers) < settings.LOGISTICS_QUEUE_WORKERS:
+                worker = threading.Thread(target=self._work, 
+                                          name="%s-queue-%s" % (self.name, len(self._workers)))
+                worker.setDaemon(True)
+                worker.start()
+                self._workers.append(worker)
+        finally:
+            self._lock.release()
+        self._queue.put(key)
+
+    def _work(self):
+        while True:
+            key = self._queue.get()
+            self._lock.acquire()
+            try:
+                self._pending.discard(key)
+            finally:
+                self._lock.release()
+            try:
+                self.run(*key)
+            except Exception:
+                logging.exception("error running %s queue for %s" % (self.name, key))
+            finally:
+                self._queue.task_done()
+
+
+def _update_auto_consumption(supply_point_id, product_id):
+    from logistics.models import ProductStock
+    for stock in ProductStock.objects.filter(supply_point=supply_point_id, product=product_id):
+        stock.update_auto_consumption()
+
+consumption_queue = WorkQueue("consumption", _update_auto_consumption)
+
+def _send_notification(connection, text):
+    from logistics.outbound import send
+    send(connection, text)
+
+# the same text can be sent to the same connection twice on purpose
+outbound_queue = WorkQueue("outbound", _send_notification, deduplicate=False)
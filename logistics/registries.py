@@ -0,0 +1,349 @@
+"""
+Process-local copies of small, rarely changing tables which are read
+from inside hot loops (e.g. once per stock while rendering a dashboard).
+
+Each registry loads its whole table once and then answers lookups from
+memory. Local copies are dropped by signals when the underlying rows
+change. To keep multiple worker processes in sync, every change also
+bumps a version key in the shared cache, which the other processes
+check before using their copy: once per web request (from the 
+request_started signal to request_finished), and on every lookup 
+anywhere else, like the SMS router, celery tasks and management 
+commands, which have no request to hang the check on. Either way a 
+change made elsewhere is seen by the next request or message. The
+version is bumped once the change has been committed (see 
+logistics.commit_hooks), so that no process reloads the old rows 
+under the new version.
+"""
+import re
+import threading
+from copy import copy
+import uuid
+from logistics.commit_hooks import after_commit
+from logistics.spot_cache import cache
+from rapidsms.conf import settings
+
+# a month, which is as long as memcached allows
+VERSION_TIMEOUT = 30 * 24 * 60 * 60
+
+# the registries checked so far in the current web request, if any
+_local = threading.local()
+
+class ProcessLocalRegistry(object):
+    """
+    Base class for process-local registries. Subclasses must define
+    a version_key and implement load().
+    """
+    version_key = None
+    _registries = []
+
+    def __init__(self):
+        self._data = None
+        self._version = None
+        self._lock = threading.Lock()
+        ProcessLocalRegistry._registries.append(self)
+
+    def load(self):
+        """
+        Loads the full contents of the registry from the database.
+        """
+        raise NotImplementedError()
+
+    def _shared_version(self):
+        version = cache.get(self.version_key)
+        if version is None:
+            # nobody has loaded this since the cache was cleared
+            version = uuid.uuid4().hex
+            if not cache.add(self.version_key, version, VERSION_TIMEOUT):
+                version = cache.get(self.version_key)
+        return version
+
+    def _is_current(self):
+        checked = getattr(_local, "checked", None)
+        if checked is not None:
+            if self in checked:
+                return True
+            checked.add(self)
+        return self._shared_version() == self._version
+
+    @property
+    def data(self):
+        data = self._data
+        if data is None or not self._is_current():
+            self._lock.acquire()
+            try:
+                # read the version first, so that a change that comes in
+                # while we're loading makes this copy look stale, not current
+                version = self._shared_version()
+                data = self._data = self.load()
+                self._version = version
+                checked = getattr(_local, "checked", None)
+                if checked is not None:
+                    checked.add(self)
+            finally:
+                self._lock.release()
+        return data
+
+    def reset(self):
+        """
+        Drops this process's copy, without touching other processes.
+        """
+        self._data = None
+
+    def invalidate(self):
+        """
+        Drops this process's copy, and once the change has been committed
+        tells all other processes to drop theirs (and drops this one again,
+        in case it was reloaded from before the commit). Called whenever 
+        the underlying data changes.
+        """
+        self.reset()
+        after_commit(self._bump_version)
+
+    def _bump_version(self):
+        cache.set(self.version_key, uuid.uuid4().hex, VERSION_TIMEOUT)
+        self.reset()
+
+
+def reset_registries():
+    """
+    Drops the local copies of all registries.
+    """
+    for registry in ProcessLocalRegistry._registries:
+        registry.reset()
+
+def check_registries(sender, **kwargs):
+    """
+    Starts a web request, in which each registry checks its shared 
+    version on its first lookup only. Connected to django's 
+    request_started signal.
+    """
+    _local.checked = set()
+
+def end_registry_checks(sender, **kwargs):
+    """
+    Ends a web request, after which every lookup checks the shared 
+    version again. Connected to django's request_finished signal.
+    """
+    _local.checked = None
+
+
+class DefaultConsumptionRegistry(ProcessLocalRegistry):
+    """
+    All DefaultMonthlyConsumption values, keyed by
+    (supply point type code, product id).
+    """
+    version_key = "logistics-registry-default-monthly-consumption"
+
+    def load(self):
+        from logistics.models import DefaultMonthlyConsumption
+        return dict(((sptype, product), consumption) for sptype, product, consumption in \
+                    DefaultMonthlyConsumption.objects.values_list("supply_point_type", "product",
+                                                                  "default_monthly_consumption"))
+
+    def get(self, supply_point_type_id, product_id):
+        return self.data.get((supply_point_type_id, product_id))
+
+default_consumptions = DefaultConsumptionRegistry()
+
+
+class ProductKeywordRegistry(ProcessLocalRegistry):
+    """
+    A compiled regular expression matching text that starts with 
+    "soh", a product code or a product code alias, used to decide 
+    whether a message looks like a stock report.
+    """
+    version_key = "logistics-registry-product-keywords"
+
+    def load(self):
+        from logistics.models import Product
+        from logistics.const import Reports
+        keywords = [Reports.SOH]
+        keywords.extend(Product.objects.values_list("sms_code", flat=True))
+        keywords.extend(getattr(settings, "LOGISTICS_PRODUCT_ALIASES", {}).keys())
+        # longest first, although any match will do
+        keywords.sort(key=len, reverse=True)
+        return re.compile("|".join(re.escape(keyword) for keyword in keywords))
+
+    def matches(self, text):
+        return self.data.match(text) is not None
+
+product_keywords = ProductKeywordRegistry()
+
+
+# marks a code which matches more than one product
+_AMBIGUOUS = object()
+
+class ProductCodeRegistry(ProcessLocalRegistry):
+    """
+    Every product, looked up by code the way stock reports always have 
+    been: a code matches the products whose sms_code contains it 
+    (ignoring case), and is only recognised if it matches exactly one.
+    Every fragment of every code is indexed, which is cheap since codes
+    are at most a few characters long. Also keeps which products are 
+    active and the LOGISTICS_PRODUCT_ALIASES, so that nothing about a 
+    code needs a query.
+    """
+    version_key = "logistics-registry-product-codes"
+
+    def load(self):
+        from logistics.models import Product
+        products = {}
+        fragments = {}
+        for product in Product.objects.all():
+            products[product.pk] = product
+            code = product.sms_code.lower()
+            for fragment in set(code[i:j] for i in range(len(code) + 1) \
+                                          for j in range(i, len(code) + 1)):
+                fragments[fragment] = _AMBIGUOUS if fragment in fragments else product.pk
+        codes = dict((product.sms_code.lower(), product.is_active) for product in products.values())
+        aliases = dict((alias.lower(), code) for alias, code in \
+                       getattr(settings, "LOGISTICS_PRODUCT_ALIASES", {}).items())
+        return products, fragments, codes, aliases
+
+    def get(self, code):
+        """
+        Returns (a copy of) the product matching code. Raises 
+        Product.DoesNotExist or Product.MultipleObjectsReturned, 
+        like Product.objects.get(sms_code__icontains=code).
+        """
+        from logistics.models import Product
+        products, fragments, _, _ = self.data
+        pk = fragments.get(code.lower())
+        if pk is None:
+            raise Product.DoesNotExist("No product matches %s" % code)
+        if pk is _AMBIGUOUS:
+            raise Product.MultipleObjectsReturned("More than one product matches %s" % code)
+        return copy(products[pk])
+
+    def is_code(self, code):
+        """
+        Whether code is exactly (ignoring case) some product's code.
+        """
+        return code.lower() in self.data[2]
+
+    def is_active(self, code):
+        """
+        Whether the product whose code is exactly (ignoring case) code 
+        is active. Raises KeyError if there isn't one.
+        """
+        return self.data[2][code.lower()]
+
+    def clean(self, code):
+        """
+        Lower cases code, and replaces it with the code it's an alias 
+        for, if it's one of the LOGISTICS_PRODUCT_ALIASES.
+        """
+        code = code.lower()
+        _, _, codes, aliases = self.data
+        if code in aliases:
+            assert(code not in codes)
+            code = aliases[code]
+        return code
+
+product_codes = ProductCodeRegistry()
+
+
+class ProductEquivalentsRegistry(ProcessLocalRegistry):
+    """
+    The products equivalent to each product, following Product.equivalents
+    transitively (so if a is equivalent to b and b to c, all three are 
+    equivalent to each other), as sets of product ids keyed by product id.
+    """
+    version_key = "logistics-registry-product-equivalents"
+
+    def load(self):
+        from logistics.models import Product
+        neighbours = {}
+        for a, b in Product.equivalents.through.objects.values_list("from_product", "to_product"):
+            neighbours.setdefault(a, set()).add(b)
+            neighbours.setdefault(b, set()).add(a)
+        groups = {}
+        for start in neighbours:
+            if start in groups:
+                continue
+            group = set([start])
+            to_visit = [start]
+            while to_visit:
+                for pk in neighbours[to_visit.pop()]:
+                    if pk not in group:
+                        group.add(pk)
+                        to_visit.append(pk)
+            group = frozenset(group)
+            for pk in group:
+                groups[pk] = group
+        return groups
+
+    def get(self, product_id):
+        """
+        The ids of every product equivalent to the product, not 
+        including the product itself.
+        """
+        return self.data.get(product_id, frozenset()) - frozenset([product_id])
+
+product_equivalents = ProductEquivalentsRegistry()
+
+
+class ContactRoleRegistry(ProcessLocalRegistry):
+    """
+    The id and responsibility codes of every ContactRole, so that the
+    permission checks made on every incoming message don't need any 
+    queries.
+    """
+    version_key = "logistics-registry-contact-roles"
+
+    def load(self):
+        from logistics.models import ContactRole
+        codes = dict(ContactRole.objects.values_list("pk", "code"))
+        responsibilities = dict((pk, set()) for pk in codes)
+        for role_id, responsibility in ContactRole.responsibilities.through.objects\
+          .values_list("contactrole", "responsibility__code"):
+            responsibilities[role_id].add(responsibility)
+        return codes, responsibilities
+
+    def code(self, role_id):
+        """
+        The code of the role with the id, or None if there isn't one.
+        """
+        return self.data[0].get(role_id)
+
+    def responsibilities(self, role_id):
+        """
+        The codes of the role's responsibilities.
+        """
+        return self.data[1].get(role_id, set())
+
+    def has_role(self, contact, code):
+        return contact.role_id is not None and self.code(contact.role_id) == code
+
+contact_roles = ContactRoleRegistry()
+
+
+class LocationTreeRegistry(ProcessLocalRegistry):
+    """
+    The parent and spot cache generation key of every location, keyed by
+    location id, so that the generations above a supply point can be 
+    found without a query for each level of the tree.
+    """
+    version_key = "logistics-registry-location-tree"
+
+    def load(self):
+        from rapidsms.contrib.locations.models import Location
+        from logistics.aggregation import _parent_id
+        return dict((location.pk, (_parent_id(location), location._generation_key())) \
+                    for location in Location.objects.all())
+
+    def generation_keys(self, location_id):
+        """
+        The generation keys of the location and every location above it.
+        """
+        tree = self.data
+        keys = []
+        seen = set()
+        while location_id in tree and location_id not in seen:
+            seen.add(location_id)
+            location_id, key = tree[location_id]
+            keys.append(key)
+        return keys
+
+location_tree = LocationTreeRegistry()
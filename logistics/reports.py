@@ -10,8 +10,9 @@ from django.utils.importlib import import_module
 from rapidsms.conf import settings
 from dimagi.utils.dates import DateSpan
 from logistics.models import ProductReport, \
-    Product, ProductStock, SupplyPoint, StockRequest, HistoricalStockCache
+    Product, ProductStock, SupplyPoint, StockRequest
 from .tables import SOHReportingTable
+from .balances import historical_stock_counts
 from .const import Reports
 from .util import config
 
@@ -566,10 +567,10 @@ class ProductAvailabilitySummaryByFacility(ProductAvailabilitySummary):
         self.data = data
 
 class ProductAvailabilitySummaryByFacilitySP(ProductAvailabilitySummary):
-    """ it looks like this is a slower but more full-featured version of 
-    ProductAvailabilitySummaryByFacility which supports query by date, plus 
-    some incomplete code for using caching looking ahead: could merge these 
-    two functions, or replace this entirely with tanzania warehousing stuff
+    """ a version of ProductAvailabilitySummaryByFacility which supports 
+    query by date. past months are read from the HistoricalStockCache 
+    (and filled in when missing), so this takes the same number of 
+    queries no matter how many facilities or products there are.
     """
 
     def __init__(self, facilities, width=900, height=300, month=None, year=None):
@@ -585,34 +586,12 @@ class ProductAvailabilitySummaryByFacilitySP(ProductAvailabilitySummary):
 
         total = facilities.count()
 
-        products = Product.objects.all().order_by('sms_code')
+        products = list(Product.objects.all().order_by('sms_code'))
         data = []
-        
+        counts = historical_stock_counts(facilities, products, year, month)
         for p in products:
-
-            # once we want to use the cache we can use these to populate
-            # this object, but for now disable it
-            if False:
-                relevant = HistoricalStockCache.objects.filter(product=p,
-                                                               year=year, 
-                                                               month=month)
-                with_stock = relevant.filter(stock__gt=0).count()
-                without_stock = relevant.filter(stock=0).count()
-                without_data = total - with_stock - without_stock
-            else:
-                # TODO This is ludicrously inefficient.
-            
-                with_stock = 0
-                without_stock = 0
-                without_data = 0
-                for f in facilities:
-                    stock = f.historical_stock(p, year, month, default_value=-1)
-                    if stock > 0:
-                        with_stock += 1
-                    elif stock == 0:
-                        without_stock += 1
-                    else:
-                        without_data += 1
+            with_stock, without_stock = counts[p.pk]
+            without_data = total - with_stock - without_stock
             data.append({"product": p,
                          "total": total,
                          "with_stock": with_stock,
@@ -36,6 +36,7 @@ LOGISTICS_USE_LOCATION_SESSIONS = False # keep persistent locations across reque
 LOGISTICS_NAVIGATION_MODE = "url" # "url" or "param", depending how your site navigation works
 LOGISTICS_USE_SPOT_CACHING = False # use spot caches in various places we've found performance hits
 LOGISTICS_SPOT_CACHE_TIMEOUT = 60 * 60 # spot cache timeout, in seconds, defaults to an hour
+LOGISTICS_SPOT_CACHE_LOCK_TIMEOUT = 30 # how long to wait (in seconds) for another process computing a spot cached value
 LOGISTICS_IGNORE_EMPTY_STOCKS = False # if there is no stock, ignore 0 soh values
 LOGISTICS_USE_BACKORDERS = True  # enable back orders or set to false to cancel pending orders on receipt
 
@@ -48,9 +49,45 @@ LOGISTICS_MAX_REPORT_LEVEL_FUNCTION = None
 
 # set to a value (in seconds) to ignore duplicate receipts within that time range
 LOGISTICS_IGNORE_DUPE_RECEIPTS_WITHIN = None
+# how long (in seconds) to remember the text of incoming receipts, to spot 
+# repeats. it's stretched to LOGISTICS_IGNORE_DUPE_RECEIPTS_WITHIN, or the 
+# four hours within which a repeated receipt overrides the max stock levels,
+# if either is longer (see MessageFingerprint.ttl)
+LOGISTICS_MESSAGE_FINGERPRINT_TTL = 24 * 60 * 60
 
 # this is the set of allowable values for STOCKED_BY
 STOCKED_BY_USER='user' # sp's are responsible for reporting commodities registered to specific users
 STOCKED_BY_FACILITY='facility' # sp's are respnsible for reporting commodities registered to specific facilities
 STOCKED_BY_PRODUCT='product' # sp's are responsible for reporting commodities marked as 'is_active'
 LOGISTICS_STOCKED_BY = STOCKED_BY_USER
+
+# this is the set of allowable values for STOCK_COUNTS_BY
+STOCK_COUNTS_BY_PYTHON='python' # walk through every stock, calling the is_* methods on each
+STOCK_COUNTS_BY_SQL='sql' # compute current stock counts with a single grouped query
+STOCK_COUNTS_BY_STATUS_TABLE='status_table' # count rows in the materialized StockStatus table
+# StockStatus is only kept up to date when counting by status table. run 
+# ./manage.py rebuild_stock_status after switching to it, or after changing
+# the stock level policies.
+LOGISTICS_STOCK_COUNTS_BY = STOCK_COUNTS_BY_PYTHON
+
+# this is the set of allowable values for QUEUE_BACKEND, which runs 
+# background work like recalculating auto consumption after a report
+QUEUE_BACKEND_SYNC='sync' # run it straight away, while handling the message
+QUEUE_BACKEND_THREADS='threads' # run it on a pool of LOGISTICS_QUEUE_WORKERS threads in this process
+QUEUE_BACKEND_CELERY='celery' # run it on the celery workers (requires djcelery)
+# the default keeps the old behaviour: the stock report handler still 
+# recalculates auto consumption before it replies, so reports take as long
+# as they used to. set it to threads or celery to reply first.
+LOGISTICS_QUEUE_BACKEND = QUEUE_BACKEND_SYNC
+LOGISTICS_QUEUE_WORKERS = 2
+
+# this is the set of allowable values for OUTBOUND_BACKEND, which sends
+# notifications like stockouts to suppliees (through the outbound queue)
+OUTBOUND_BACKEND_RAPIDSMS='rapidsms' # send them through rapidsms
+OUTBOUND_BACKEND_LOCAL='local' # keep them in logistics.outbound.local_outbox, for tests
+LOGISTICS_OUTBOUND_BACKEND = OUTBOUND_BACKEND_RAPIDSMS
+# the most notifications to send per second through each rapidsms backend,
+# by backend name, e.g. {"gsm": 1}. backends not listed aren't limited.
+# the counts are kept in the cache, so the limit is shared by every process
+# using the same cache backend. with QUEUE_BACKEND_SYNC nothing is held back.
+LOGISTICS_OUTBOUND_RATE_LIMITS = {}
@@ -1,5 +1,7 @@
 from django.db import transaction
 from django.dispatch import Signal
+from rapidsms.conf import settings
+from logistics.commit_hooks import queue_after_commit
 
 stockout_reported = Signal(providing_args=["supply_point", "products", "reported_by"])
 stockout_resolved = Signal(providing_args=["supply_point", "products", "resolved_by"])
@@ -12,13 +14,160 @@ def notify_suppliees_of_stockouts_reported(sender, supply_point, products, repor
     supply_point.notify_suppliees_of_stockouts_reported([p.code for p in products], 
                                                         exclude=None if reported_by is None else [reported_by])
 
-@transaction.commit_on_success
 def post_save_stock_transaction(sender, instance, created, **kwargs):
     from logistics.models import ProductStock
-    ps = ProductStock.objects.get(supply_point=instance.supply_point, 
-                                  product=instance.product)
-    ps.update_auto_consumption()
+    from logistics.queues import consumption_queue
+    if not created:
+        # edits to existing transactions need everything recomputed
+        ProductStock.objects.filter(supply_point=instance.supply_point_id, 
+                                    product=instance.product_id).update(consumption_last_date=None)
+    consumption_queue.put(instance.supply_point_id, instance.product_id)
+
+def post_delete_stock_transaction(sender, instance, **kwargs):
+    from logistics.models import ProductStock
+    # recompute the consumption totals the next time they're needed
+    ProductStock.objects.filter(supply_point=instance.supply_point_id, 
+                                product=instance.product_id).update(consumption_last_date=None)
+
+def default_consumption_changed(sender, instance, **kwargs):
+    from logistics.registries import default_consumptions
+    default_consumptions.invalidate()
+
+def products_changed(sender, instance, **kwargs):
+    from logistics.registries import product_keywords, product_codes, \
+        product_equivalents
+    product_keywords.invalidate()
+    product_codes.invalidate()
+    # deleting a product deletes its equivalents without an m2m_changed signal
+    product_equivalents.invalidate()
+
+def product_equivalents_changed(sender, action, **kwargs):
+    from logistics.registries import product_equivalents
+    if action in ("post_add", "post_remove", "post_clear"):
+        product_equivalents.invalidate()
+
+def contact_roles_changed(sender, **kwargs):
+    from logistics.registries import contact_roles
+    # m2m_changed is sent both before and after each change
+    if kwargs.get("action") in (None, "post_add", "post_remove", "post_clear"):
+        contact_roles.invalidate()
+
+def _refresh_stock_statuses(**filters):
+    """
+    Updates the materialized StockStatus table, if it's in use.
+    """
+    if settings.LOGISTICS_STOCK_COUNTS_BY == settings.STOCK_COUNTS_BY_STATUS_TABLE:
+        from logistics.models import ProductStock
+        from logistics.aggregation import refresh_stock_statuses
+        refresh_stock_statuses(ProductStock.objects.filter(**filters)\
+            .select_related("supply_point", "supply_point__type", "product"))
+
+def post_save_product_stock(sender, instance, **kwargs):
+    if settings.LOGISTICS_STOCK_COUNTS_BY == settings.STOCK_COUNTS_BY_STATUS_TABLE:
+        from logistics.aggregation import refresh_stock_statuses
+        refresh_stock_statuses([instance])
+
+def post_delete_product_stock(sender, instance, **kwargs):
+    if settings.LOGISTICS_STOCK_COUNTS_BY == settings.STOCK_COUNTS_BY_STATUS_TABLE:
+        from logistics.models import StockStatus
+        StockStatus.objects.filter(supply_point=instance.supply_point_id, 
+                                   product=instance.product_id).delete()
+
+def default_consumption_stock_statuses(sender, instance, **kwargs):
+    _refresh_stock_statuses(supply_point__type=instance.supply_point_type_id, 
+                            product=instance.product_id)
+
+def post_save_product(sender, instance, **kwargs):
+    # the average consumption and emergency level both feed into the status
+    _refresh_stock_statuses(product=instance.pk)
+
+def invalidate_supply_point_spot_caches(sender, instance, **kwargs):
+    """
+    Connected to saves of anything that changes a supply point's stock
+    (ProductStock and StockTransaction, which ProductReport.post_save 
+    saves for every report).
+    """
+    instance.supply_point.invalidate_spot_caches()
+
+def _tree_state(instance):
+    """
+    What decides which locations' stock counts a supply point or 
+    location is part of.
+    """
+    from logistics.models import SupplyPoint
+    from logistics.aggregation import _parent_id
+    if isinstance(instance, SupplyPoint):
+        return (instance.active, instance.location_id, instance.type_id)
+    return (instance.is_active, _parent_id(instance), instance.code)
+
+def remember_tree_state(sender, instance, **kwargs):
+    """
+    Connected to post_init of SupplyPoint and Location, so that saves
+    can tell whether they've moved.
+    """
+    instance._tree_state = _tree_state(instance)
+
+def post_save_supply_point(sender, instance, created, **kwargs):
+    """
+    Refreshes the supply point's StockStatus rows if its type (which 
+    decides its default consumptions) or active has changed. Has to be
+    connected before supply_point_moved, which updates the remembered 
+    state.
+    """
+    old = getattr(instance, "_tree_state", None)
+    if not created and old is not None and \
+      (old[0], old[2]) != (instance.active, instance.type_id):
+        _refresh_stock_statuses(supply_point=instance.pk)
+
+def supply_point_moved(sender, instance, **kwargs):
+    """
+    Connected to saves and deletes of SupplyPoint. Bumps the generations
+    of the supply point and every location it was or is now under, if 
+    it's new or gone, or has changed location, type or active.
+    """
+    from logistics.registries import location_tree
+    from logistics.spot_cache import bump_generations
+    old = getattr(instance, "_tree_state", None)
+    new = instance._tree_state = _tree_state(instance)
+    if kwargs.get("created") is False and old == new:
+        return
+    keys = set([instance._generation_key()])
+    for location_id in set([old and old[1], new[1]]):
+        keys.update(location_tree.generation_keys(location_id))
+    bump_generations(keys)
+
+def location_moved(sender, instance, **kwargs):
+    """
+    Connected to saves and deletes of Location. Bumps the generations of
+    the location and every location it was or is now under if its parent,
+    is_active or code has changed (or it's been deleted), and drops the 
+    location tree registry.
+    """
+    from logistics.registries import location_tree
+    from logistics.spot_cache import bump_generations
+    old = getattr(instance, "_tree_state", None)
+    new = instance._tree_state = _tree_state(instance)
+    if kwargs.get("created"):
+        # nothing is under it yet, but it has to be in the tree
+        location_tree.invalidate()
+        return
+    if kwargs.get("created") is False and old == new:
+        return
+    keys = set([instance._generation_key()])
+    for parent_id in set([old and old[1], new[1]]):
+        keys.update(location_tree.generation_keys(parent_id))
+    bump_generations(keys)
+    location_tree.invalidate()
+
+def invalidate_all_spot_caches(sender, **kwargs):
+    """
+    Connected to saves of anything that changes stock levels everywhere,
+    like default consumptions.
+    """
+    from logistics.spot_cache import GLOBAL_GENERATION_KEY, bump_generations
+    bump_generations([GLOBAL_GENERATION_KEY])
 
+@queue_after_commit
 @transaction.commit_on_success
 def post_save_product_report(sender, instance, created, **kwargs):
     """
@@ -0,0 +1,207 @@
+"""
+A thin wrapper around django's cache which counts round-trips to the
+cache backend, so that the cost of spot caching can be measured.
+
+Use it in place of django.core.cache.cache:
+
+    from logistics.spot_cache import cache
+
+Every call counts as one round-trip (get_many and set_many included,
+which is the point of using them). The count is kept per thread, and
+is reset and reported per request (in an X-Cache-Round-Trips response
+header) by logistics.middleware.CacheRoundTripMiddleware, if it's
+added to MIDDLEWARE_CLASSES.
+
+Spot cached values are stored along with the generations of whatever
+they depend on (e.g. a supply point and the global generation). Saving
+a stock bumps the generations of its supply point and every location
+above it, as does moving, activating or deactivating a supply point or
+location, so cached values are never served once they're out of date,
+no matter how long LOGISTICS_SPOT_CACHE_TIMEOUT is. Generations are 
+bumped once the change has been committed (see logistics.commit_hooks).
+"""
+import threading
+import time
+import uuid
+from django.core.cache import cache as _backend
+from logistics.commit_hooks import after_commit
+from rapidsms.conf import settings
+
+_local = threading.local()
+
+def round_trips():
+    """
+    The number of cache round-trips made by this thread since the
+    last reset.
+    """
+    return getattr(_local, "round_trips", 0)
+
+def reset_round_trips():
+    _local.round_trips = 0
+
+def _count():
+    _local.round_trips = round_trips() + 1
+
+
+class CountingCache(object):
+
+    def __init__(self, backend):
+        self._backend = backend
+
+    def get(self, key, default=None):
+        _count()
+        return self._backend.get(key, default)
+
+    def set(self, key, value, timeout=None):
+        _count()
+        return self._backend.set(key, value, timeout)
+
+    def add(self, key, value, timeout=None):
+        _count()
+        return self._backend.add(key, value, timeout)
+
+    def incr(self, key, delta=1):
+        _count()
+        return self._backend.incr(key, delta)
+
+    def delete(self, key):
+        _count()
+        return self._backend.delete(key)
+
+    def get_many(self, keys):
+        _count()
+        return self._backend.get_many(keys)
+
+    def set_many(self, data, timeout=None):
+        _count()
+        return self._backend.set_many(data, timeout)
+
+    def __getattr__(self, name):
+        return getattr(self._backend, name)
+
+cache = CountingCache(_backend)
+
+
+# generations are kept for as long as memcached allows
+GENERATION_TIMEOUT = 30 * 24 * 60 * 60
+
+# bumped when something that affects every supply point changes,
+# like default consumptions
+GLOBAL_GENERATION_KEY = "gen-global"
+
+# how often to check whether someone else has finished computing a value
+LOCK_POLL_INTERVAL = 0.1
+
+def _new_generation():
+    # start new (or evicted) generations from the clock, in milliseconds,
+    # so that a generation that drops out of the cache never comes back 
+    # with a value it has had before
+    return int(time.time() * 1000)
+
+def _replace_generations(keys):
+    # generations are only compared, never counted, so a new one
+    # just has to be different from anything it's been before
+    cache.set_many(dict((key, uuid.uuid4().hex) for key in keys), GENERATION_TIMEOUT)
+
+def bump_generations(keys):
+    """
+    Bumps each of the generations, so that nothing cached under 
+    their current values is used again, in one round-trip. Inside 
+    queue_after_commit the bump waits for the commit: bumped any 
+    earlier, another process could compute from the old rows under 
+    the new generation and cache them as fresh.
+    """
+    keys = list(keys)
+    if keys:
+        after_commit(_replace_generations, keys)
+
+def _generations(keys, found):
+    """
+    Returns the tuple of generations for the keys, given what was found
+    in the cache, starting any that weren't there.
+    """
+    generations = []
+    for key in keys:
+        if key not in found:
+            generation = _new_generation()
+            if not cache.add(key, generation, GENERATION_TIMEOUT):
+                generation = cache.get(key, generation)
+            found[key] = generation
+        generations.append(found[key])
+    return tuple(generations)
+
+def get_generations(keys):
+    """
+    Returns the current generations for the keys, as a tuple, 
+    in one round-trip (unless any have to be started).
+    """
+    keys = list(keys)
+    return _generations(keys, cache.get_many(keys))
+
+def get_fresh_many(keys_to_generation_keys):
+    """
+    Takes a dictionary of cache keys to the generation keys their 
+    values depend on. Returns a dictionary of the values which are 
+    cached and still fresh, reading everything in one round-trip.
+    """
+    generation_keys = set()
+    for keys in keys_to_generation_keys.values():
+        generation_keys.update(keys)
+    found = cache.get_many(list(keys_to_generation_keys) + list(generation_keys))
+    fresh = {}
+    for key, keys in keys_to_generation_keys.items():
+        cached = found.get(key)
+        if cached is not None and cached[0] == _generations(keys, found):
+            fresh[key] = cached[1]
+    return fresh
+
+def set_fresh_many(values, generations, timeout=None):
+    """
+    Caches values (a dictionary keyed by cache key) along with the 
+    generations (a dictionary of generation tuples, by the same keys) 
+    that were current when the values started being computed.
+    """
+    if timeout is None:
+        timeout = settings.LOGISTICS_SPOT_CACHE_TIMEOUT
+    cache.set_many(dict((key, (generations[key], value)) for key, value in values.items()), 
+                   timeout)
+
+def get_or_compute(key, generation_keys, compute, timeout=None):
+    """
+    Returns the value cached under key, as long as none of the 
+    generations it depends on have been bumped since it was cached. 
+    Otherwise calls compute() and caches the result.
+    
+    When many processes miss the same key at once only one of them 
+    computes it; the others wait (for up to LOGISTICS_SPOT_CACHE_LOCK_TIMEOUT
+    seconds) and use its result.
+    """
+    if timeout is None:
+        timeout = settings.LOGISTICS_SPOT_CACHE_TIMEOUT
+    generation_keys = list(generation_keys)
+    found = cache.get_many([key] + generation_keys)
+    # read before computing, so that a bump while we're computing
+    # leaves the result looking stale rather than fresh
+    generations = _generations(generation_keys, found)
+    cached = found.get(key)
+    if cached is not None and cached[0] == generations:
+        return cached[1]
+    
+    lock_key = "%s-lock" % key
+    lock_timeout = settings.LOGISTICS_SPOT_CACHE_LOCK_TIMEOUT
+    if cache.add(lock_key, 1, lock_timeout):
+        try:
+            value = compute()
+            cache.set(key, (generations, value), timeout)
+        finally:
+            cache.delete(lock_key)
+        return value
+    
+    deadline = time.time() + lock_timeout
+    while time.time() < deadline:
+        time.sleep(LOCK_POLL_INTERVAL)
+        cached = cache.get(key)
+        if cached is not None and cached[0] == generations:
+            return cached[1]
+    # whoever had the lock is taking too long, or died
+    return compute()
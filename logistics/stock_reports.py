@@ -0,0 +1,207 @@
+"""
+Saving a stock report for many products with a fixed number of writes.
+
+Saving product reports one at a time (SupplyPoint.report()) runs
+ProductReport.post_save for each of them, which saves the supply point,
+looks up and saves the stock and saves a StockTransaction, whose own
+signals then go back to the stock. A ReportBatch loads every stock and
+report type it needs up front, works out the balances in memory and
+writes the reports, stocks and transactions in bulk, in a single
+transaction. On postgres that's a constant number of queries however
+many products are reported; other databases can't return the ids of a
+multi-row insert, so there it's one insert per row.
+
+Afterwards it sends the post_save signals that saving them one at a
+time would have, for everything else that listens to them. Those
+handlers still run their own queries for each report, so the save as
+a whole grows with the number of products.
+
+Once a report is saved, the replies to it are all worked out from a 
+ReportContext, which loads the stocks they look at in a fixed number 
+of queries.
+"""
+from datetime import datetime
+from django.db import connection, transaction
+from django.db.models import AutoField
+from django.db.models.signals import post_save
+from rapidsms.conf import settings
+from logistics.balances import _ids
+from logistics.registries import product_equivalents
+
+def _insert_many(model, objects):
+    """
+    Inserts the (unsaved) objects without sending any signals, and sets 
+    their primary keys. Where the database can return the ids from an
+    insert (postgres) that's a single INSERT ... RETURNING, otherwise it's
+    one INSERT per object.
+    """
+    if not objects:
+        return
+    qn = connection.ops.quote_name
+    fields = [f for f in model._meta.local_fields if not isinstance(f, AutoField)]
+    sql = "INSERT INTO %s (%s) VALUES " % \
+        (qn(model._meta.db_table), ", ".join(qn(f.column) for f in fields))
+    row = "(%s)" % ", ".join(["%s"] * len(fields))
+    values = [[f.get_db_prep_save(f.pre_save(obj, True), connection=connection) \
+               for f in fields] for obj in objects]
+    cursor = connection.cursor()
+    if connection.features.can_return_id_from_insert:
+        cursor.execute(sql + ", ".join([row] * len(objects)) + \
+                       " RETURNING %s" % qn(model._meta.pk.column),
+                       [value for params in values for value in params])
+        # the ids come back in the order the rows were given
+        pks = [pk for pk, in cursor.fetchall()]
+    else:
+        pks = []
+        for params in values:
+            cursor.execute(sql + row, params)
+            pks.append(connection.ops.last_insert_id(cursor, model._meta.db_table, 
+                                                     model._meta.pk.column))
+    for obj, pk in zip(objects, pks):
+        obj.pk = pk
+
+class ReportBatch(object):
+    """
+    Product reports for a single supply point, all made at the same time,
+    saved as if each had been saved in turn with SupplyPoint.report().
+    """
+
+    def __init__(self, supply_point, products, message=None, date=None):
+        """
+        products are all the products that will be reported on (a
+        queryset, or a list of objects).
+        """
+        from logistics.models import ProductStock, ProductReportType
+        self.supply_point = supply_point
+        self.message = message
+        self.date = date or datetime.utcnow()
+        products = dict((product.pk, product) for product in products)
+        self._stocks = {}
+        for stock in ProductStock.objects.filter(supply_point=supply_point,
+                                                 product__in=_ids(products.values())):
+            stock.supply_point = supply_point
+            stock.product = products[stock.product_id]
+            self._stocks[stock.product_id] = stock
+        self._report_types = dict((report_type.code, report_type) for report_type in \
+                                  ProductReportType.objects.all())
+        self._new_stocks = []
+        # (report, stock, transaction, whether the stock was new) for each report
+        self._entries = []
+
+    def stock(self, product):
+        """
+        The ProductStock for the product, as of the reports added so far,
+        or None if there isn't one yet.
+        """
+        return self._stocks.get(product.pk)
+
+    def add(self, product, report_type, quantity):
+        """
+        Adds a report, updating the stock (in memory) the same way
+        ProductReport.post_save would. report_type is a report type code.
+        Returns the (unsaved) ProductReport.
+        """
+        from logistics.models import ProductStock, ProductReport, ProductReportType, \
+            StockTransaction
+        try:
+            report_type = self._report_types[report_type]
+        except KeyError:
+            raise ProductReportType.DoesNotExist("No report type %s" % report_type)
+        report = ProductReport(product=product, report_type=report_type, quantity=quantity,
+                               message=self.message, supply_point=self.supply_point,
+                               report_date=self.date)
+        stock = self.stock(product)
+        created = stock is None
+        if created:
+            stock = ProductStock(is_active=settings.LOGISTICS_DEFAULT_PRODUCT_ACTIVATION_STATUS,
+                                 supply_point=self.supply_point, product=product)
+            self._stocks[product.pk] = stock
+            self._new_stocks.append(stock)
+        beginning_balance = stock.quantity if stock.quantity is not None else 0
+        st = StockTransaction.from_product_report(report, beginning_balance)
+        stock.quantity = st.ending_balance
+        stock.last_modified = datetime.utcnow()
+        self._entries.append((report, stock, st, created))
+        return report
+
+    @transaction.commit_on_success
+    def _write(self):
+        from logistics.models import ProductStock, ProductReport, StockTransaction
+        self.supply_point.last_reported = datetime.utcnow()
+        self.supply_point.save()
+
+        _insert_many(ProductStock, self._new_stocks)
+        new_pks = set(stock.pk for stock in self._new_stocks)
+        updated = dict((stock.pk, stock) for _, stock, _, created in self._entries \
+                       if not created and stock.pk not in new_pks).values()
+        if updated:
+            qn = connection.ops.quote_name
+            column = lambda field: qn(ProductStock._meta.get_field(field).column)
+            connection.cursor().executemany("UPDATE %s SET %s = %%s, %s = %%s WHERE %s = %%s" % \
+                                            (qn(ProductStock._meta.db_table), column("quantity"),
+                                             column("last_modified"), column("id")),
+                                            [(stock.quantity, connection.ops.value_to_db_datetime(stock.last_modified),
+                                              stock.pk) for stock in updated])
+
+        reports = [report for report, _, _, _ in self._entries]
+        _insert_many(ProductReport, reports)
+
+        transactions = []
+        for report, _, st, _ in self._entries:
+            st.product_report = report
+            transactions.append(st)
+        _insert_many(StockTransaction, transactions)
+        transaction.set_dirty()
+
+    def save(self):
+        """
+        Writes everything that's been added, then sends the post_save
+        signals for each report, stock and transaction in turn. Returns
+        the saved reports.
+        """
+        from logistics.models import ProductStock, ProductReport, StockTransaction
+        if not self._entries:
+            return []
+        self._write()
+        for report, stock, st, created in self._entries:
+            # ProductReport.post_save would otherwise do it all again
+            report._stock_recorded = True
+            post_save.send(sender=ProductReport, instance=report, created=True, raw=False)
+            post_save.send(sender=ProductStock, instance=stock, created=created, raw=False)
+            post_save.send(sender=StockTransaction, instance=st, created=True, raw=False)
+        return [report for report, _, _, _ in self._entries]
+
+
+class ReportContext(object):
+    """
+    Every stock at a supply point (with its product), for working out the
+    replies to a report. Each stock is only loaded once, so its levels are
+    only resolved once, however many of the replies look at it.
+    """
+
+    def __init__(self, supply_point):
+        from logistics.models import ProductStock
+        self.supply_point = supply_point
+        self.stocks = list(ProductStock.objects.filter(supply_point=supply_point)\
+                           .select_related("product").order_by("pk"))
+        self._stocks = {}
+        for stock in self.stocks:
+            stock.supply_point = supply_point
+            self._stocks[stock.product_id] = stock
+
+    def stock(self, product):
+        """
+        The product's stock at the supply point, or None if it has none.
+        """
+        return self._stocks.get(product.pk)
+
+    def equivalent_stocks(self, product):
+        """
+        The stocks at the supply point of every product equivalent to 
+        the product (see ProductEquivalentsRegistry), if 
+        LOGISTICS_USE_COMMODITY_EQUIVALENTS is on.
+        """
+        if not getattr(settings, "LOGISTICS_USE_COMMODITY_EQUIVALENTS", False):
+            return []
+        return [self._stocks[pk] for pk in sorted(product_equivalents.get(product.pk)) \
+                if pk in self._stocks]
@@ -0,0 +1,9 @@
+from celery.decorators import task
+
+@task
+def run_queued(name, key):
+    """
+    Runs work queued on a logistics.queues.WorkQueue.
+    """
+    from logistics.queues import WorkQueue
+    WorkQueue.get(name).run_queued(*key)
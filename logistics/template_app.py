@@ -11,10 +11,11 @@ from rapidsms.conf import settings
 from django.utils.importlib import import_module
 from django.utils.translation import ugettext as _
 from rapidsms.apps.base import AppBase
-from logistics.models import Product, ProductReportsHelper
+from logistics.models import ProductReportsHelper
 from logistics.errors import UnknownCommodityCodeError
 from logistics.const import Reports
 from logistics.util import config
+from logistics.registries import product_keywords
 
 class App(AppBase):
 
@@ -193,13 +194,7 @@ class App(AppBase):
         if not settings.LOGISTICS_AGGRESSIVE_SOH_PARSING:
             return message.text.lower().startswith(Reports.SOH) 
         else:
-            keywords = [Reports.SOH]
-            keywords.extend(Product.objects.values_list('sms_code', flat=True).order_by('sms_code'))
-            text = message.text.lower()
-            for keyword in keywords:
-                if text.startswith(keyword):
-                    return True
-            return False
+            return product_keywords.matches(message.text.lower())
 
         
     def _clean_message(self, text):
@@ -20,7 +20,8 @@ from logistics.config import messagelog
 import logging
 from rapidsms.models import Contact
 from logistics.models import transactions_before_or_during
-from django.core.cache import cache
+from logistics.spot_cache import get_or_compute
+from logistics.balances import BalanceIndex
 
 Message = messagelog.models.Message
 register = template.Library()
@@ -186,10 +187,12 @@ def order_fill_stats(locations, type=None, datespan=None):
 def stockonhand_table(supply_point, datespan=None):
     if datespan is None:
         datespan = DateSpan.since(settings.LOGISTICS_REPORTING_CYCLE_IN_DAYS)
-    sohs = supply_point.stocked_productstocks().order_by('product__name')
+    sohs = supply_point.stocked_productstocks().order_by('product__name').select_related('product')
     # update the stock quantities to match whatever reporting period has been specified
+    balances = BalanceIndex([supply_point], [soh.product for soh in sohs])
     for soh in sohs: 
-        soh.quantity = supply_point.historical_stock_by_date(soh.product, datespan.end_of_end_day)
+        soh.quantity = balances.historical_stock_by_date(supply_point, soh.product, 
+                                                         datespan.end_of_end_day)
     return r_2_s_helper("logistics/partials/stockonhand_table_full.html", 
                          {"stockonhands": sohs, 
                           "datespan": datespan})
@@ -279,21 +282,14 @@ def historical_months_of_stock(supply_point, product, year, month, default_value
             return ("log-historical_months_of_stock-%(supply_point)s-%(product)s-%(year)s-%(month)s-%(default)s" % \
                     {"supply_point": supply_point.code, "product": product.sms_code, 
                      "year": year, "month": month, "default": default_value}).replace(" ", "-")
-    key = _cache_key()
-    if settings.LOGISTICS_USE_SPOT_CACHING: 
-        from_cache = cache.get(key)
-        if from_cache:
-            return from_cache
-            
-        
-    srs = transactions_before_or_during(year, month).\
-                filter(supply_point=supply_point, product=product).order_by("-date")
-    if srs.exists():
-        val = ProductStock.objects.get(supply_point=supply_point, product=product)\
-                    .calculate_months_remaining(srs[0].ending_balance)
-        ret = _months_or_default(val, default_value)
-    else: 
-        ret = default_value
+    def _compute():
+        srs = transactions_before_or_during(year, month).\
+                    filter(supply_point=supply_point, product=product).order_by("-date")
+        if srs.exists():
+            val = ProductStock.objects.get(supply_point=supply_point, product=product)\
+                        .calculate_months_remaining(srs[0].ending_balance)
+            return _months_or_default(val, default_value)
+        return default_value
     if settings.LOGISTICS_USE_SPOT_CACHING: 
-            cache.set(key, ret, settings.LOGISTICS_SPOT_CACHE_TIMEOUT)
-    return ret
+        return get_or_compute(_cache_key(), supply_point._cache_generation_keys(), _compute)
+    return _compute()
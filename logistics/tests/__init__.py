@@ -1 +1,9 @@
 from consumption import *
+from stock_counts import *
+from balances import *
+from queues import *
+from registries import *
+from parsing import *
+from stock_reports import *
+from outbound import *
+from fingerprints import *
@@ -0,0 +1,206 @@
+from datetime import datetime, timedelta
+from django.core.management import call_command
+from rapidsms.conf import settings
+from rapidsms.tests.scripted import TestScript
+from logistics.models import SupplyPoint, Product, StockTransaction, \
+    HistoricalStockCache, HistoricalStockCacheRun
+from logistics.balances import BalanceIndex, balances_as_of, end_of_day, \
+    fill_historical_stock_cache, historical_stock_counts
+from logistics.reports import ProductAvailabilitySummaryByFacilitySP
+from rapidsms.contrib.locations.models import Location
+from logistics.const import Reports
+from logistics.tests.util import load_test_data, fake_report
+
+class TestBalanceIndex(TestScript):
+    
+    def setUp(self):
+        TestScript.setUp(self)
+        load_test_data()
+        self.sp = SupplyPoint.objects.get(code='dedh')
+        self.ov = Product.objects.get(sms_code='ov')
+        self.ml = Product.objects.get(sms_code='ml')
+        self.products = [self.ov, self.ml]
+        
+    def _make_transactions(self):
+        ov, ml = self.ov, self.ml
+        for amount, days_ago in [(30, 95), (20, 64), (10, 40), (15, 33), (5, 33), (0, 2)]:
+            fake_report(self.sp, ov, amount, days_ago, Reports.SOH)
+        fake_report(self.sp, ml, 10, 50, Reports.SOH)
+        fake_report(self.sp, ml, 12, 0, Reports.REC)
+        # two transactions at exactly the same time, which are broken by pk
+        same_time = datetime.utcnow() - timedelta(days=20)
+        StockTransaction.objects.filter(product=ov, ending_balance__in=[15, 5]).update(date=same_time)
+        
+    def testMatchesQueries(self):
+        self._make_transactions()
+        balances = BalanceIndex([self.sp], self.products)
+        today = datetime.utcnow()
+        for product in self.products:
+            for days_ago in range(0, 120, 3):
+                date = today - timedelta(days=days_ago)
+                self.assertEqual(self.sp.historical_stock_by_date(product, date), 
+                                 balances.historical_stock_by_date(self.sp, product, date))
+                self.assertEqual(self.sp.historical_stock(product, date.year, date.month, -1), 
+                                 balances.historical_stock(self.sp, product, date.year, 
+                                                           date.month, -1))
+    
+    def testNoTransactions(self):
+        balances = BalanceIndex([self.sp])
+        today = datetime.utcnow()
+        self.assertFalse(balances.has_transactions(self.sp, self.ov))
+        self.assertEqual(-1, balances.historical_stock(self.sp, self.ov, 
+                                                       today.year, today.month, -1))
+        self.assertEqual(None, balances.balance_as_of(self.sp, self.ov, today))
+        
+    def testBeforeAndAsOf(self):
+        self._make_transactions()
+        ov = self.ov
+        date = StockTransaction.objects.filter(product=ov, ending_balance=10)[0].date
+        balances = BalanceIndex([self.sp], [ov])
+        self.assertEqual(20, balances.balance_before(self.sp, ov, date))
+        self.assertEqual(10, balances.balance_as_of(self.sp, ov, date))
+
+    def testBalancesAsOf(self):
+        self._make_transactions()
+        today = datetime.utcnow()
+        country = Location.objects.get(code=settings.COUNTRY)
+        for days_ago in range(0, 120, 3):
+            date = today - timedelta(days=days_ago)
+            expected = {}
+            for product in self.products:
+                balance = self.sp.historical_stock_by_date(product, date, default_value=None)
+                if balance is not None:
+                    expected[(self.sp.pk, product.pk)] = balance
+            self.assertEqual(expected, country.balances_as_of(end_of_day(date)))
+            self.assertEqual(expected, SupplyPoint.objects.filter(code='dedh')\
+                                            .balances_as_of(end_of_day(date)))
+            self.assertEqual(dict((k, v) for k, v in expected.items() if k[1] == self.ov.pk),
+                             balances_as_of([self.sp], end_of_day(date), [self.ov]))
+
+
+class TestPopulateHistoricalStockCache(TestScript):
+    
+    def setUp(self):
+        TestScript.setUp(self)
+        load_test_data()
+        self.sp = SupplyPoint.objects.get(code='dedh')
+        self.ov = Product.objects.get(sms_code='ov')
+        
+    def _assert_cache_matches(self):
+        cached = HistoricalStockCache.objects.filter(supply_point=self.sp, product=self.ov)
+        self.assertTrue(cached.count() > 0)
+        for row in cached:
+            self.assertEqual(self.sp.historical_stock(self.ov, row.year, row.month), row.stock)
+        # no duplicates
+        self.assertEqual(cached.count(), len(set(cached.values_list("year", "month"))))
+    
+    def testIncremental(self):
+        fake_report(self.sp, self.ov, 30, 95, Reports.SOH)
+        fake_report(self.sp, self.ov, 20, 40, Reports.SOH)
+        call_command("populate_historical_stock_cache")
+        self._assert_cache_matches()
+        run = HistoricalStockCacheRun.objects.get()
+        self.assertTrue(run.is_full)
+        self.assertEqual(StockTransaction.objects.order_by("-pk")[0].pk, run.last_transaction_id)
+        
+        # a backdated report changes the months after it
+        fake_report(self.sp, self.ov, 25, 70, Reports.SOH)
+        call_command("populate_historical_stock_cache")
+        self._assert_cache_matches()
+        self.assertFalse(HistoricalStockCacheRun.objects.order_by("-pk")[0].is_full)
+        
+        # nothing new, nothing written
+        call_command("populate_historical_stock_cache")
+        self.assertEqual(0, HistoricalStockCacheRun.objects.order_by("-pk")[0].rows_written)
+        
+        # the current month is still changing, so it's never cached
+        now = datetime.utcnow()
+        self.assertFalse(HistoricalStockCache.objects.filter(year=now.year, month=now.month).exists())
+        
+        # months that end after a run are filled in by the next one, 
+        # even for stocks without new transactions
+        last_month = now.replace(day=1) - timedelta(days=1)
+        HistoricalStockCache.objects.filter(year=last_month.year, month=last_month.month).delete()
+        HistoricalStockCacheRun.objects.update(started=last_month)
+        call_command("populate_historical_stock_cache")
+        self.assertTrue(HistoricalStockCache.objects.filter(supply_point=self.sp, product=self.ov,
+                                                            year=last_month.year, 
+                                                            month=last_month.month).exists())
+        self._assert_cache_matches()
+    
+    def testLateCommit(self):
+        # a transaction that's given a lower id than the last run went up
+        # to, but commits after it
+        gap = fake_report(self.sp, self.ov, 30, 95, Reports.SOH)[0]
+        gap_id = gap.pk
+        gap.delete()
+        fake_report(self.sp, self.ov, 20, 40, Reports.SOH)
+        call_command("populate_historical_stock_cache")
+        StockTransaction(pk=gap_id, supply_point=self.sp, product=self.ov, quantity=0, 
+                         beginning_balance=0, ending_balance=50, 
+                         date=datetime.utcnow() - timedelta(days=70),
+                         report_type_code=Reports.SOH).save()
+        call_command("populate_historical_stock_cache")
+        self._assert_cache_matches()
+
+
+class TestHistoricalStockCounts(TestScript):
+    
+    def setUp(self):
+        TestScript.setUp(self)
+        load_test_data()
+        self.sp = SupplyPoint.objects.get(code='dedh')
+        self.ov = Product.objects.get(sms_code='ov')
+        self.ml = Product.objects.get(sms_code='ml')
+        fake_report(self.sp, self.ov, 10, 70, Reports.SOH)
+        fake_report(self.sp, self.ml, 0, 70, Reports.SOH)
+        last_month = datetime.utcnow().replace(day=1) - timedelta(days=1)
+        self.year, self.month = last_month.year, last_month.month
+        
+    def testFillsMissingMonths(self):
+        facilities = SupplyPoint.objects.all()
+        products = Product.objects.all()
+        expected = facilities.count() * products.count()
+        self.assertEqual(expected, fill_historical_stock_cache(facilities, products, self.year, self.month))
+        self.assertEqual(0, fill_historical_stock_cache(facilities, products, self.year, self.month))
+        cached = HistoricalStockCache.objects.filter(year=self.year, month=self.month)
+        self.assertEqual(expected, cached.count())
+        self.assertEqual(10, cached.get(supply_point=self.sp, product=self.ov).stock)
+        # no transactions means no data, not a stockout
+        self.assertEqual(None, cached.exclude(supply_point=self.sp)[0].stock)
+    
+    def testRecomputesIncompleteMonths(self):
+        facilities = SupplyPoint.objects.all()
+        products = Product.objects.all()
+        fill_historical_stock_cache(facilities, products, self.year, self.month)
+        cached = HistoricalStockCache.objects.filter(year=self.year, month=self.month)
+        # cached part-way through the month, before the report came in
+        cached.filter(supply_point=self.sp, product=self.ov)\
+            .update(stock=None, computed=datetime(self.year, self.month, 2))
+        # cached before the time was recorded
+        cached.filter(supply_point=self.sp, product=self.ml).update(stock=None, computed=None)
+        self.assertEqual(2, fill_historical_stock_cache(facilities, products, self.year, self.month))
+        self.assertEqual(10, cached.get(supply_point=self.sp, product=self.ov).stock)
+        self.assertEqual(0, cached.get(supply_point=self.sp, product=self.ml).stock)
+        self.assertEqual(0, fill_historical_stock_cache(facilities, products, self.year, self.month))
+    
+    def testCountsMatchBalances(self):
+        facilities = SupplyPoint.objects.all()
+        products = Product.objects.all()
+        balances = BalanceIndex(facilities, products)
+        for year, month in ((self.year, self.month), 
+                            (datetime.utcnow().year, datetime.utcnow().month)):
+            counts = historical_stock_counts(facilities, products, year, month)
+            for p in products:
+                stocks = [balances.historical_stock(f, p, year, month, default_value=None) \
+                          for f in facilities]
+                self.assertEqual((len([s for s in stocks if s > 0]), stocks.count(0)), 
+                                 counts[p.pk])
+        
+        summary = ProductAvailabilitySummaryByFacilitySP(facilities, year=self.year, month=self.month)
+        for row in summary.data:
+            self.assertEqual(facilities.count(), row["total"])
+            if row["product"] == self.ov:
+                self.assertEqual((1, 0), (row["with_stock"], row["without_stock"]))
+            elif row["product"] == self.ml:
+                self.assertEqual((0, 1), (row["with_stock"], row["without_stock"]))
@@ -1,4 +1,4 @@
-from datetime import timedelta
+from datetime import datetime, timedelta
 from rapidsms.conf import settings
 from django.core.cache import cache
 from rapidsms.tests.scripted import TestScript
@@ -8,6 +8,10 @@ from logistics.models import Location, SupplyPointType, SupplyPoint, \
 from logistics.models import SupplyPoint as Facility
 from logistics.tests.util import load_test_data, fake_report
 from logistics.const import Reports
+from logistics.registries import default_consumptions, check_registries, \
+    end_registry_checks
+from logistics.consumption import update_auto_consumptions, auto_monthly_consumption, \
+    ConsumptionAccumulator, ConsumptionCalculator, TRANSACTION_FIELDS, TRANSACTION_ORDER
 
 class TestConsumption (TestScript):
     def setUp(self):
@@ -392,43 +396,185 @@ class TestConsumption (TestScript):
         self.assertEquals(1, self.ps.daily_consumption)
 
     def testFacilityTypeConsumption(self):
-        # verify that, for different states of the cache, the right value gets returned
+        # verify that, as defaults change, the right value gets returned
         cache.set("test", "cache_active")
         self.assertEqual("cache_active", cache.get("test"), 
                          "This test depends on caching, "
                          "which does not appear to be enabled!")
         MONTHLY_CONSUMPTION = 13
-        cache_key = self.sp.type._cache_key(self.pr.code)
-        self.pr, self.sp
         self.ps.manual_monthly_consumption = None
         self.ps.save()
+        # test case 1: no default, returns None
+        self.assertEquals(None, self.sp.type.monthly_consumption_by_product(self.pr))
+        
+        # test case 2: saving a default invalidates the registry
         dmc = DefaultMonthlyConsumption(supply_point_type = self.sp.type,
                                         product = self.pr, 
                                         default_monthly_consumption = MONTHLY_CONSUMPTION)
         dmc.save()
-        # test case 1: empty cache, make sure it gets populated
-        cache.delete(cache_key)
-        self.assertEquals(None, cache.get(cache_key))
         monthly_consumption_by_product = self.sp.type.monthly_consumption_by_product(self.pr)
         self.assertEquals(monthly_consumption_by_product, MONTHLY_CONSUMPTION)
-        self.assertEquals(cache.get(cache_key), MONTHLY_CONSUMPTION)
-        # test case 2: populate cache, returns the value, no cache refresh.
-        self.assertEquals(cache.get(cache_key), MONTHLY_CONSUMPTION)
-
-        # test case 3: populate the cache with none, return None
-        dmc = DefaultMonthlyConsumption.objects.get(supply_point_type = self.sp.type,
-                                                    product = self.pr)
+        
+        # test case 3: a change made by another process (no signal here) is 
+        # picked up as soon as the shared version changes
+        DefaultMonthlyConsumption.objects.filter(pk=dmc.pk).update(default_monthly_consumption=17)
+        self.assertEquals(self.sp.type.monthly_consumption_by_product(self.pr), MONTHLY_CONSUMPTION)
+        cache.set(default_consumptions.version_key, "changed-elsewhere")
+        self.assertEquals(self.sp.type.monthly_consumption_by_product(self.pr), 17)
+        
+        # ... and within a web request, by the next request
+        check_registries(None)
+        try:
+            self.assertEquals(self.sp.type.monthly_consumption_by_product(self.pr), 17)
+            DefaultMonthlyConsumption.objects.filter(pk=dmc.pk).update(default_monthly_consumption=19)
+            cache.set(default_consumptions.version_key, "changed-elsewhere-again")
+            self.assertEquals(self.sp.type.monthly_consumption_by_product(self.pr), 17)
+        finally:
+            end_registry_checks(None)
+        check_registries(None)
+        try:
+            self.assertEquals(self.sp.type.monthly_consumption_by_product(self.pr), 19)
+        finally:
+            end_registry_checks(None)
+        
+        # test case 4: deleting the default invalidates the registry
         dmc.delete()
-        cache.delete(cache_key)
-        self.assertEquals(None, cache.get(cache_key))
         monthly_consumption_by_product = self.sp.type.monthly_consumption_by_product(self.pr)
         self.assertEquals(monthly_consumption_by_product, None)
-        # self.assertEquals(cache.get(cache_key), NONE_VALUE) 
-        # test case 4: cache populated with None, continues to return None
-        monthly_consumption_by_product = self.sp.type.monthly_consumption_by_product(self.pr)
-        self.assertEquals(monthly_consumption_by_product, None)
-
 
+    def testIncrementalConsumption(self):
+        # each new report is added to the running totals, which always 
+        # agree with going through the whole history
+        for amount, days_ago, report_type in ((200, 60, Reports.SOH), (150, 50, Reports.SOH),
+                                              (40, 45, Reports.REC), (120, 40, Reports.SOH),
+                                              (0, 35, Reports.SOH), (100, 30, Reports.SOH),
+                                              (60, 20, Reports.SOH), (30, 10, Reports.SOH)):
+            self._report(amount, days_ago, report_type)
+            ps = ProductStock.objects.get(pk=self.ps.pk)
+            self.assertEquals(StockTransaction.objects.filter(supply_point=self.sp, 
+                                                              product=self.pr).count(),
+                              ps.consumption_transactions)
+            self.assertEquals(ps.daily_consumption, 
+                              ConsumptionAccumulator(ps).daily_consumption)
+        self.assertEquals(auto_monthly_consumption(ps.daily_consumption), 
+                          ps.auto_monthly_consumption)
+        
+        # a backdated transaction means starting over
+        st = StockTransaction.objects.filter(supply_point=self.sp, product=self.pr).order_by("date")[0]
+        self.assertFalse(ConsumptionAccumulator(ps).can_add(st.date))
+        st.date = st.date - timedelta(days=10)
+        st.save()
+        ps = ProductStock.objects.get(pk=self.ps.pk)
+        self.assertEquals(ps.daily_consumption, ConsumptionAccumulator(ps).daily_consumption)
+        
+        # as does the lookback window moving
+        settings.LOGISTICS_CONSUMPTION["LOOKBACK_DAYS"] = 25
+        self.assertFalse(ConsumptionAccumulator(ps).can_add(datetime.utcnow()))
+        accumulator = ConsumptionAccumulator(ps)
+        accumulator.recompute()
+        self.assertEquals(ps.consumption_transactions, 
+                          StockTransaction.objects.filter(supply_point=self.sp, 
+                                                          product=self.pr).count())
+        self.assertEquals(ps.daily_consumption, accumulator.daily_consumption)
+        
+    def testLateCommitIsCounted(self):
+        # a transaction with a lower id than the last one added, as when 
+        # its transaction commits after a later one's
+        gap = StockTransaction.objects.create(supply_point=self.sp, product=self.pr, 
+                                              quantity=0, beginning_balance=0, 
+                                              ending_balance=0)
+        gap_id = gap.pk
+        gap.delete()
+        for amount, days_ago in ((200, 60), (150, 50), (120, 40)):
+            self._report(amount, days_ago, Reports.SOH)
+        StockTransaction(pk=gap_id, supply_point=self.sp, product=self.pr, quantity=-30, 
+                         beginning_balance=120, ending_balance=90, 
+                         date=datetime.utcnow() - timedelta(days=30),
+                         report_type_code=Reports.SOH).save()
+        ps = ProductStock.objects.get(pk=self.ps.pk)
+        self.assertEquals(4, ps.consumption_transactions)
+        accumulator = ConsumptionAccumulator(ps)
+        accumulator.recompute()
+        self.assertEquals(ps.daily_consumption, accumulator.daily_consumption)
+    
+    def testIncrementalConsumptionWithLookback(self):
+        settings.LOGISTICS_CONSUMPTION["LOOKBACK_DAYS"] = 45
+        for amount, days_ago, report_type in ((200, 60, Reports.SOH), (150, 50, Reports.SOH),
+                                              (40, 45, Reports.REC), (120, 40, Reports.SOH),
+                                              (100, 30, Reports.SOH), (60, 20, Reports.SOH)):
+            self._report(amount, days_ago, report_type)
+        ps = ProductStock.objects.get(pk=self.ps.pk)
+        # the window started inside the first counted period, so new 
+        # reports are still added to the totals
+        self.assertTrue(ps.consumption_since < ConsumptionAccumulator(ps).cutoff_date)
+        self.assertTrue(ConsumptionAccumulator(ps).can_add(datetime.utcnow()))
+        window_start = ps.consumption_window_start
+        self._report(30, 10, Reports.SOH)
+        ps = ProductStock.objects.get(pk=self.ps.pk)
+        # (a recompute would have started a new window)
+        self.assertEquals(window_start, ps.consumption_window_start)
+        self.assertEquals(ps.daily_consumption, ConsumptionAccumulator(ps).daily_consumption)
+        
+        # as the window moves, the first period is rescaled...
+        txs = StockTransaction.objects.filter(supply_point=self.sp, product=self.pr)\
+            .order_by(*TRANSACTION_ORDER).values_list(*TRANSACTION_FIELDS)
+        for days in (1, 3, 4):
+            cutoff = datetime.utcnow() - timedelta(days=45 - days)
+            calculator = ConsumptionCalculator(cutoff_date=cutoff)
+            for values in txs:
+                calculator.add(*values)
+            accumulator = ConsumptionAccumulator(ps, cutoff_date=cutoff)
+            self.assertTrue(accumulator.can_add(datetime.utcnow()))
+            self.assertAlmostEquals(calculator.daily_consumption, accumulator.daily_consumption, 1)
+        # ... until it's passed, when everything is recomputed
+        self.assertFalse(ConsumptionAccumulator(ps, cutoff_date=datetime.utcnow() - timedelta(days=39))\
+                         .can_add(datetime.utcnow()))
+        
+    def testReportTypeCode(self):
+        self._report(100, 20, Reports.SOH)
+        self._report(50, 10, Reports.REC)
+        self.assertEquals([Reports.SOH, Reports.REC], 
+                          list(StockTransaction.objects.filter(supply_point=self.sp, product=self.pr)\
+                               .order_by("date").values_list("report_type_code", flat=True)))
+        
+    def testAverageMonthlyConsumptions(self):
+        from dimagi.utils.dates import DateSpan
+        from logistics.charts import _average_monthly_consumptions
+        for amount, days_ago, report_type in ((200, 100, Reports.SOH), (150, 80, Reports.SOH),
+                                              (50, 70, Reports.REC), (160, 50, Reports.SOH),
+                                              (120, 30, Reports.SOH), (100, 10, Reports.SOH)):
+            self._report(amount, days_ago, report_type)
+        now = datetime.utcnow()
+        datespans = [DateSpan(startdate=now - timedelta(days=start), enddate=now - timedelta(days=end)) \
+                     for start, end in ((110, 40), (90, 20), (60, 0))]
+        amcs = _average_monthly_consumptions(Facility.objects.all(), [self.pr], datespans)
+        for i, dm in enumerate(datespans):
+            daily = self.ps.get_daily_consumption(datespan=dm)
+            self.assertEquals(daily * 30.0 if daily is not None else None, amcs.get((self.pr.pk, i)))
+        
+    def testBatchConsumptionMatchesPerStock(self):
+        other = Product.objects.exclude(pk=self.pr.pk)[0]
+        for amount, days_ago, report_type in ((200, 40, Reports.SOH), (50, 35, Reports.REC),
+                                              (150, 30, Reports.SOH), (0, 25, Reports.SOH),
+                                              (100, 20, Reports.SOH), (80, 10, Reports.SOH),
+                                              (20, 5, Reports.REC), (70, 0, Reports.SOH)):
+            self._report(amount, days_ago, report_type)
+            fake_report(self.sp, other, amount / 2, days_ago, report_type)
+        
+        expected = {}
+        for ps in ProductStock.objects.all():
+            ps.update_auto_consumption()
+            expected[ps.pk] = ProductStock.objects.get(pk=ps.pk).auto_monthly_consumption
+        self.assertTrue(any(expected.values()))
+        
+        ProductStock.objects.update(auto_monthly_consumption=None)
+        self.assertEquals(len([amc for amc in expected.values() if amc]), 
+                          update_auto_consumptions())
+        for ps in ProductStock.objects.all():
+            self.assertEquals(expected[ps.pk], ps.auto_monthly_consumption)
+        # nothing changes the second time round
+        self.assertEquals(0, update_auto_consumptions())
+        
     def _report(self, amount, days_ago, report_type):
         self.ps = fake_report(self.sp, self.pr, amount, days_ago, report_type)[1]
         return self.ps
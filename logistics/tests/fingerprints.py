@@ -0,0 +1,44 @@
+from datetime import datetime, timedelta
+from rapidsms.conf import settings
+from rapidsms.models import Backend, Connection
+from rapidsms.tests.scripted import TestScript
+from logistics.const import MAX_STOCK_OVERRIDE_WINDOW
+from logistics.models import MessageFingerprint
+
+class TestMessageFingerprint(TestScript):
+    
+    def setUp(self):
+        TestScript.setUp(self)
+        backend, _ = Backend.objects.get_or_create(name="fingerprint-test")
+        self.connection = Connection.objects.create(backend=backend, identity="5551234")
+        self.other = Connection.objects.create(backend=backend, identity="5555678")
+        
+    def testRecent(self):
+        MessageFingerprint.record(self.connection, "rec ov 10")
+        self.assertEqual(1, MessageFingerprint.recent(self.connection, "REC OV 10", 60).count())
+        self.assertEqual(0, MessageFingerprint.recent(self.connection, "rec ov 11", 60).count())
+        self.assertEqual(0, MessageFingerprint.recent(self.other, "rec ov 10", 60).count())
+        MessageFingerprint.objects.update(date=datetime.utcnow() - timedelta(seconds=120))
+        self.assertEqual(0, MessageFingerprint.recent(self.connection, "rec ov 10", 60).count())
+    
+    def testExpired(self):
+        MessageFingerprint.record(self.connection, "rec ov 10")
+        MessageFingerprint.objects.update(date=datetime.utcnow() - \
+            timedelta(seconds=MessageFingerprint.ttl() + 60))
+        MessageFingerprint.record(self.connection, "rec ml 10")
+        self.assertEqual(["rec ml 10"], 
+                         [text for text in ("rec ov 10", "rec ml 10") \
+                          if MessageFingerprint.objects.filter(fingerprint=MessageFingerprint.fingerprint_text(text)).exists()])
+    
+    def testTTLCoversLookbacks(self):
+        ttl = settings.LOGISTICS_MESSAGE_FINGERPRINT_TTL
+        dupes = settings.LOGISTICS_IGNORE_DUPE_RECEIPTS_WITHIN
+        try:
+            settings.LOGISTICS_MESSAGE_FINGERPRINT_TTL = 60
+            settings.LOGISTICS_IGNORE_DUPE_RECEIPTS_WITHIN = None
+            self.assertEqual(MAX_STOCK_OVERRIDE_WINDOW, MessageFingerprint.ttl())
+            settings.LOGISTICS_IGNORE_DUPE_RECEIPTS_WITHIN = MAX_STOCK_OVERRIDE_WINDOW * 2
+            self.assertEqual(MAX_STOCK_OVERRIDE_WINDOW * 2, MessageFingerprint.ttl())
+        finally:
+            settings.LOGISTICS_MESSAGE_FINGERPRINT_TTL = ttl
+            settings.LOGISTICS_IGNORE_DUPE_RECEIPTS_WITHIN = dupes
@@ -0,0 +1,85 @@
+import time
+from django.conf import settings as django_settings
+from django.db import connection as db_connection
+from rapidsms.conf import settings
+from rapidsms.models import Backend, Connection, Contact
+from rapidsms.tests.scripted import TestScript
+from logistics.models import SupplyPoint, ContactRole, Responsibility
+from logistics.outbound import local_outbox, recipients, send, RateLimiter
+from logistics.queues import outbound_queue
+from logistics.util import config
+from logistics.tests.util import load_test_data
+
+class TestOutbound(TestScript):
+    
+    def setUp(self):
+        TestScript.setUp(self)
+        load_test_data()
+        self._backend = settings.LOGISTICS_OUTBOUND_BACKEND
+        self._queue_backend = settings.LOGISTICS_QUEUE_BACKEND
+        self._rate_limits = settings.LOGISTICS_OUTBOUND_RATE_LIMITS
+        settings.LOGISTICS_OUTBOUND_BACKEND = settings.OUTBOUND_BACKEND_LOCAL
+        settings.LOGISTICS_QUEUE_BACKEND = settings.QUEUE_BACKEND_SYNC
+        local_outbox.clear()
+        self.sp = SupplyPoint.objects.get(code='dedh')
+        responsibility, _ = Responsibility.objects.get_or_create\
+            (code=config.Responsibilities.REPORTEE_RESPONSIBILITY)
+        role = ContactRole.objects.create(code="testsupervisor")
+        role.responsibilities.add(responsibility)
+        backend, _ = Backend.objects.get_or_create(name="outbound-test")
+        self.contacts = []
+        self.connections = []
+        for name in ("Jane", "John"):
+            contact = Contact.objects.create(name=name, supply_point=self.sp, role=role)
+            self.contacts.append(contact)
+            self.connections.append(Connection.objects.create(backend=backend, contact=contact, 
+                                                              identity="555%s" % contact.pk))
+        # no connection, so nothing is sent
+        Contact.objects.create(name="Jim", supply_point=self.sp, role=role)
+    
+    def tearDown(self):
+        settings.LOGISTICS_OUTBOUND_BACKEND = self._backend
+        settings.LOGISTICS_QUEUE_BACKEND = self._queue_backend
+        settings.LOGISTICS_OUTBOUND_RATE_LIMITS = self._rate_limits
+        local_outbox.clear()
+        TestScript.tearDown(self)
+    
+    def testReportToSupervisor(self):
+        self.sp.report_to_supervisor("Dear %(admin_name)s, stockouts", {})
+        self.assertEqual([(self.connections[0].pk, "Dear Jane, stockouts"), 
+                          (self.connections[1].pk, "Dear John, stockouts")],
+                         sorted((c.pk, text) for c, text in local_outbox.messages))
+    
+    def testExclude(self):
+        self.sp.report_to_supervisor("Dear %(admin_name)s, stockouts", {}, 
+                                     exclude=self.contacts[:1])
+        self.assertEqual([(self.connections[1].pk, "Dear John, stockouts")], 
+                         [(c.pk, text) for c, text in local_outbox.messages])
+    
+    def testRateLimit(self):
+        settings.LOGISTICS_OUTBOUND_RATE_LIMITS = {"limited": 2}
+        limiter = RateLimiter()
+        start = time.time()
+        for i in range(5):
+            limiter.wait("limited")
+            limiter.wait("unlimited")
+        # two a second, so the fifth has to wait for the third second
+        self.assertTrue(time.time() - start > 1)
+    
+    def testSendsDuplicates(self):
+        settings.LOGISTICS_QUEUE_BACKEND = settings.QUEUE_BACKEND_THREADS
+        self.sp.report_to_supervisor("stockouts", {})
+        self.sp.report_to_supervisor("stockouts", {})
+        outbound_queue.join()
+        self.assertEqual(4, len(local_outbox.messages))
+    
+    def testSendWithoutQueries(self):
+        connection = recipients([self.sp], config.Responsibilities.REPORTEE_RESPONSIBILITY)[0][1]
+        debug = django_settings.DEBUG
+        django_settings.DEBUG = True
+        try:
+            queries = len(db_connection.queries)
+            send(connection, "stockouts")
+            self.assertEqual(queries, len(db_connection.queries))
+        finally:
+            django_settings.DEBUG = debug
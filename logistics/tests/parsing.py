@@ -0,0 +1,54 @@
+from rapidsms.tests.scripted import TestScript
+from logistics.models import SupplyPoint, ProductReportsHelper
+from logistics.const import Reports
+from logistics.tests.util import load_test_data
+
+# report formats seen in the field, and how the legacy parser tokenized them
+GOLDEN_TOKENS = (
+    ('ov 10 ml 20', ['ov', '10', 'ml', '20']),
+    ('ov10ml20', ['ov', '10', 'ml', '20']),
+    ('OV 10, ML 20', ['ov', '10', '-', 'ml', '20']),
+    ('ov 10 2 ml 20 3', ['ov', '10', '-', '2', 'ml', '20', '-', '3']),
+    ('ov10-2 ml20-3', ['ov', '10', '-', '2', 'ml', '20', '-', '3']),
+    ('ov 10/2; ml 20/3', ['ov', '10', '-', '2', '-', 'ml', '20', '-', '3']),
+    ('ov10.2', ['ov', '10', '.', '2']),
+    ('ov 10+5 ml 0', ['ov', '10', '-', '5', 'ml', '0']),
+    ('soh ov 10 ml 20', ['sohov', '10', 'ml', '20']),
+    ("ov (10) ml '20'", ['ov', '10', 'ml', '20']),
+    ('ov 1O ml 2O', ['ov', '1', 'oml', '2', 'o']),
+    ('ov 10 * 3', ['ov', '10', '-', '3']),
+    ('jd10.3 mc 5', ['jd', '10', '.', '3', 'mc', '5']),
+    ('ov10 ml', ['ov', '10', 'ml']),
+    ('10 ov', ['10', 'ov']),
+    ('ov - 10', ['ov', '-', '10']),
+    ('ov 10 ml 20 zz 5', ['ov', '10', 'ml', '20', 'zz', '5']),
+    ('ov 10\nml 20', ['ov', '10', '\n', 'ml', '20']),
+    ('ov  10   ml   20', ['ov', '10', 'ml', '20']),
+    ('ov10,2,ml20', ['ov', '10', '-', '2', '-', 'ml', '20']),
+    ('5', ['55']),
+)
+
+class TestReportParsing(TestScript):
+    
+    def setUp(self):
+        TestScript.setUp(self)
+        load_test_data()
+        self.sp = SupplyPoint.objects.get(code="dedh")
+        
+    def _helper(self):
+        return ProductReportsHelper(self.sp, Reports.SOH)
+    
+    def testGoldenTokens(self):
+        for text, tokens in GOLDEN_TOKENS:
+            self.assertEqual(tokens, list(self._helper()._lex(text)))
+            self.assertEqual(tokens, list(self._helper()._lex(unicode(text))))
+    
+    def testParse(self):
+        for text, stock, received in (("ov 10 ml 20", {"ov": 10, "ml": 20}, {}),
+                                      ("ov10-2 ml20-3", {"ov": 10, "ml": 20}, {"ov": 2, "ml": 3}),
+                                      ("OV 10 2, ML 20", {"ov": 10, "ml": 20}, {"ov": 2})):
+            helper = self._helper()
+            helper.parse(text)
+            self.assertEqual(stock, helper.product_stock)
+            self.assertEqual(received, helper.product_received)
+            self.assertEqual([], helper.errors)
@@ -0,0 +1,75 @@
+import threading
+from rapidsms.conf import settings
+from rapidsms.tests.scripted import TestScript
+from logistics.queues import WorkQueue
+from logistics.commit_hooks import queue_after_commit
+
+class TestWorkQueue(TestScript):
+    
+    def setUp(self):
+        TestScript.setUp(self)
+        self._backend = settings.LOGISTICS_QUEUE_BACKEND
+        self._workers = settings.LOGISTICS_QUEUE_WORKERS
+        self.calls = []
+        
+    def tearDown(self):
+        settings.LOGISTICS_QUEUE_BACKEND = self._backend
+        settings.LOGISTICS_QUEUE_WORKERS = self._workers
+        TestScript.tearDown(self)
+    
+    def testSync(self):
+        settings.LOGISTICS_QUEUE_BACKEND = settings.QUEUE_BACKEND_SYNC
+        queue = WorkQueue("test-sync", lambda *key: self.calls.append(key))
+        queue.put(1, 2)
+        queue.put(1, 2)
+        self.assertEqual([(1, 2), (1, 2)], self.calls)
+    
+    def testQueueAfterCommit(self):
+        settings.LOGISTICS_QUEUE_BACKEND = settings.QUEUE_BACKEND_SYNC
+        queue = WorkQueue("test-after-commit", lambda *key: self.calls.append(key))
+        @queue_after_commit
+        def inner():
+            queue.put(2)
+            self.assertEqual([], self.calls)
+        @queue_after_commit
+        def outer():
+            queue.put(1)
+            inner()
+            # still held, until the outermost one returns
+            self.assertEqual([], self.calls)
+        outer()
+        self.assertEqual([(1,), (2,)], self.calls)
+        
+        @queue_after_commit
+        def failing():
+            queue.put(3)
+            raise ValueError()
+        self.assertRaises(ValueError, failing)
+        self.assertEqual([(1,), (2,)], self.calls)
+    
+    def testThreadsCoalesce(self):
+        settings.LOGISTICS_QUEUE_BACKEND = settings.QUEUE_BACKEND_THREADS
+        settings.LOGISTICS_QUEUE_WORKERS = 1
+        started = threading.Event()
+        release = threading.Event()
+        def handler(*key):
+            self.calls.append(key)
+            if key == ("block",):
+                started.set()
+                release.wait(5)
+        queue = WorkQueue("test-threads", handler)
+        
+        # keep the worker busy while the same stock is queued repeatedly
+        queue.put("block")
+        started.wait(5)
+        for i in range(5):
+            queue.put(1, 2)
+        queue.put(3, 4)
+        release.set()
+        queue.join()
+        self.assertEqual([("block",), (1, 2), (3, 4)], self.calls)
+        
+        # once it's been run, it can be queued again
+        queue.put(1, 2)
+        queue.join()
+        self.assertEqual((1, 2), self.calls[-1])
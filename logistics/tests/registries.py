@@ -0,0 +1,163 @@
+from django.conf import settings as django_settings
+from django.db import connection
+from rapidsms.conf import settings
+from rapidsms.models import Contact
+from rapidsms.tests.scripted import TestScript
+from logistics.models import Product, ContactRole, Responsibility
+from logistics.registries import product_keywords, product_codes, product_equivalents, \
+    contact_roles
+from logistics.tests.util import load_test_data
+from logistics.commit_hooks import queue_after_commit
+from logistics.spot_cache import cache
+
+class TestProductKeywords(TestScript):
+    
+    def setUp(self):
+        TestScript.setUp(self)
+        load_test_data()
+        
+    def testMatches(self):
+        self.assertTrue(product_keywords.matches("soh ov 10"))
+        self.assertTrue(product_keywords.matches("ov 10 ml 20"))
+        self.assertFalse(product_keywords.matches("register john"))
+        self.assertFalse(product_keywords.matches("xx 10"))
+    
+    def testRebuiltOnProductChanges(self):
+        self.assertFalse(product_keywords.matches("xx 10"))
+        product = Product.objects.get(sms_code="ov")
+        product.sms_code = "xx"
+        product.save()
+        self.assertTrue(product_keywords.matches("xx 10"))
+        self.assertFalse(product_keywords.matches("ov 10"))
+        product.delete()
+        self.assertFalse(product_keywords.matches("xx 10"))
+    
+    def testVersionBumpedAfterCommit(self):
+        product_keywords.matches("ov 10") # loads the registry
+        before = cache.get(product_keywords.version_key)
+        @queue_after_commit
+        def save():
+            product = Product.objects.get(sms_code="ov")
+            product.sms_code = "xx"
+            product.save()
+            # other processes keep their copies until the commit...
+            self.assertEqual(before, cache.get(product_keywords.version_key))
+            # ...but this one sees its own change straight away
+            self.assertTrue(product_keywords.matches("xx 10"))
+        save()
+        self.assertNotEqual(before, cache.get(product_keywords.version_key))
+        self.assertTrue(product_keywords.matches("xx 10"))
+
+
+class TestProductCodes(TestScript):
+    
+    def setUp(self):
+        TestScript.setUp(self)
+        load_test_data()
+        
+    def _assertMatchesQuery(self, code):
+        try:
+            expected = Product.objects.get(sms_code__icontains=code)
+        except (Product.DoesNotExist, Product.MultipleObjectsReturned), e:
+            self.assertRaises(e.__class__, product_codes.get, code)
+        else:
+            self.assertEqual(expected, product_codes.get(code))
+    
+    def testSameAsQuery(self):
+        Product.objects.create(sms_code="ovx", name="Overette Extra", units="cycle",
+                               type=Product.objects.get(sms_code="ov").type)
+        for code in ("ov", "OV", "ml", "m", "l", "ovx", "x", "o", "v", "zz", "", "mlx"):
+            self._assertMatchesQuery(code)
+    
+    def testIsCode(self):
+        self.assertTrue(product_codes.is_code("ov"))
+        self.assertTrue(product_codes.is_code("ML"))
+        self.assertFalse(product_codes.is_code("o"))
+    
+    def testIsActive(self):
+        self.assertTrue(product_codes.is_active("OV"))
+        Product.objects.get(sms_code="ov").deactivate()
+        self.assertFalse(product_codes.is_active("ov"))
+        self.assertTrue(product_codes.is_active("ml"))
+    
+    def testAliases(self):
+        aliases = settings.LOGISTICS_PRODUCT_ALIASES
+        settings.LOGISTICS_PRODUCT_ALIASES = {"overette": "ov"}
+        product_codes.reset()
+        try:
+            self.assertEqual("ov", product_codes.clean("Overette"))
+            self.assertEqual("ml", product_codes.clean("ML"))
+        finally:
+            settings.LOGISTICS_PRODUCT_ALIASES = aliases
+            product_codes.reset()
+    
+    def testNoQueries(self):
+        product_codes.get("ov") # loads the registry
+        debug = django_settings.DEBUG
+        django_settings.DEBUG = True
+        try:
+            queries = len(connection.queries)
+            for code in ("ov", "ml", "ov"):
+                product_codes.get(product_codes.clean(code))
+                product_codes.is_active(code)
+            self.assertEqual(queries, len(connection.queries))
+        finally:
+            django_settings.DEBUG = debug
+
+
+class TestProductEquivalents(TestScript):
+    
+    def setUp(self):
+        TestScript.setUp(self)
+        load_test_data()
+        self.ov = Product.objects.get(sms_code="ov")
+        self.ml = Product.objects.get(sms_code="ml")
+        self.ovx = Product.objects.create(sms_code="ovx", name="Overette Extra", units="cycle",
+                                          type=self.ov.type)
+        
+    def testTransitive(self):
+        self.assertEqual(set(), product_equivalents.get(self.ov.pk))
+        self.ov.equivalents.add(self.ml)
+        self.assertEqual(set([self.ml.pk]), product_equivalents.get(self.ov.pk))
+        self.ml.equivalents.add(self.ovx)
+        self.assertEqual(set([self.ml.pk, self.ovx.pk]), product_equivalents.get(self.ov.pk))
+        self.assertEqual(set([self.ov.pk, self.ml.pk]), product_equivalents.get(self.ovx.pk))
+        self.ml.equivalents.clear()
+        self.assertEqual(set(), product_equivalents.get(self.ovx.pk))
+
+
+class TestContactRoles(TestScript):
+    
+    def setUp(self):
+        TestScript.setUp(self)
+        self.role = ContactRole.objects.create(code="testrole")
+        self.responsibility = Responsibility.objects.create(code="testresponsibility")
+        self.contact = Contact.objects.create(name="Jane", role=self.role)
+        
+    def testResponsibilities(self):
+        self.assertFalse(self.contact.has_responsibility("testresponsibility"))
+        self.role.responsibilities.add(self.responsibility)
+        self.assertTrue(self.contact.has_responsibility("testresponsibility"))
+        self.role.responsibilities.remove(self.responsibility)
+        self.assertFalse(self.contact.has_responsibility("testresponsibility"))
+        self.assertFalse(Contact(name="John").has_responsibility("testresponsibility"))
+    
+    def testRoles(self):
+        self.assertTrue(contact_roles.has_role(self.contact, "testrole"))
+        self.assertEqual("testrole", self.contact.role_code)
+        self.role.code = "otherrole"
+        self.role.save()
+        self.assertFalse(contact_roles.has_role(self.contact, "testrole"))
+        self.assertFalse(contact_roles.has_role(Contact(name="John"), "testrole"))
+        
+    def testNoQueries(self):
+        self.contact.has_responsibility("testresponsibility") # loads the registry
+        debug = django_settings.DEBUG
+        django_settings.DEBUG = True
+        try:
+            queries = len(connection.queries)
+            self.contact.has_responsibility("testresponsibility")
+            contact_roles.has_role(self.contact, "testrole")
+            self.assertEqual(queries, len(connection.queries))
+        finally:
+            django_settings.DEBUG = debug
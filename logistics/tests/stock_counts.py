@@ -0,0 +1,330 @@
+from rapidsms.conf import settings
+from django.db.models import Sum
+from rapidsms.tests.scripted import TestScript
+from logistics.models import SupplyPoint, SupplyPointType, Product, \
+    ProductStock, DefaultMonthlyConsumption, StockStatus
+from logistics.aggregation import STOCK_COUNT_KEYS, stock_counts_from_db, \
+    stock_counts_from_status_table, rebuild_stock_statuses, refresh_stock_statuses, \
+    StockCountRollup, _parent_id
+from logistics.tests.util import load_test_data
+from logistics.spot_cache import round_trips, reset_round_trips, \
+    bump_generations, GLOBAL_GENERATION_KEY, cache
+from logistics.commit_hooks import queue_after_commit
+from rapidsms.contrib.locations.models import Location
+
+class TestStockCounts(TestScript):
+    
+    def setUp(self):
+        TestScript.setUp(self)
+        load_test_data()
+        self.sp = SupplyPoint.objects.get(code='dedh')
+        self.stocks = ProductStock.objects.filter(supply_point=self.sp)
+        
+    def _assert_counts_match(self):
+        stocks = self.stocks.select_related("supply_point", "supply_point__type", "product")
+        python_counts = self.sp._stock_counts_from_python(stocks)
+        db_counts = stock_counts_from_db(stocks)
+        for key in STOCK_COUNT_KEYS:
+            self.assertEqual(python_counts[key], db_counts[key], 
+                             "%s: %s != %s" % (key, python_counts[key], db_counts[key]))
+
+    def _check_quantities(self):
+        for quantity in [None, 0, 1, 2, 3, 7, 8, 14, 15, 16, 30]:
+            self.stocks.update(quantity=quantity)
+            self._assert_counts_match()
+    
+    def testDefaultConsumption(self):
+        # falls back to the product's average monthly consumption
+        self._check_quantities()
+        
+    def testManualConsumption(self):
+        self.stocks.update(manual_monthly_consumption=10)
+        self._check_quantities()
+
+    def testNoConsumption(self):
+        Product.objects.all().update(average_monthly_consumption=None)
+        self._check_quantities()
+        
+    def testAutoConsumption(self):
+        self.stocks.update(use_auto_consumption=True, auto_monthly_consumption=7)
+        self._check_quantities()
+        self.stocks.update(auto_monthly_consumption=0)
+        self._check_quantities()
+    
+    def testSupplyPointTypeConsumption(self):
+        for product in Product.objects.all():
+            DefaultMonthlyConsumption.objects.create(supply_point_type=self.sp.type, 
+                                                     product=product, 
+                                                     default_monthly_consumption=9)
+        self._check_quantities()
+
+    def testConsumptionTotal(self):
+        self.stocks.update(manual_monthly_consumption=10)
+        self.assertEqual(20, stock_counts_from_db(self.stocks)["consumption"])
+
+    def testLevelsFollowSupplyPointType(self):
+        sptype = SupplyPointType.objects.create(code="levelstest", name="Levels Test")
+        for product in Product.objects.all():
+            DefaultMonthlyConsumption.objects.create(supply_point_type=sptype, product=product, 
+                                                     default_monthly_consumption=9)
+        stock = self.stocks.select_related("supply_point", "supply_point__type")[0]
+        self.assertNotEqual(9, stock.monthly_consumption)
+        stock.supply_point.type = sptype
+        self.assertEqual(9, stock.monthly_consumption)
+    
+    def testLevelLookupsPerClassifiedStock(self):
+        # each stock should only resolve its default consumption once,
+        # no matter how many of the is_* methods are called on it
+        lookups = []
+        original = SupplyPointType.__dict__["monthly_consumption_by_product"]
+        def _counting_lookup(sptype, product):
+            lookups.append((sptype.code, product.sms_code))
+            return original(sptype, product)
+        SupplyPointType.monthly_consumption_by_product = _counting_lookup
+        try:
+            stocks = list(self.stocks.select_related("supply_point", "supply_point__type", "product"))
+            self.sp._stock_counts_from_python(stocks)
+            for stock in stocks:
+                stock.reorder_amount
+                stock.months_remaining
+        finally:
+            SupplyPointType.monthly_consumption_by_product = original
+        self.assertEqual(len(stocks), len(lookups))
+
+
+class TestStockStatusTable(TestScript):
+    
+    def setUp(self):
+        TestScript.setUp(self)
+        self._original_counts_by = settings.LOGISTICS_STOCK_COUNTS_BY
+        settings.LOGISTICS_STOCK_COUNTS_BY = settings.STOCK_COUNTS_BY_STATUS_TABLE
+        load_test_data()
+        self.sp = SupplyPoint.objects.get(code='dedh')
+        self.stocks = ProductStock.objects.filter(supply_point=self.sp)
+        
+    def tearDown(self):
+        settings.LOGISTICS_STOCK_COUNTS_BY = self._original_counts_by
+        TestScript.tearDown(self)
+        
+    def _assert_counts_match(self):
+        stocks = self.stocks.select_related("supply_point", "supply_point__type", "product")
+        python_counts = self.sp._stock_counts_from_python(stocks)
+        table_counts = stock_counts_from_status_table(StockStatus.objects.filter(supply_point=self.sp))
+        python_counts["consumption"] = stocks.exclude(manual_monthly_consumption=None)\
+            .aggregate(total=Sum('manual_monthly_consumption'))['total']
+        for key in STOCK_COUNT_KEYS + ("consumption",):
+            self.assertEqual(python_counts[key], table_counts[key], 
+                             "%s: %s != %s" % (key, python_counts[key], table_counts[key]))
+    
+    def _save_quantities(self):
+        for quantity in [None, 0, 1, 2, 7, 8, 15, 16, 30]:
+            for stock in self.stocks:
+                stock.quantity = quantity
+                stock.save()
+            self._assert_counts_match()
+    
+    def testStockSaves(self):
+        self.assertEqual(self.stocks.count(), 
+                         StockStatus.objects.filter(supply_point=self.sp).count())
+        self._save_quantities()
+        for stock in self.stocks:
+            stock.manual_monthly_consumption = 10
+            stock.save()
+        self._save_quantities()
+        
+    def testConsumptionChanges(self):
+        for product in Product.objects.all():
+            DefaultMonthlyConsumption.objects.create(supply_point_type=self.sp.type, 
+                                                     product=product, 
+                                                     default_monthly_consumption=9)
+        self._save_quantities()
+        DefaultMonthlyConsumption.objects.all().delete()
+        self._assert_counts_match()
+        for product in Product.objects.all():
+            product.average_monthly_consumption = 20
+            product.save()
+        self._assert_counts_match()
+        
+    def testSupplyPointTypeChanges(self):
+        sptype = SupplyPointType.objects.create(code="statustest", name="Status Test")
+        for product in Product.objects.all():
+            DefaultMonthlyConsumption.objects.create(supply_point_type=sptype, product=product, 
+                                                     default_monthly_consumption=9)
+        for stock in self.stocks:
+            stock.quantity = 8
+            stock.save()
+        self.sp.type = sptype
+        self.sp.save()
+        self._assert_counts_match()
+        
+    def testConcurrentCreate(self):
+        stocks = list(self.stocks.select_related("supply_point", "supply_point__type", "product"))
+        StockStatus.objects.all().delete()
+        for stock in stocks:
+            stock.quantity = 0
+        # the second of each pair finds the row the first created since
+        # it looked, and updates it instead
+        refresh_stock_statuses([stock for stock in stocks for _ in range(2)])
+        self.assertEqual(len(stocks), StockStatus.objects.filter(supply_point=self.sp).count())
+        self.stocks.update(quantity=0)
+        self._assert_counts_match()
+        
+    def testRebuild(self):
+        self.stocks.update(quantity=3) # doesn't fire any signals
+        StockStatus.objects.all().delete()
+        self.assertEqual(ProductStock.objects.count(), rebuild_stock_statuses())
+        self._assert_counts_match()
+
+
+class TestStockCountRollup(TestScript):
+    
+    def setUp(self):
+        TestScript.setUp(self)
+        load_test_data()
+        self.country = Location.objects.get(code=settings.COUNTRY)
+        garms = SupplyPoint.objects.get(code='garms')
+        for product, quantity in zip(Product.objects.all(), [0, 40]):
+            ProductStock.objects.create(supply_point=garms, product=product, 
+                                        quantity=quantity, manual_monthly_consumption=10)
+        ProductStock.objects.filter(supply_point__code='dedh').update(quantity=3)
+        
+    def _assert_rollup_matches(self, product=None):
+        rollup = StockCountRollup(self.country, product=product)
+        self.assertEqual(3, len(rollup.locations))
+        for location in rollup.locations:
+            for key in STOCK_COUNT_KEYS + ("consumption",):
+                # the old way: scan all the stocks under each location
+                expected = location._get_stock_count_for_facilities(location.all_facilities(), 
+                                                                    key, product, None)
+                self.assertEqual(expected, rollup.get(location, key), 
+                                 "%s %s: %s != %s" % (location.code, key, expected, 
+                                                      rollup.get(location, key)))
+        for facility in rollup.facilities:
+            for key in STOCK_COUNT_KEYS + ("consumption",):
+                self.assertEqual(facility._get_stock_count(key, product, None), 
+                                 rollup.get(facility, key))
+    
+    def testRollup(self):
+        self._assert_rollup_matches()
+        self._assert_rollup_matches(product='ov')
+    
+    def testRollupFromDb(self):
+        original = settings.LOGISTICS_STOCK_COUNTS_BY
+        settings.LOGISTICS_STOCK_COUNTS_BY = settings.STOCK_COUNTS_BY_SQL
+        try:
+            self._assert_rollup_matches()
+        finally:
+            settings.LOGISTICS_STOCK_COUNTS_BY = original
+    
+    def testCountsAreSummedUpTheTree(self):
+        rollup = StockCountRollup(self.country)
+        self.assertEqual(1, rollup.get(self.country, "stockout_count"))
+        self.assertEqual(3, rollup.get(self.country, "stocked_count"))
+        self.assertEqual(2, rollup.get(Location.objects.get(code='de'), "stocked_count"))
+        self.assertEqual(20, rollup.get(self.country, "consumption"))
+        self.assertEqual(None, rollup.get(Location.objects.get(code='de'), "consumption"))
+
+
+class TestSpotCacheRoundTrips(TestScript):
+    
+    def setUp(self):
+        TestScript.setUp(self)
+        self._original_spot_caching = settings.LOGISTICS_USE_SPOT_CACHING
+        settings.LOGISTICS_USE_SPOT_CACHING = True
+        load_test_data()
+        # the cache isn't rolled back between tests like the database is
+        bump_generations([GLOBAL_GENERATION_KEY])
+        self.sp = SupplyPoint.objects.get(code='dedh')
+        
+    def tearDown(self):
+        settings.LOGISTICS_USE_SPOT_CACHING = self._original_spot_caching
+        TestScript.tearDown(self)
+        
+    def testCountsArePacked(self):
+        ProductStock.objects.filter(supply_point=self.sp).update(quantity=0)
+        self.sp._populate_stock_cache([self.sp], 'ov', None)
+        reset_round_trips()
+        # one to read the generations, one to set all the counts
+        self.sp._populate_stock_cache([self.sp], 'ov', None)
+        self.assertEqual(2, round_trips())
+        reset_round_trips()
+        self.assertEqual(1, self.sp.stockout_count(product='ov'))
+        self.assertEqual(1, self.sp.emergency_stock_count(product='ov'))
+        self.assertEqual(0, self.sp.overstocked_count(product='ov'))
+        self.assertEqual(3, round_trips())
+        
+    def testInactiveRoot(self):
+        self.country.is_active = False
+        self.country.save()
+        rollup = StockCountRollup(self.country)
+        children = [loc for loc in rollup.locations if _parent_id(loc) == self.country.pk]
+        for key in STOCK_COUNT_KEYS:
+            self.assertEqual(sum(rollup.get(child, key) for child in children), 
+                             rollup.get(self.country, key))
+        
+    def testRollupIsCachedInOneTrip(self):
+        country = Location.objects.get(code=settings.COUNTRY)
+        rollup = StockCountRollup(country)
+        reset_round_trips()
+        rollup.cache()
+        self.assertEqual(1, round_trips())
+    
+    def testStockSavesInvalidate(self):
+        country = Location.objects.get(code=settings.COUNTRY)
+        for stock in ProductStock.objects.filter(supply_point=self.sp):
+            stock.quantity = 0
+            stock.save()
+        self.assertEqual(1, self.sp.stockout_count(product='ov'))
+        self.assertEqual(2, country.stockout_count())
+        stock = ProductStock.objects.get(supply_point=self.sp, product__sms_code='ov')
+        stock.quantity = 10
+        stock.save()
+        # both the facility and every location above it see the change
+        self.assertEqual(0, self.sp.stockout_count(product='ov'))
+        self.assertEqual(1, country.stockout_count())
+        
+    def testSupplyPointChangesInvalidate(self):
+        country = Location.objects.get(code=settings.COUNTRY)
+        ProductStock.objects.filter(supply_point=self.sp).update(quantity=0)
+        stockouts = country.stockout_count()
+        own = self.sp.stockout_count()
+        self.assertTrue(own > 0)
+        self.sp.active = False
+        self.sp.save()
+        # the locations above it no longer count it
+        self.assertEqual(stockouts - own, country.stockout_count())
+    
+    def testBumpIsOneTrip(self):
+        self.sp.invalidate_spot_caches() # loads the location tree
+        reset_round_trips()
+        self.sp.invalidate_spot_caches()
+        # one to check the location tree is current, one to bump
+        self.assertEqual(2, round_trips())
+    
+    def testBumpWaitsForCommit(self):
+        key = self.sp._generation_key()
+        before = cache.get(key)
+        @queue_after_commit
+        def save():
+            bump_generations([key])
+            # other processes mustn't see the new generation before the commit
+            self.assertEqual(before, cache.get(key))
+        save()
+        self.assertNotEqual(before, cache.get(key))
+        
+        @queue_after_commit
+        def failing():
+            bump_generations([key])
+            raise ValueError()
+        after = cache.get(key)
+        self.assertRaises(ValueError, failing)
+        self.assertEqual(after, cache.get(key))
+        
+    def testDefaultConsumptionChangesInvalidate(self):
+        ProductStock.objects.filter(supply_point=self.sp).update(quantity=12)
+        self.assertEqual(0, self.sp.overstocked_count())
+        for product in Product.objects.all():
+            DefaultMonthlyConsumption.objects.create(supply_point_type=self.sp.type, 
+                                                     product=product, 
+                                                     default_monthly_consumption=1)
+        self.assertEqual(2, self.sp.overstocked_count())
@@ -0,0 +1,157 @@
+from django.conf import settings as django_settings
+from django.db import connection
+from rapidsms.conf import settings
+from rapidsms.tests.scripted import TestScript
+from logistics.models import SupplyPoint, Product, ProductStock, ProductReport, \
+    ProductReportsHelper, StockTransaction
+from logistics.signals import stockout_reported, stockout_resolved
+from logistics.stock_reports import ReportBatch
+from logistics.const import Reports
+from logistics.tests.util import load_test_data
+
+class TestReportBatch(TestScript):
+    
+    def setUp(self):
+        TestScript.setUp(self)
+        load_test_data()
+        self.sp = SupplyPoint.objects.get(code='dedh')
+        self.ov = Product.objects.get(sms_code='ov')
+        self.ml = Product.objects.get(sms_code='ml')
+        
+    def _transactions(self, product):
+        return [(st.report_type_code, st.beginning_balance, st.quantity, st.ending_balance) \
+                for st in StockTransaction.objects.filter(supply_point=self.sp, product=product)\
+                                                  .order_by("pk")]
+        
+    def testMatchesReportingOneAtATime(self):
+        self.sp.report_stock(self.ov, 10)
+        helper = ProductReportsHelper(self.sp, Reports.SOH)
+        helper.add_product_stock("ov", 0)
+        helper.add_product_receipt("ov", 5)
+        helper.add_product_stock("ml", 20)
+        helper.save()
+        self.assertEqual([(Reports.SOH, 0, 10, 10), (Reports.REC, 10, 5, 15), 
+                          (Reports.SOH, 15, -15, 0)], self._transactions(self.ov))
+        self.assertEqual([(Reports.SOH, 0, 20, 20)], self._transactions(self.ml))
+        self.assertEqual(0, ProductStock.objects.get(supply_point=self.sp, product=self.ov).quantity)
+        self.assertEqual(20, ProductStock.objects.get(supply_point=self.sp, product=self.ml).quantity)
+        for st in StockTransaction.objects.filter(supply_point=self.sp):
+            self.assertEqual(st.product_id, st.product_report.product_id)
+            self.assertEqual(st.date, st.product_report.report_date)
+        self.assertEqual(4, ProductReport.objects.filter(supply_point=self.sp).count())
+        self.assertNotEqual(None, SupplyPoint.objects.get(pk=self.sp.pk).last_reported)
+    
+    def testStockoutSignals(self):
+        self.sp.report_stock(self.ov, 10)
+        sent = []
+        def reported(sender, supply_point, products, **kwargs):
+            sent.append(("reported", [p.sms_code for p in products]))
+        def resolved(sender, supply_point, products, **kwargs):
+            sent.append(("resolved", [p.sms_code for p in products]))
+        stockout_reported.connect(reported)
+        stockout_resolved.connect(resolved)
+        try:
+            helper = ProductReportsHelper(self.sp, Reports.SOH)
+            helper.add_product_stock("ov", 0)
+            helper.add_product_stock("ml", 20)
+            helper.save()
+        finally:
+            stockout_reported.disconnect(reported)
+            stockout_resolved.disconnect(resolved)
+        self.assertEqual([("resolved", ["ml"]), ("reported", ["ov"])], sent)
+    
+    def testWriteQueries(self):
+        products = list(Product.objects.all())
+        for product in products:
+            self.sp.report_stock(product, 10)
+        
+        def count_queries(products):
+            queries = len(connection.queries)
+            batch = ReportBatch(self.sp, products)
+            for product in products:
+                batch.add(product, Reports.SOH, 5)
+            batch._write()
+            return len(connection.queries) - queries
+        
+        debug = django_settings.DEBUG
+        django_settings.DEBUG = True
+        try:
+            one, many = count_queries(products[:1]), count_queries(products)
+        finally:
+            django_settings.DEBUG = debug
+        if connection.features.can_return_id_from_insert:
+            self.assertEqual(one, many)
+        else:
+            # an insert for each report and transaction
+            self.assertEqual(one + 2 * (len(products) - 1), many)
+    
+    def testSetsPrimaryKeys(self):
+        self.sp.report_stock(self.ov, 10)
+        # an earlier report at the same time mustn't be picked up
+        batch = ReportBatch(self.sp, [self.ov, self.ml])
+        batch.add(self.ov, Reports.SOH, 5)
+        batch.save()
+        batch = ReportBatch(self.sp, [self.ov, self.ml], date=batch.date)
+        reports = [batch.add(self.ov, Reports.REC, 5), batch.add(self.ml, Reports.SOH, 20)]
+        batch.save()
+        for report, stock, st, _ in batch._entries:
+            self.assertEqual(report, ProductReport.objects.get(pk=report.pk))
+            self.assertEqual(report.pk, StockTransaction.objects.get(pk=st.pk).product_report_id)
+            self.assertEqual(stock.quantity, ProductStock.objects.get(pk=stock.pk).quantity)
+        self.assertEqual([(Reports.REC, 5), (Reports.SOH, 20)], 
+                         [(r.report_type.code, r.quantity) for r in reports])
+    
+    def testRepliesInConstantQueries(self):
+        def count_queries(codes):
+            helper = ProductReportsHelper(self.sp, Reports.SOH)
+            for code in codes:
+                helper.add_product_stock(code, 0)
+            helper.save()
+            queries = len(connection.queries)
+            helper.amount_to_reorder()
+            helper.stockouts()
+            helper.low_supply()
+            helper.over_supply()
+            self.assertEqual(" ".join(helper._stockouts()), helper.stockouts())
+            return len(connection.queries) - queries
+        
+        codes = list(Product.objects.values_list("sms_code", flat=True))
+        debug = django_settings.DEBUG
+        django_settings.DEBUG = True
+        try:
+            self.assertEqual(count_queries(codes[:1]), count_queries(codes))
+        finally:
+            django_settings.DEBUG = debug
+    
+    def testReplies(self):
+        helper = ProductReportsHelper(self.sp, Reports.SOH)
+        helper.add_product_stock("ov", 0)
+        helper.add_product_stock("ml", 20)
+        helper.save()
+        self.assertEqual("ov", helper.stockouts())
+        self.assertTrue(helper.context.stock(self.ov) is helper.context.stock(self.ov))
+        self.assertEqual(0, helper.context.stock(self.ov).quantity)
+    
+    def testEquivalentsSuppressStockouts(self):
+        equivalents = getattr(settings, "LOGISTICS_USE_COMMODITY_EQUIVALENTS", False)
+        settings.LOGISTICS_USE_COMMODITY_EQUIVALENTS = True
+        try:
+            ovx = Product.objects.create(sms_code="ovx", name="Overette Extra", units="cycle",
+                                         type=self.ov.type)
+            # only equivalent to ov through ml
+            self.ov.equivalents.add(self.ml)
+            self.ml.equivalents.add(ovx)
+            helper = ProductReportsHelper(self.sp, Reports.SOH)
+            helper.add_product_stock("ov", 0)
+            helper.add_product_stock("ovx", 1000)
+            helper.save()
+            stocks = ProductStock.objects.count()
+            if helper.context.stock(ovx).is_above_low_supply():
+                self.assertEqual("", helper.stockouts())
+            else:
+                self.assertEqual("ov", helper.stockouts())
+            helper.low_supply()
+            # nothing is written working out the replies
+            self.assertEqual(stocks, ProductStock.objects.count())
+        finally:
+            settings.LOGISTICS_USE_COMMODITY_EQUIVALENTS = equivalents
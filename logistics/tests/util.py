@@ -2,12 +2,15 @@ from datetime import timedelta
 from logistics import loader as logi_loader
 from logistics.const import Reports
 from logistics.models import StockTransaction, ProductStock
+from logistics.registries import reset_registries
 
 def load_test_data():
     logi_loader.init_reports()
     logi_loader.init_supply_point_types()
     logi_loader.init_test_location_and_supplypoints()
     logi_loader.init_test_product_and_stock()
+    # test data is rolled back between tests without firing any signals
+    reset_registries()
     
 def fake_report(supply_point, product, amount, days_ago, report_type, date=None):
     """
@@ -26,6 +26,8 @@ from rapidsms.contrib.messagelog.views import message_log as rapidsms_messagelog
 from dimagi.utils.dates import DateSpan
 from dimagi.utils.decorators.datespan import datespan_in_request
 from email_reports.decorators import magic_token_required
+from logistics.aggregation import stock_count_rollup
+from logistics.commit_hooks import queue_after_commit
 from logistics.charts import stocklevel_plot
 from logistics.decorators import place_in_request
 from logistics.models import ProductStock, \
@@ -260,7 +262,13 @@ def aggregate(request, location_code=None, context={}, template="logistics/aggre
         template, context, context_instance=RequestContext(request)
     )
 
-def _get_rows_from_children(children, commodity_filter, commoditytype_filter, datespan=None):
+def _get_rows_from_children(children, commodity_filter, commoditytype_filter, datespan=None, 
+                            rollup=None):
+    """
+    If counts covering all the children are passed in (see 
+    logistics.aggregation.stock_count_rollup), they are read from there 
+    rather than looked up on each child.
+    """
     rows = []
     for child in children:
         row = {}
@@ -272,24 +280,33 @@ def _get_rows_from_children(children, commodity_filter, commoditytype_filter, da
             row['url'] = reverse('stockonhand_facility', args=[child.code])
         else:
             row['url'] = reverse('logistics_dashboard', args=[child.code])
-        row['stockout_count'] = child.stockout_count(product=commodity_filter, 
-                                                     producttype=commoditytype_filter, 
-                                                     datespan=datespan)
-        row['emergency_plus_low'] = child.emergency_plus_low(product=commodity_filter, 
-                                                     producttype=commoditytype_filter, 
-                                                     datespan=datespan)
-        row['good_supply_count'] = child.good_supply_count(product=commodity_filter, 
-                                                     producttype=commoditytype_filter, 
-                                                     datespan=datespan)
-        row['overstocked_count'] = child.overstocked_count(product=commodity_filter, 
-                                                     producttype=commoditytype_filter, 
-                                                     datespan=datespan)
+        if rollup is not None:
+            counts = rollup.counts(child)
+            for key in ('stockout_count', 'emergency_plus_low', 
+                        'good_supply_count', 'overstocked_count'):
+                row[key] = counts[key]
+        else:
+            row['stockout_count'] = child.stockout_count(product=commodity_filter, 
+                                                         producttype=commoditytype_filter, 
+                                                         datespan=datespan)
+            row['emergency_plus_low'] = child.emergency_plus_low(product=commodity_filter, 
+                                                         producttype=commoditytype_filter, 
+                                                         datespan=datespan)
+            row['good_supply_count'] = child.good_supply_count(product=commodity_filter, 
+                                                         producttype=commoditytype_filter, 
+                                                         datespan=datespan)
+            row['overstocked_count'] = child.overstocked_count(product=commodity_filter, 
+                                                         producttype=commoditytype_filter, 
+                                                         datespan=datespan)
         z = lambda x: x if x is not None else 0
         row['total'] = z(row['stockout_count']) + z(row['emergency_plus_low']) + \
           z(row['good_supply_count']) + z(row['overstocked_count'])
         if commodity_filter is not None:
-            row['consumption'] = child.consumption(product=commodity_filter, 
-                                                   producttype=commoditytype_filter)
+            if rollup is not None:
+                row['consumption'] = rollup.get(child, 'consumption')
+            else:
+                row['consumption'] = child.consumption(product=commodity_filter, 
+                                                       producttype=commoditytype_filter)
         rows.append(row)
     return rows
 
@@ -297,7 +314,11 @@ def get_location_children(location, commodity_filter, commoditytype_filter, date
     children = []
     children.extend(location.facilities())
     children.extend(location.get_children())
-    return _get_rows_from_children(children, commodity_filter, commoditytype_filter, datespan)
+    # one pass over everything below the location, rather than one per child
+    rollup = stock_count_rollup(location, children, commodity_filter, commoditytype_filter, 
+                                datespan)
+    return _get_rows_from_children(children, commodity_filter, commoditytype_filter, datespan, 
+                                   rollup)
 
 @cache_page(60 * 15)
 def export_reporting(request, location_code=None):
@@ -340,6 +361,7 @@ def export_stockonhand(request, facility_code, format='xls', filename='stockonha
     return response
 
 @permission_required('logistics.add_facility')
+@queue_after_commit
 @transaction.commit_on_success
 def facility(req, pk=None, template="logistics/config.html"):
     facility = None
@@ -384,6 +406,7 @@ def facility(req, pk=None, template="logistics/config.html"):
     )
 
 @permission_required('logistics.add_product')
+@queue_after_commit
 @transaction.commit_on_success
 def activate_commodity(request, sms_code):
     """ 
@@ -397,6 +420,7 @@ def activate_commodity(request, sms_code):
     return HttpResponse("success")
 
 @permission_required('logistics.add_product')
+@queue_after_commit
 @transaction.commit_on_success
 def commodity(req, pk=None, template="logistics/config.html"):
     form = None
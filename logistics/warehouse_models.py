@@ -10,6 +10,47 @@ class HistoricalStockCache(models.Model):
     year = models.PositiveIntegerField()
     month = models.PositiveIntegerField()
     stock = models.IntegerField(null=True)
+    # when the stock was worked out. rows computed before the end of their
+    # month (or before this was recorded) may be missing transactions, so 
+    # they're recomputed rather than trusted.
+    computed = models.DateTimeField(null=True)
+    
+    class Meta:
+        unique_together = (('supply_point', 'product', 'year', 'month'),)
+
+class HistoricalStockCacheRun(models.Model):
+    """
+    A record of a run of populate_historical_stock_cache. The last 
+    transaction it covered is the watermark the next incremental run 
+    starts from.
+    """
+    last_transaction_id = models.PositiveIntegerField(default=0)
+    started = models.DateTimeField(default=datetime.utcnow)
+    completed = models.DateTimeField(null=True)
+    is_full = models.BooleanField(default=True)
+    rows_written = models.PositiveIntegerField(default=0)
+
+class StockStatus(models.Model):
+    """
+    A materialized copy of the current status of every ProductStock, 
+    kept up to date by signals as stocks and consumptions change, so that
+    stock counts for a location are a grouped count over an index rather
+    than a walk through every stock.
+    
+    flags has one bit set for each stock count the stock is included in
+    (see logistics.aggregation.STOCK_STATUS_FLAGS)
+    """
+    supply_point = models.ForeignKey('logistics.SupplyPoint')
+    product = models.ForeignKey('logistics.Product')
+    is_active = models.BooleanField(default=True, db_index=True)
+    quantity = models.IntegerField(null=True)
+    manual_monthly_consumption = models.PositiveIntegerField(null=True)
+    monthly_consumption = models.PositiveIntegerField(null=True)
+    flags = models.PositiveIntegerField(default=0, db_index=True)
+    last_updated = models.DateTimeField(default=datetime.utcnow)
+    
+    class Meta:
+        unique_together = (('supply_point', 'product'),)
 
 class BaseReportingModel(models.Model):
     """